@@ -15,13 +15,35 @@ point of view:
    0  1  2  3  4  5  6  7
    
 The squared marked * would be identified by tuple (4, 2). There's no board
-class; just a list of pieces - each piece keeps track of its own position.
+class; just a list of pieces - each piece keeps track of its own position. The
+game also keeps a 64-entry index of squares (x + y * 8) so that looking up the
+piece on a square doesn't need to scan the list.
 
 """
+import os
 import re
 import sys
+import json
+import math
+import mmap
 import copy
+import time
 import random
+import struct
+import shutil
+import tempfile
+import argparse
+import itertools
+import threading
+import collections
+import multiprocessing
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for batched move generation
+    numpy = None
 
 # Regular expression for a valid grid reference (only used for input)
 GRID_REF = re.compile(r"^[A-H][1-8]$")
@@ -48,29 +70,106 @@ DOWN_LEFT = (-1, -1)
 LEFT = (-1, 0)
 UP_LEFT = (-1, 1)
 
+# Clockwise, starting with one square up
+ALL_DIRECTIONS = [UP, UP_RIGHT, RIGHT, DOWN_RIGHT,
+                  DOWN, DOWN_LEFT, LEFT, UP_LEFT]
+DIAGONAL_DIRECTIONS = [UP_RIGHT, DOWN_RIGHT, DOWN_LEFT, UP_LEFT]
+STRAIGHT_DIRECTIONS = [UP, RIGHT, DOWN, LEFT]
+
+# Knight moves:
+# [ ][7][ ][0][ ]
+# [6][ ][ ][ ][1]
+# [ ][ ][N][ ][ ]
+# [5][ ][ ][ ][2]
+# [ ][4][ ][3][ ]
+KNIGHT_OFFSETS = [(1, 2), (2, 1), (2, -1), (1, -2),
+                  (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+
+
+def _build_target_table(offsets):
+    """For each square (x + y * 8), the positions one offset away that are
+    on the board, in offset order.
+    
+    """
+    table = []
+    for square in range(64):
+        x, y = square % 8, square // 8
+        table.append(tuple((x + offset[0], y + offset[1])
+                           for offset in offsets
+                           if 0 <= x + offset[0] <= 7 and
+                           0 <= y + offset[1] <= 7))
+    return table
+
+def _build_ray_squares(direction):
+    """For each square, the positions in the given direction up to the edge
+    of the board, nearest first.
+    
+    """
+    table = []
+    for square in range(64):
+        ray = []
+        x, y = square % 8 + direction[0], square // 8 + direction[1]
+        while 0 <= x <= 7 and 0 <= y <= 7:
+            ray.append((x, y))
+            x, y = x + direction[0], y + direction[1]
+        table.append(tuple(ray))
+    return table
+
+# Precomputed targets for each square, so move generation doesn't have to
+# build and bounds check offset tuples
+KNIGHT_TARGETS = _build_target_table(KNIGHT_OFFSETS)
+KING_TARGETS = _build_target_table(ALL_DIRECTIONS)
+RAY_SQUARES = dict((direction, _build_ray_squares(direction))
+                   for direction in ALL_DIRECTIONS)
+
 # ANSI color codes
 ANSI_BEGIN = "\033[%sm"
 ANSI_END = "\033[0m"
 ANSI_BG = {DARK: "40", LIGHT: "44", HIGHLIGHTED: "42"}
 ANSI_FG = {WHITE: "37", BLACK: "31"}
+BOARD_FILE_LABELS = "   A B C D E F G H"
+
+# Calls of get_valid_moves to time in run_move_benchmark, and plies of the
+# random game it checks the legality of moves along
+MOVE_BENCHMARK_CALLS = 200
+MOVE_BENCHMARK_PLIES = 40
+
+# Random games for compare mode to play on every backend side by side, and
+# the most plies to play in each
+COMPARE_GAMES = 60
+COMPARE_MAX_PLIES = 200
+
+# Random games for check mode to take positions from, and the most plies to
+# play in each
+CHECK_GAMES = 10
+CHECK_MAX_PLIES = 120
 
 
 class AbstractPiece(object):
     """Abstract superclass defining a chess piece.
     
     Pieces keep track of their own attributes and board position. Subclasses
-    must implement get_valid_moves.
+    must implement get_valid_moves, and declare empty __slots__ so that
+    pieces don't carry an attribute dictionary.
     
     """
+    __slots__ = ("color", "pos", "has_moved")
+    
     def __init__(self, color, pos):
         if not color in (WHITE, BLACK):
             raise ValueError("Invalid color")
         self.color = color
         self.pos = pos
-        self.name = PIECE_NAMES[self.__class__]
-        self.value = PIECE_VALUES[self.__class__]
         self.has_moved = False
     
+    @property
+    def name(self):
+        return PIECE_NAMES[self.__class__]
+    
+    @property
+    def value(self):
+        return PIECE_VALUES[self.__class__]
+    
     def __str__(self):
         color_string = COLOR_NAMES[self.color]
         piece_string = PIECE_NAMES[self.__class__]
@@ -90,6 +189,25 @@ class AbstractPiece(object):
         """
         raise NotImplementedError()
     
+    def get_attacked_squares(self, game):
+        """Squares the piece attacks in the given game, including squares
+        occupied by its own side (which it defends).
+        
+        """
+        raise NotImplementedError()
+    
+    def get_attacks_in_direction(self, game, direction):
+        """Squares attacked along a given direction, up to and including the
+        first piece of either colour.
+        
+        """
+        squares = []
+        for pos in RAY_SQUARES[direction][self.pos[0] + self.pos[1] * 8]:
+            squares.append(pos)
+            if game.get_piece_at(pos):
+                break
+        return squares
+    
     def get_moves_in_direction(self, game, direction):
         """Find all moves along a given direction.
         
@@ -99,19 +217,9 @@ class AbstractPiece(object):
         """
         moves = []
         
-        # Start from the current position
-        test_move = self.pos
-        
-        # Keep adding the offset until we hit an invalid move
-        while True:
-            test_move = (test_move[0] + direction[0],
-                         test_move[1] + direction[1])
-            
-            # Off the board? No more moves in this direction.
-            if (test_move[0] < 0 or test_move[0] > 7 or
-                test_move[1] < 0 or test_move[1] > 7):
-                break
-            
+        # Walk the precomputed ray until we hit a piece; it stops at the
+        # edge of the board.
+        for test_move in RAY_SQUARES[direction][self.pos[0] + self.pos[1] * 8]:
             # Hit a piece? Action depends on which color
             hit_piece = game.get_piece_at(test_move)
             if hit_piece:
@@ -136,7 +244,8 @@ class AbstractPiece(object):
         
         * Not on the board
         * Taking own piece
-        * Doesn't rescue the King from check
+        
+        Moves that leave the King in check are removed by the game.
         
         """
         valid_moves = []
@@ -157,14 +266,14 @@ class AbstractPiece(object):
                 # Taking its own piece
                 continue
             
-            # TODO: If in check, remove moves that don't rescue the King
-            
             valid_moves.append(pos)
         
         return valid_moves    
 
 
 class Pawn(AbstractPiece):
+    __slots__ = ()
+    
     def get_valid_moves(self, game, testing_check=False):
         moves = []
         
@@ -186,10 +295,12 @@ class Pawn(AbstractPiece):
         if not game.get_piece_at(forward_one):
             moves.append(forward_one)
         
-        # Can move two squares forward from the starting position
+        # Can move two squares forward from the starting position, as long as
+        # it isn't jumping over a piece
         if ((self.color == WHITE and self.pos[1] == 1) or
             (self.color == BLACK and self.pos[1] == 6)):
-            if not game.get_piece_at(forward_two):
+            if (not game.get_piece_at(forward_one) and
+                not game.get_piece_at(forward_two)):
                 moves.append(forward_two)
         
         # Can take diagonally forward
@@ -205,35 +316,42 @@ class Pawn(AbstractPiece):
         moves = self.remove_invalid_moves(game, moves)
         
         return moves
+    
+    def get_attacked_squares(self, game):
+        # Pawns only take diagonally forward, and attack those squares
+        # whether or not there's anything to take there
+        forward = 1 if self.color == WHITE else -1
+        squares = [(self.pos[0] - 1, self.pos[1] + forward),
+                   (self.pos[0] + 1, self.pos[1] + forward)]
+        return [pos for pos in squares if 0 <= pos[0] <= 7]
 
 
 class Knight(AbstractPiece):
+    __slots__ = ()
+    
     def get_valid_moves(self, game, testing_check=False):
+        # Targets are already on the board; just skip our own pieces
         moves = []
-        
-        # [ ][7][ ][0][ ]
-        # [6][ ][ ][ ][1]
-        # [ ][ ][N][ ][ ]
-        # [5][ ][ ][ ][2]
-        # [ ][4][ ][3][ ]
-        offsets = [(1, 2), (2, 1), (2, -1), (1, -2),
-                   (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
-        for offset in offsets:
-            moves.append((self.pos[0] + offset[0], self.pos[1] + offset[1]))
-
-        # Remove obviously invalid moves
-        moves = self.remove_invalid_moves(game, moves)
+        for pos in KNIGHT_TARGETS[self.pos[0] + self.pos[1] * 8]:
+            taken_piece = game.get_piece_at(pos)
+            if not taken_piece or taken_piece.color != self.color:
+                moves.append(pos)
         return moves
+    
+    def get_attacked_squares(self, game):
+        return KNIGHT_TARGETS[self.pos[0] + self.pos[1] * 8]
         
 
 class King(AbstractPiece):
+    __slots__ = ()
+    
     def get_valid_moves(self, game, testing_check=False):
+        # Targets are already on the board; just skip our own pieces
         moves = []
-        # Clockwise, starting with one square up
-        offsets = [UP, UP_RIGHT, RIGHT, DOWN_RIGHT,
-                   DOWN, DOWN_LEFT, LEFT, UP_LEFT]
-        for offset in offsets:
-            moves.append((self.pos[0] + offset[0], self.pos[1] + offset[1]))
+        for pos in KING_TARGETS[self.pos[0] + self.pos[1] * 8]:
+            taken_piece = game.get_piece_at(pos)
+            if not taken_piece or taken_piece.color != self.color:
+                moves.append(pos)
         
         # Castling - just handle the King move; the rook move will be done
         # by the game.
@@ -249,19 +367,23 @@ class King(AbstractPiece):
                 continue
             
             # Can't castle out of check
-            if game.in_check(self.color):
+            attack_map = game.get_attack_map(not self.color)
+            if attack_map[self.pos[0] + y_pos * 8]:
                 continue
             
             # Neither the rook nor the king can have moved
             if self.has_moved or rook.has_moved:
                 continue
             
-            # Squares between the king and rook must be vacant
+            # Squares between the king and rook must be vacant. The King
+            # only crosses the two squares next to it.
             squares_between = []
             if rook.pos[0] < self.pos[0]:  # Queen side
                 squares_between = [(1, y_pos), (2, y_pos), (3, y_pos)]
+                squares_crossed = [(2, y_pos), (3, y_pos)]
             else:  # King side
                 squares_between = [(5, y_pos), (6, y_pos)]
+                squares_crossed = squares_between
             all_squares_vacant = True
             for square in squares_between:
                 if game.get_piece_at(square):
@@ -269,12 +391,12 @@ class King(AbstractPiece):
             if not all_squares_vacant:
                 continue
             
-            # None of the squares in between can put the King in check
+            # None of the squares crossed can put the King in check. The King
+            # doesn't block any attacks on them that wouldn't already have
+            # put it in check.
             crosses_check = False
-            for square in squares_between:
-                test_game = copy.deepcopy(game)
-                test_game.move_piece_to(self, square)
-                if test_game.in_check(self.color):
+            for square in squares_crossed:
+                if attack_map[square[0] + square[1] * 8]:
                     crosses_check = True
                     break
             if crosses_check:
@@ -286,12 +408,15 @@ class King(AbstractPiece):
             else:
                 moves.append((6, self.pos[1]))
         
-        # Remove obviously invalid moves
-        moves = self.remove_invalid_moves(game, moves)
         return moves
+    
+    def get_attacked_squares(self, game):
+        return KING_TARGETS[self.pos[0] + self.pos[1] * 8]
 
 
 class Queen(AbstractPiece):
+    __slots__ = ()
+    
     def get_valid_moves(self, game, testing_check=False):
         moves = []
         
@@ -304,11 +429,18 @@ class Queen(AbstractPiece):
         for direction in directions:
             moves.extend(self.get_moves_in_direction(game, direction))
         
-        moves = self.remove_invalid_moves(game, moves)    
         return moves
+    
+    def get_attacked_squares(self, game):
+        squares = []
+        for direction in ALL_DIRECTIONS:
+            squares.extend(self.get_attacks_in_direction(game, direction))
+        return squares
 
 
 class Bishop(AbstractPiece):
+    __slots__ = ()
+    
     def get_valid_moves(self, game, testing_check=False):
         moves = []
         
@@ -320,11 +452,18 @@ class Bishop(AbstractPiece):
         for direction in directions:
             moves.extend(self.get_moves_in_direction(game, direction))
 
-        moves = self.remove_invalid_moves(game, moves)
         return moves
+    
+    def get_attacked_squares(self, game):
+        squares = []
+        for direction in DIAGONAL_DIRECTIONS:
+            squares.extend(self.get_attacks_in_direction(game, direction))
+        return squares
 
 
 class Rook(AbstractPiece):
+    __slots__ = ()
+    
     def get_valid_moves(self, game, testing_check=False):
         moves = []
         
@@ -336,8 +475,13 @@ class Rook(AbstractPiece):
         for direction in directions:
             moves.extend(self.get_moves_in_direction(game, direction))
 
-        moves = self.remove_invalid_moves(game, moves)
         return moves
+    
+    def get_attacked_squares(self, game):
+        squares = []
+        for direction in STRAIGHT_DIRECTIONS:
+            squares.extend(self.get_attacks_in_direction(game, direction))
+        return squares
 
 
 # Characters to represent pieces
@@ -362,6 +506,19 @@ PIECE_NAMES = {King: "king",
                Knight: "knight",
                Pawn: "pawn"}
 
+# Letters used for pieces in FEN and move strings; upper case is white
+PIECE_LETTERS = {King: "k",
+                 Queen: "q",
+                 Rook: "r",
+                 Bishop: "b",
+                 Knight: "n",
+                 Pawn: "p"}
+PIECE_CLASSES_FOR_LETTERS = dict((letter, piece_class) for piece_class, letter
+                                 in PIECE_LETTERS.items())
+
+# What else pawns can promote to (Queen is the default)
+UNDERPROMOTIONS = [Knight, Bishop, Rook]
+
 # Values for AI
 PIECE_VALUES = {King: 9999,
                 Queen: 9,
@@ -370,74 +527,665 @@ PIECE_VALUES = {King: 9999,
                 Knight: 3,
                 Pawn: 1}
 
+# Search scores, in hundredths of a pawn
+MATE_SCORE = 100000
+
+# The search looks at the clock (and for a stop request) when the node count
+# has none of these bits set. Nodes take a fraction of a millisecond each, so
+# it stops within about ten milliseconds of being told to.
+SEARCH_CHECK_INTERVAL = 31
+
+# While root moves are being searched in other processes, how often (in
+# seconds) the search looks at the clock and for a stop request
+SEARCH_POLL_INTERVAL = 0.01
+
+# Piece kinds, used to index bitboards and hash keys
+PAWN_KIND, KNIGHT_KIND, BISHOP_KIND, ROOK_KIND, QUEEN_KIND, KING_KIND = range(6)
+KIND_CLASSES = [Pawn, Knight, Bishop, Rook, Queen, King]
+KINDS = dict((piece_class, kind) for kind, piece_class in
+             enumerate(KIND_CLASSES))
+UNDERPROMOTION_KINDS = [KINDS[piece_class] for piece_class in UNDERPROMOTIONS]
+
+# Position tuple for each square number (x + y * 8)
+POS_FOR_SQUARE = [(square % 8, square // 8) for square in range(64)]
+
+# Moves can be packed into 16 bits for storing: the from square in bits 0-5,
+# the to square in bits 6-11 and the promotion in bits 12-13, where 0 means
+# the default (a Queen, or no promotion at all). Bits 14-15 are free for
+# flags, and ignored when unpacking.
+MOVE_SQUARE_MASK = 0x3f
+MOVE_TO_SHIFT = 6
+MOVE_PROMOTION_SHIFT = 12
+MOVE_PROMOTION_MASK = 0x3
+MOVE_PROMOTIONS = [None] + UNDERPROMOTIONS
+MOVE_PROMOTION_CODES = dict((piece_class, code) for code, piece_class in
+                            enumerate(MOVE_PROMOTIONS) if piece_class)
+
+# Castling rights, as bits of a mask
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+
+# Zobrist hash keys. They come from a fixed seed so a position always gets
+# the same key, whichever backend it's in and whichever run made it.
+_zobrist_random = random.Random(20160911)
+ZOBRIST_PIECES = dict((color, [[_zobrist_random.getrandbits(64)
+                                for square in range(64)]
+                               for kind in range(6)])
+                      for color in (WHITE, BLACK))
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for rights in range(16)]
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for x in range(8)]
+del _zobrist_random
+
+# Bonuses for where each kind of piece stands, in hundredths of a pawn, from
+# White's side of the board: the top row is the eighth rank
+PIECE_SQUARE_BONUSES = [
+    # Pawns: push on, keep the centre, don't leave the King's side open
+    [  0,   0,   0,   0,   0,   0,   0,   0,
+      50,  50,  50,  50,  50,  50,  50,  50,
+      10,  10,  20,  30,  30,  20,  10,  10,
+       5,   5,  10,  25,  25,  10,   5,   5,
+       0,   0,   0,  20,  20,   0,   0,   0,
+       5,  -5, -10,   0,   0, -10,  -5,   5,
+       5,  10,  10, -20, -20,  10,  10,   5,
+       0,   0,   0,   0,   0,   0,   0,   0],
+    # Knights: central, not on the rim
+    [-50, -40, -30, -30, -30, -30, -40, -50,
+     -40, -20,   0,   0,   0,   0, -20, -40,
+     -30,   0,  10,  15,  15,  10,   0, -30,
+     -30,   5,  15,  20,  20,  15,   5, -30,
+     -30,   0,  15,  20,  20,  15,   0, -30,
+     -30,   5,  10,  15,  15,  10,   5, -30,
+     -40, -20,   0,   5,   5,   0, -20, -40,
+     -50, -40, -30, -30, -30, -30, -40, -50],
+    # Bishops: off the back rank, on long diagonals
+    [-20, -10, -10, -10, -10, -10, -10, -20,
+     -10,   0,   0,   0,   0,   0,   0, -10,
+     -10,   0,   5,  10,  10,   5,   0, -10,
+     -10,   5,   5,  10,  10,   5,   5, -10,
+     -10,   0,  10,  10,  10,  10,   0, -10,
+     -10,  10,  10,  10,  10,  10,  10, -10,
+     -10,   5,   0,   0,   0,   0,   5, -10,
+     -20, -10, -10, -10, -10, -10, -10, -20],
+    # Rooks: on the seventh rank, or central on the first
+    [  0,   0,   0,   0,   0,   0,   0,   0,
+       5,  10,  10,  10,  10,  10,  10,   5,
+      -5,   0,   0,   0,   0,   0,   0,  -5,
+      -5,   0,   0,   0,   0,   0,   0,  -5,
+      -5,   0,   0,   0,   0,   0,   0,  -5,
+      -5,   0,   0,   0,   0,   0,   0,  -5,
+      -5,   0,   0,   0,   0,   0,   0,  -5,
+       0,   0,   0,   5,   5,   0,   0,   0],
+    # Queens: a little towards the centre
+    [-20, -10, -10,  -5,  -5, -10, -10, -20,
+     -10,   0,   0,   0,   0,   0,   0, -10,
+     -10,   0,   5,   5,   5,   5,   0, -10,
+      -5,   0,   5,   5,   5,   5,   0,  -5,
+       0,   0,   5,   5,   5,   5,   0,  -5,
+     -10,   5,   5,   5,   5,   5,   0, -10,
+     -10,   0,   5,   0,   0,   0,   0, -10,
+     -20, -10, -10,  -5,  -5, -10, -10, -20],
+    # Kings: tucked away behind the pawns
+    [-30, -40, -40, -50, -50, -40, -40, -30,
+     -30, -40, -40, -50, -50, -40, -40, -30,
+     -30, -40, -40, -50, -50, -40, -40, -30,
+     -30, -40, -40, -50, -50, -40, -40, -30,
+     -20, -30, -30, -40, -40, -30, -30, -20,
+     -10, -20, -20, -20, -20, -20, -20, -10,
+      20,  20,   0,   0,   0,   0,  20,  20,
+      20,  30,  10,   0,   0,  10,  30,  20]]
+
+def _build_piece_square_scores():
+    """Score for a piece of each colour and kind on each square: its value
+    (nothing for Kings) plus its PIECE_SQUARE_BONUSES entry, with the board
+    turned round for Black.
+    
+    """
+    scores = {}
+    for color in (WHITE, BLACK):
+        scores[color] = []
+        for kind, piece_class in enumerate(KIND_CLASSES):
+            value = 0 if piece_class == King else PIECE_VALUES[piece_class]
+            table = []
+            for square in range(64):
+                x, y = square % 8, square // 8
+                row = 7 - y if color == WHITE else y
+                table.append(value * 100 +
+                             PIECE_SQUARE_BONUSES[kind][x + row * 8])
+            scores[color].append(table)
+    return scores
+
+# Material and piece-square score for each colour, kind and square, kept as
+# running totals by the games and used by the search engine's evaluation
+PIECE_SQUARE_SCORES = _build_piece_square_scores()
+
 
 class EndGame(Exception):
     """Raised when the game ends. Message is human-readable and presented
-    to the player.
+    to the player; winner is the colour that won, or None for a draw.
     
     """
-    pass
+    def __init__(self, message, winner=None):
+        Exception.__init__(self, message)
+        self.winner = winner
+
+
+class UndoRecord(object):
+    """The state needed to take back a move. Returned by Game.move_piece_to
+    and Game.make_move.
+    
+    """
+    def __init__(self, game, piece):
+        # The moved piece and the state it was in beforehand
+        self.piece = piece
+        self.from_pos = piece.pos
+        self.had_moved = piece.has_moved
+        
+        # Game state before the move
+        self.en_passant_pos = game.en_passant_pos
+        self.idle_move_count = game.idle_move_count
+        self.last_moved_piece = game.last_moved_piece
+        self.color_to_move = game.color_to_move
+        self.zobrist_key = game.zobrist_key
+        
+        # Filled in by move_piece_to as the move is made
+        self.taken_piece = None
+        self.taken_indexes = None
+        self.promoted_piece = None
+        self.promoted_indexes = None
+        self.castled_rook = None
+        self.castled_rook_pos = None
+        self.rook_had_moved = False
+
+
+# Move lists kept by each game's move cache
+MOVE_CACHE_SIZE = 2048
+
+
+class MoveCache(object):
+    """Bounded store of move lists keyed by position, evicting the least
+    recently used list when full.
+    
+    Moves are stored packed by encode_moves rather than with the pieces
+    themselves. Apart from saving memory, the same position can be reached
+    with different piece objects on its squares - after a promotion is taken
+    back and made again, for example.
+    
+    """
+    def __init__(self, max_size=MOVE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def get(self, key):
+        """The move list stored for the key, or None.
+        
+        """
+        moves = self._entries.pop(key, None)
+        if moves is None:
+            self.misses += 1
+            return None
+        # Re-insert to mark it as the most recently used
+        self._entries[key] = moves
+        self.hits += 1
+        return moves
+    
+    def put(self, key, moves):
+        """Store a move list, evicting old ones to stay within max_size.
+        
+        """
+        self._entries[key] = moves
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+
+
+# Game methods counted and timed by the profiler
+PROFILED_METHODS = ["get_piece_at", "get_valid_moves",
+                    "get_valid_moves_for_piece", "in_check", "is_piece_at_risk",
+                    "is_square_attacked", "has_legal_move", "move_piece_to",
+                    "make_move", "unmake_move"]
+# Set to 1 to print profiles, or to a path to write them there as JSON
+PROFILE_ENV_VAR = "CHESS_PROFILE"
+
+# Set to 1 to have the search engine check the games' running scores
+# against a full recount at every position it evaluates
+CHECK_EVALUATION_ENV_VAR = "CHESS_CHECK_EVALUATION"
+
+
+class Profiler(object):
+    """Counts and times calls to PROFILED_METHODS of the game classes.
+    
+    Nothing is measured until install() wraps the methods, so there's no cost
+    when profiling is off. Times include any profiled methods called from
+    inside, e.g. get_valid_moves includes its get_valid_moves_for_piece calls.
+    
+    Wrap each turn in start_turn() and end_turn() to get a summary per turn;
+    summary() covers everything since the profiler was made.
+    
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.turns = []
+        self._calls = collections.defaultdict(int)
+        self._times = collections.defaultdict(float)
+        self._originals = []
+        self._turn_start = None
+    
+    def install(self, game_classes=None):
+        """Wrap the profiled methods of the given game classes (by default
+        every backend).
+        
+        """
+        for game_class in game_classes or GAME_BACKENDS.values():
+            for name in PROFILED_METHODS:
+                method = game_class.__dict__.get(name)
+                if method is None:
+                    continue
+                self._originals.append((game_class, name, method))
+                setattr(game_class, name, self._wrap(name, method))
+    
+    def uninstall(self):
+        """Put the original methods back.
+        
+        """
+        for game_class, name, method in reversed(self._originals):
+            setattr(game_class, name, method)
+        self._originals = []
+    
+    def _wrap(self, name, method):
+        calls, times = self._calls, self._times
+        def profiled(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                calls[name] += 1
+                times[name] += time.time() - start
+        profiled.__name__ = method.__name__
+        profiled.__doc__ = method.__doc__
+        return profiled
+    
+    def start_turn(self):
+        self._turn_start = (time.time(), dict(self._calls), dict(self._times))
+    
+    def end_turn(self, **details):
+        """Record the calls made since start_turn(), along with any details
+        given (the move played, for example). Returns the turn's summary.
+        
+        """
+        start_time, start_calls, start_times = self._turn_start
+        turn = dict(details)
+        turn["time"] = time.time() - start_time
+        turn["methods"] = self._get_method_summary(start_calls, start_times)
+        self.turns.append(turn)
+        self._turn_start = None
+        return turn
+    
+    def summary(self):
+        """Totals for everything profiled so far, and each turn.
+        
+        """
+        return {"time": time.time() - self.start_time,
+                "methods": self._get_method_summary({}, {}),
+                "turns": self.turns}
+    
+    def _get_method_summary(self, start_calls, start_times):
+        methods = {}
+        for name, calls in self._calls.items():
+            calls -= start_calls.get(name, 0)
+            if calls:
+                methods[name] = {"calls": calls,
+                                 "time": (self._times[name] -
+                                          start_times.get(name, 0.0))}
+        return methods
+
+
+def get_profile_string(summary, limit=None):
+    """Profiled methods from a turn or game summary, slowest first, e.g.
+    "get_valid_moves 120 calls 12.3ms". With a limit, only that many are
+    shown, on one line.
+    
+    """
+    methods = sorted(summary["methods"].items(),
+                     key=lambda item: item[1]["time"], reverse=True)
+    strings = ["%s %i calls %.1fms" % (name, method["calls"],
+                                        method["time"] * 1000)
+               for name, method in methods[:limit]]
+    if limit:
+        return "%.1fms: %s" % (summary["time"] * 1000, ", ".join(strings))
+    return "\n".join(["Total time %.1fms" % (summary["time"] * 1000)] +
+                     strings)
 
 
 class Game(object):
     """Class representing the game state.
     
     Board layout is stored as a list of pieces - each piece knows its own
-    position. Other state information (who's turn etc.) is stored in
-    instance variables.
+    position. A square index and per-colour piece lists are kept in sync with
+    the piece list so lookups don't need to scan it. Other state information
+    (who's turn etc.) is stored in instance variables.
     
     """
-    def __init__(self):
-        """Set up initial state.
+    def __init__(self, empty=False):
+        """Set up initial state. If empty, leave the board empty; from_fen
+        uses this to place the pieces itself.
         
         """
+        # Zobrist hash of the position, kept up to date as pieces move
+        self.zobrist_key = 0
+        
+        # Each colour's PIECE_SQUARE_SCORES total, kept up to date the same
+        # way
+        self.scores = {WHITE: 0, BLACK: 0}
+        
         # List of all pieces in the game
         self._pieces = []
         
+        # Piece on each square, indexed by x + y * 8; None for empty squares
+        self._board = [None] * 64
+        
+        # Pieces of each colour, and each colour's King
+        self._pieces_by_color = {WHITE: [], BLACK: []}
+        self._kings = {}
+        
+        # Attack maps for the current position, by colour. Built on demand
+        # by get_attack_map and thrown away whenever a piece moves.
+        self._attack_maps = {}
+        
+        # Legal move lists for recently seen positions
+        self.move_cache = MoveCache()
+        
+        # Endgame tablebase for check_endgame and the players to use, if any
+        self.tablebase = None
+        
+        # Checks and pins against one side's King, and the zobrist key and
+        # colour they were found for. See _get_check_info.
+        self._check_info = None
+        self._check_info_key = None
+        
         # General state
-        self.color_to_move = WHITE
+        self._color_to_move = WHITE
         # Number of moves without a pawn move or a take
         self.idle_move_count = 0
+        # Starts at 1 and goes up after each of black's moves, as in FEN
+        self.fullmove_number = 1
         
         # Setup initial position. First, setup pawns:
-        for x in range(8):
-            self._pieces.append(Pawn(WHITE, (x, 1)))
-            self._pieces.append(Pawn(BLACK, (x, 6)))
-        
-        # Other pieces
-        officer_ranks = {WHITE: 0, BLACK: 7}
-        for color, rank in officer_ranks.items():
-            self._pieces.append(Rook(color, (0, rank)))
-            self._pieces.append(Knight(color, (1, rank)))
-            self._pieces.append(Bishop(color, (2, rank)))
-            self._pieces.append(Queen(color, (3, rank)))
-            self._pieces.append(King(color, (4, rank)))
-            self._pieces.append(Bishop(color, (5, rank)))
-            self._pieces.append(Knight(color, (6, rank)))
-            self._pieces.append(Rook(color, (7, rank)))
+        if not empty:
+            for x in range(8):
+                self._add_piece(Pawn(WHITE, (x, 1)))
+                self._add_piece(Pawn(BLACK, (x, 6)))
+            
+            # Other pieces
+            officer_ranks = {WHITE: 0, BLACK: 7}
+            for color, rank in officer_ranks.items():
+                self._add_piece(Rook(color, (0, rank)))
+                self._add_piece(Knight(color, (1, rank)))
+                self._add_piece(Bishop(color, (2, rank)))
+                self._add_piece(Queen(color, (3, rank)))
+                self._add_piece(King(color, (4, rank)))
+                self._add_piece(Bishop(color, (5, rank)))
+                self._add_piece(Knight(color, (6, rank)))
+                self._add_piece(Rook(color, (7, rank)))
         
         # Various state
         self.last_moved_piece = None
         self.en_passant_pos = None
+        self.zobrist_key ^= ZOBRIST_CASTLING[self.get_castling_rights()]
     
-    def get_piece_at(self, pos):
-        """The piece at the given position.
+    @classmethod
+    def from_fen(cls, fen):
+        """A game set up from a position in Forsyth-Edwards Notation.
+        
+        Castling rights are mapped onto the has_moved flags of the Kings and
+        Rooks; pawns count as having moved unless they're on their starting
+        rank. The halfmove clock and fullmove number are optional. Raises
+        ValueError if the FEN can't be parsed.
+        
+        """
+        fields = fen.split()
+        if not 4 <= len(fields) <= 6:
+            raise ValueError("FEN must have four to six fields: %r" % fen)
+        placement, side, castling, en_passant = fields[:4]
+        
+        game = cls(empty=True)
+        
+        # Pieces, rank by rank from the top
+        ranks = placement.split("/")
+        if len(ranks) != 8:
+            raise ValueError("FEN must have eight ranks: %r" % fen)
+        for y, rank in zip(reversed(range(8)), ranks):
+            x = 0
+            for char in rank:
+                if char.isdigit():
+                    x += int(char)
+                    continue
+                piece_class = PIECE_CLASSES_FOR_LETTERS.get(char.lower())
+                if not piece_class or x > 7:
+                    raise ValueError("Bad rank %r in FEN: %r" % (rank, fen))
+                color = WHITE if char.isupper() else BLACK
+                piece = piece_class(color, (x, y))
+                piece.has_moved = True
+                if piece_class == Pawn and y == (1 if color == WHITE else 6):
+                    piece.has_moved = False
+                game._add_piece(piece)
+                x += 1
+            if x != 8:
+                raise ValueError("Bad rank %r in FEN: %r" % (rank, fen))
+        if len(game._kings) != 2:
+            raise ValueError("FEN must have one King each: %r" % fen)
+        
+        # Side to move
+        if side not in ("w", "b"):
+            raise ValueError("Bad side to move in FEN: %r" % fen)
+        game._color_to_move = WHITE if side == "w" else BLACK
+        
+        # Castling rights. Kings and Rooks that can still castle haven't moved.
+        for char in castling.replace("-", ""):
+            color = WHITE if char.isupper() else BLACK
+            rank = 0 if color == WHITE else 7
+            x = {"k": 7, "q": 0}.get(char.lower())
+            king = game.get_piece_at((4, rank))
+            rook = game.get_piece_at((x, rank)) if x is not None else None
+            if (not king or king.__class__ != King or king.color != color or
+                not rook or rook.__class__ != Rook or rook.color != color):
+                raise ValueError("Bad castling rights in FEN: %r" % fen)
+            king.has_moved = False
+            rook.has_moved = False
+        
+        # En passant square. It's behind a pawn of the side that just moved,
+        # which counts as the last moved piece.
+        if en_passant != "-":
+            if not GRID_REF.match(en_passant.upper()):
+                raise ValueError("Bad en passant square in FEN: %r" % fen)
+            game.en_passant_pos = get_coords_for_grid_ref(en_passant.upper())
+            x, y = game.en_passant_pos
+            pawn_y = 3 if y == 2 else 4
+            pawn = game.get_piece_at((x, pawn_y))
+            if (y != (5 if game.color_to_move == WHITE else 2) or
+                not pawn or pawn.__class__ != Pawn or
+                pawn.color == game.color_to_move):
+                raise ValueError("Bad en passant square in FEN: %r" % fen)
+            game.last_moved_piece = pawn
+        
+        # Halfmove clock (idle move count) and fullmove number
+        for index, attribute in (4, "idle_move_count"), (5, "fullmove_number"):
+            if len(fields) > index:
+                if not fields[index].isdigit():
+                    raise ValueError("Bad move count in FEN: %r" % fen)
+                setattr(game, attribute, int(fields[index]))
+        
+        game.zobrist_key = game.compute_zobrist_key()
+        return game
+    
+    def to_fen(self):
+        """The position in Forsyth-Edwards Notation.
+        
+        """
+        return get_fen(self)
+    
+    @property
+    def color_to_move(self):
+        """The colour of the player who moves next.
+        
+        """
+        return self._color_to_move
+    
+    @color_to_move.setter
+    def color_to_move(self, color):
+        if color != self._color_to_move:
+            self._color_to_move = color
+            self.zobrist_key ^= ZOBRIST_BLACK_TO_MOVE
+    
+    def get_castling_rights(self):
+        """Castling rights as a mask of WHITE_KING_SIDE etc. A side keeps the
+        right to castle while its King and that Rook haven't moved.
+        
+        """
+        rights = 0
+        for color, rank, king_side, queen_side in (
+                (WHITE, 0, WHITE_KING_SIDE, WHITE_QUEEN_SIDE),
+                (BLACK, 7, BLACK_KING_SIDE, BLACK_QUEEN_SIDE)):
+            king = self._kings.get(color)
+            if not king or king.has_moved or king.pos != (4, rank):
+                continue
+            for x, right in (7, king_side), (0, queen_side):
+                rook = self._board[x + rank * 8]
+                if (rook and rook.__class__ == Rook and rook.color == color and
+                    not rook.has_moved):
+                    rights |= right
+        return rights
+    
+    def compute_zobrist_key(self):
+        """The Zobrist key of the position, computed from scratch. The
+        zobrist_key attribute is updated as moves are made and should always
+        match this.
+        
+        """
+        key = ZOBRIST_CASTLING[self.get_castling_rights()]
+        for piece in self._pieces:
+            key ^= ZOBRIST_PIECES[piece.color][KINDS[piece.__class__]][
+                piece.pos[0] + piece.pos[1] * 8]
+        if self.color_to_move == BLACK:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        if self.en_passant_pos:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_pos[0]]
+        return key
+    
+    def compute_scores(self):
+        """Each colour's total of PIECE_SQUARE_SCORES, computed from scratch.
+        The scores attribute is updated as moves are made and should always
+        match this.
         
         """
+        scores = {WHITE: 0, BLACK: 0}
         for piece in self._pieces:
-            if piece.pos == pos:
-                return piece
+            scores[piece.color] += PIECE_SQUARE_SCORES[piece.color][
+                KINDS[piece.__class__]][piece.pos[0] + piece.pos[1] * 8]
+        return scores
+    
+    def get_piece_at(self, pos):
+        """The piece at the given position, or None if the square is empty or
+        off the board.
+        
+        """
+        x, y = pos
+        if 0 <= x <= 7 and 0 <= y <= 7:
+            return self._board[x + y * 8]
+        return None
+    
+    def _add_piece(self, piece, indexes=None):
+        """Put a piece on the board at its current position.
+        
+        Pass the indexes returned by _remove_piece to put a piece back
+        exactly where it was in the piece lists.
+        
+        """
+        if indexes is None:
+            self._pieces.append(piece)
+            self._pieces_by_color[piece.color].append(piece)
+        else:
+            self._pieces.insert(indexes[0], piece)
+            self._pieces_by_color[piece.color].insert(indexes[1], piece)
+        square = piece.pos[0] + piece.pos[1] * 8
+        self._board[square] = piece
+        kind = KINDS[piece.__class__]
+        self.zobrist_key ^= ZOBRIST_PIECES[piece.color][kind][square]
+        self.scores[piece.color] += PIECE_SQUARE_SCORES[piece.color][kind][
+            square]
+        if piece.__class__ == King:
+            self._kings[piece.color] = piece
+        if self._attack_maps:
+            self._attack_maps = {}
+    
+    def _remove_piece(self, piece):
+        """Take a piece off the board.
+        
+        Returns the piece's indexes in the piece lists, for undoing.
+        
+        """
+        color_pieces = self._pieces_by_color[piece.color]
+        indexes = (self._pieces.index(piece), color_pieces.index(piece))
+        del self._pieces[indexes[0]]
+        del color_pieces[indexes[1]]
+        square = piece.pos[0] + piece.pos[1] * 8
+        self._board[square] = None
+        kind = KINDS[piece.__class__]
+        self.zobrist_key ^= ZOBRIST_PIECES[piece.color][kind][square]
+        self.scores[piece.color] -= PIECE_SQUARE_SCORES[piece.color][kind][
+            square]
+        if self._attack_maps:
+            self._attack_maps = {}
+        return indexes
+    
+    def _place_piece(self, piece, pos):
+        """Move a piece that's on the board to an empty square.
+        
+        """
+        from_square = piece.pos[0] + piece.pos[1] * 8
+        to_square = pos[0] + pos[1] * 8
+        self._board[from_square] = None
+        self._board[to_square] = piece
+        piece.pos = pos
+        kind = KINDS[piece.__class__]
+        keys = ZOBRIST_PIECES[piece.color][kind]
+        self.zobrist_key ^= keys[from_square] ^ keys[to_square]
+        scores = PIECE_SQUARE_SCORES[piece.color][kind]
+        self.scores[piece.color] += scores[to_square] - scores[from_square]
+        if self._attack_maps:
+            self._attack_maps = {}
     
-    def move_piece_to(self, piece, pos):
+    def move_piece_to(self, piece, pos, promotion=Queen):
         """Update the piece's position, removing any existing piece.
         
         All piece moves should be made with this method, otherwise the game
-        state won't be updated properly.
+        state won't be updated properly. Pawns reaching the far rank are
+        replaced with a piece of the promotion class. Returns an UndoRecord
+        that can be passed to unmake_move to take the move back.
                 
         """
         # Make sure we're not dealing with a piece from another game:
         piece = self.get_piece_at(piece.pos)
         previous_piece = self.get_piece_at(pos)
+        undo = UndoRecord(self, piece)
+        
+        # Only Kings and Rooks moving or being taken affect castling rights
+        affects_castling = (piece.__class__ in (King, Rook) or
+                            previous_piece.__class__ == Rook)
+        if affects_castling:
+            castling_rights = self.get_castling_rights()
         
         # Check for taking
         if previous_piece:
@@ -450,19 +1198,21 @@ class Game(object):
                 raise RuntimeError("%s took %s!" % (piece, previous_piece))
             
             # Remove the piece
-            self._pieces.remove(previous_piece)
+            undo.taken_piece = previous_piece
+            undo.taken_indexes = self._remove_piece(previous_piece)
         
         # Move the piece
         old_pos = piece.pos
-        piece.pos = pos
+        self._place_piece(piece, pos)
 
         # Handle special cases. Pawns:
         if piece.__class__ == Pawn:
-            # Promotion. TODO: Handle promotion to other officers
+            # Promotion
             if (piece.color == WHITE and piece.pos[1] == 7 or
                 piece.color == BLACK and piece.pos[1] == 0):
-                self._pieces.remove(piece)
-                self._pieces.append(Queen(piece.color, piece.pos))
+                undo.promoted_indexes = self._remove_piece(piece)
+                undo.promoted_piece = promotion(piece.color, piece.pos)
+                self._add_piece(undo.promoted_piece)
 
             # En passant
             if piece.pos == self.en_passant_pos:
@@ -474,32 +1224,45 @@ class Game(object):
                     raise RuntimeError("Messed up en passant.")
                 if not taken_pawn:
                     raise RuntimeError("Messed up en passant again.")
-                self._pieces.remove(taken_pawn)
+                undo.taken_piece = taken_pawn
+                undo.taken_indexes = self._remove_piece(taken_pawn)
         
         # Castling
         if piece.__class__ == King:
             if old_pos[0] - pos[0] == 2:  # Queen side castling
                 queen_rook = self.get_piece_at((0, pos[1]))
-                queen_rook.pos = (3, pos[1])
+                undo.castled_rook = queen_rook
+                undo.castled_rook_pos = queen_rook.pos
+                undo.rook_had_moved = queen_rook.has_moved
+                self._place_piece(queen_rook, (3, pos[1]))
                 queen_rook.has_moved = True
             if old_pos[0] - pos[0] == -2:  # King side castling
                 king_rook = self.get_piece_at((7, pos[1]))
-                king_rook.pos = (5, pos[1])
+                undo.castled_rook = king_rook
+                undo.castled_rook_pos = king_rook.pos
+                undo.rook_had_moved = king_rook.has_moved
+                self._place_piece(king_rook, (5, pos[1]))
                 king_rook.has_moved = True
         
         # Update en passant status
+        if self.en_passant_pos:
+            self.zobrist_key ^= ZOBRIST_EN_PASSANT[self.en_passant_pos[0]]
         if (piece.__class__ == Pawn and piece.pos[1] in [3, 4] and
             not piece.has_moved):
             if piece.pos[1] == 3:
                 self.en_passant_pos = ((piece.pos[0], 2))
             else:
                 self.en_passant_pos = ((piece.pos[0], 5))
+            self.zobrist_key ^= ZOBRIST_EN_PASSANT[piece.pos[0]]
         else:
             self.en_passant_pos = None
         
         # Update game state for castling etc.
         piece.has_moved = True
         self.last_moved_piece = piece
+        if affects_castling:
+            self.zobrist_key ^= (ZOBRIST_CASTLING[castling_rights] ^
+                                 ZOBRIST_CASTLING[self.get_castling_rights()])
                 
         # Alter idle move count - reset if it's a take or a pawn move
         if piece.__class__ == Pawn or previous_piece:
@@ -507,33 +1270,195 @@ class Game(object):
         else:
             self.idle_move_count += 1
         
+        return undo
+    
+    def make_move(self, move):
+        """Make a move and pass the turn to the other player.
+        
+        Moves are (piece, pos) tuples, or (piece, pos, promotion class) for
+        pawns promoting to something other than a Queen. Returns an
+        UndoRecord; pass it to unmake_move to restore the game to exactly the
+        state it was in before the move.
+        
+        """
+        undo = self.move_piece_to(*move)
+        if self.color_to_move == BLACK:
+            self.fullmove_number += 1
+        self.color_to_move = not self.color_to_move
+        return undo
+    
+    def unmake_move(self, undo):
+        """Take back a move made with make_move or move_piece_to.
+        
+        Moves must be taken back in the reverse order they were made.
+        
+        """
+        piece = undo.piece
+        if undo.color_to_move == BLACK and self.color_to_move == WHITE:
+            self.fullmove_number -= 1
+        
+        # Swap a promoted piece back for the pawn
+        if undo.promoted_piece:
+            self._remove_piece(undo.promoted_piece)
+            self._add_piece(piece, undo.promoted_indexes)
+        
+        # Put the rook back after castling
+        if undo.castled_rook:
+            self._place_piece(undo.castled_rook, undo.castled_rook_pos)
+            undo.castled_rook.has_moved = undo.rook_had_moved
+        
+        # Move the piece back and restore anything it took
+        self._place_piece(piece, undo.from_pos)
+        if undo.taken_piece:
+            self._add_piece(undo.taken_piece, undo.taken_indexes)
+        
+        # Restore the rest of the game state
+        piece.has_moved = undo.had_moved
+        self.en_passant_pos = undo.en_passant_pos
+        self.idle_move_count = undo.idle_move_count
+        self.last_moved_piece = undo.last_moved_piece
+        self._color_to_move = undo.color_to_move
+        self.zobrist_key = undo.zobrist_key
+        
     def check_endgame(self):
         """Raises EndGame if the previous move ended the game.
         
         """
         # See if that's the end of the game
-        if not self.get_valid_moves(self.color_to_move):
+        if not self.has_legal_move(self.color_to_move):
             # In check? That's checkmate
             if self.in_check():
+                winner = not self.color_to_move
                 raise EndGame("Checkmate! %s wins" %
-                              COLOR_NAMES[not self.color_to_move].title())
+                              COLOR_NAMES[winner].title(), winner)
             else:
                 raise EndGame("Stalemate!")
         
         if self.idle_move_count >= 50:
             raise EndGame("Draw (fifty idle moves)")
+        
+        if self.tablebase:
+            check_tablebase_endgame(self)
     
-    def is_piece_at_risk(self, piece):
-        """True if the piece can be taken, otherwise False.
+    def is_square_attacked(self, pos, by_color):
+        """True if a piece of the given colour could take on the square.
+        
+        Uses the attack map for the current position if one has been built,
+        otherwise looks outward from the square for pieces that could reach
+        it.
+        
+        """
+        attack_map = self._attack_maps.get(by_color)
+        if attack_map is not None:
+            return attack_map[pos[0] + pos[1] * 8]
+        return self._is_square_attacked(pos, by_color)
+    
+    def _is_square_attacked(self, pos, by_color):
+        """is_square_attacked without the attack map, so it can be used
+        while pieces are temporarily off the board index.
         
         """
-        their_moves = self.get_valid_moves(not piece.color, testing_check=True)
-        for move in their_moves:
-            if self.get_piece_at(move[1]) == piece:
-                # They have a move that could potentially take the piece
-                # on the next turn
+        x, y = pos
+        square = x + y * 8
+        board = self._board
+        
+        # Knights and Kings
+        for targets, piece_class in ((KNIGHT_TARGETS, Knight),
+                                     (KING_TARGETS, King)):
+            for test_x, test_y in targets[square]:
+                piece = board[test_x + test_y * 8]
+                if (piece and piece.color == by_color and
+                    piece.__class__ == piece_class):
+                    return True
+        
+        # Pawns take diagonally forward, so look diagonally backward
+        pawn_y = y - 1 if by_color == WHITE else y + 1
+        for pawn_x in x - 1, x + 1:
+            piece = self.get_piece_at((pawn_x, pawn_y))
+            if piece and piece.color == by_color and piece.__class__ == Pawn:
                 return True
+        
+        # Sliding pieces - only the first piece along each ray matters
+        for directions, piece_classes in ((STRAIGHT_DIRECTIONS, (Rook, Queen)),
+                                          (DIAGONAL_DIRECTIONS,
+                                           (Bishop, Queen))):
+            for direction in directions:
+                for test_x, test_y in RAY_SQUARES[direction][square]:
+                    piece = board[test_x + test_y * 8]
+                    if piece:
+                        if (piece.color == by_color and
+                            piece.__class__ in piece_classes):
+                            return True
+                        break
+        
         return False
+    
+    def get_attack_map(self, color):
+        """Squares the given colour attacks in the current position, including
+        those its own pieces are on, as _is_square_attacked answers.
+        
+        Returns a list of 64 booleans indexed by x + y * 8. The map is built
+        once per position; until the next move, is_square_attacked,
+        is_piece_at_risk and in_check use it instead of searching the board.
+        
+        """
+        attack_map = self._attack_maps.get(color)
+        if attack_map is None:
+            attack_map = [False] * 64
+            for piece in self._pieces_by_color[color]:
+                for pos in piece.get_attacked_squares(self):
+                    attack_map[pos[0] + pos[1] * 8] = True
+            self._attack_maps[color] = attack_map
+        return attack_map
+    
+    def is_piece_at_risk(self, piece):
+        """True if the piece can be taken, otherwise False.
+        
+        """
+        return self.is_square_attacked(piece.pos, not piece.color)
+    
+    def get_attackers(self, pos, color, removed=()):
+        """Pieces of the given colour that could take on the square, looking
+        through the pieces on the positions in removed as if they'd gone.
+        Used for static exchange evaluation.
+        
+        """
+        x, y = pos
+        square = x + y * 8
+        board = self._board
+        attackers = []
+        
+        # Knights and Kings
+        for targets, piece_class in ((KNIGHT_TARGETS, Knight),
+                                     (KING_TARGETS, King)):
+            for test_x, test_y in targets[square]:
+                piece = board[test_x + test_y * 8]
+                if (piece and piece.color == color and
+                    piece.__class__ == piece_class and
+                    piece.pos not in removed):
+                    attackers.append(piece)
+        
+        # Pawns take diagonally forward, so look diagonally backward
+        pawn_y = y - 1 if color == WHITE else y + 1
+        for pawn_x in x - 1, x + 1:
+            piece = self.get_piece_at((pawn_x, pawn_y))
+            if (piece and piece.color == color and piece.__class__ == Pawn
+                and piece.pos not in removed):
+                attackers.append(piece)
+        
+        # Sliding pieces - the first piece along each ray that's still there
+        for directions, piece_classes in ((STRAIGHT_DIRECTIONS, (Rook, Queen)),
+                                          (DIAGONAL_DIRECTIONS,
+                                           (Bishop, Queen))):
+            for direction in directions:
+                for test_x, test_y in RAY_SQUARES[direction][square]:
+                    piece = board[test_x + test_y * 8]
+                    if piece and piece.pos not in removed:
+                        if (piece.color == color and
+                            piece.__class__ in piece_classes):
+                            attackers.append(piece)
+                        break
+        return attackers
                 
     def in_check(self, color=None):
         """If the current player's King is under threat.
@@ -541,15 +1466,8 @@ class Game(object):
         """
         if color is None:
             color = self.color_to_move
-        
-        # See if any of the other player's moves could take the king
-        our_king = [piece for piece in self._pieces if
-                    piece.__class__ == King and piece.color == color][0]
-        if self.is_piece_at_risk(our_king):
-            return True
-        
-        # The king isn't under attack
-        return False
+        our_king = self._kings[color]
+        return self.is_square_attacked(our_king.pos, not color)
     
     def get_pieces(self, color=None):
         """Pieces with the given color, or all pieces.
@@ -557,128 +1475,4166 @@ class Game(object):
         """
         if color is None:
             return self._pieces
-        return [piece for piece in self._pieces if piece.color == color]
+        return self._pieces_by_color[color]
+    
+    def get_piece_count(self):
+        """Number of pieces on the board.
+        
+        """
+        return len(self._pieces)
+    
+    def get_bitboards(self, out):
+        """Write the bitboards of the position into out, a row of 12 in a
+        uint64 NumPy array: one per piece kind for White, then one per kind
+        for Black. Needs NumPy.
+        
+        """
+        out[:] = 0
+        for piece in self._pieces:
+            out[(0 if piece.color == WHITE else 6) +
+                KINDS[piece.__class__]] |= BATCH_SQUARE_BITS[
+                    piece.pos[0] + piece.pos[1] * 8]
+    
+    def to_planes(self, out=None):
+        """The position as an (PLANE_COUNT, 8, 8) NumPy array of planes; see
+        encode_positions. Written to out if given. Needs NumPy.
+        
+        """
+        return get_position_planes(self, out)
     
     def get_valid_moves_for_piece(self, piece, testing_check=False):
         """Get the moves the given piece can legally make.
         
         """
-        moves = []
+        square = piece.pos[0] + piece.pos[1] * 8
+        if self._board[square] is not piece:
+            # Not on the board, so there's no position to cache it under
+            return self._generate_moves_for_piece(piece, testing_check)
+        # If the moves for the whole side are cached, pick this piece's out
+        all_key = (self.zobrist_key, piece.color, testing_check, None)
+        if all_key in self.move_cache:
+            return decode_moves(self, [code for code in
+                                       self.move_cache.get(all_key)
+                                       if code & MOVE_SQUARE_MASK == square])
         
-        # Get every possible move
-        for pos in piece.get_valid_moves(self, testing_check=testing_check):
-            moves.append((piece, pos))
+        key = (self.zobrist_key, piece.color, testing_check, square)
+        cached_moves = self.move_cache.get(key)
+        if cached_moves is not None:
+            return decode_moves(self, cached_moves)
+        moves = self._generate_moves_for_piece(piece, testing_check)
+        self.move_cache.put(key, encode_moves(moves))
+        return moves
+    
+    def _generate_moves_for_piece(self, piece, testing_check):
+        """Uncached get_valid_moves_for_piece.
         
-        # If we're not worried about putting ourself in check, we're done.
-        if testing_check:
-            return moves
+        """
+        targets = piece.get_valid_moves(self, testing_check=testing_check)
         
-        # Filter out moves that would put the King in check
-        would_check = []
-        for move in moves:
-            test_game = copy.deepcopy(self)
-            test_game.move_piece_to(move[0], move[1])
-            if test_game.in_check(piece.color):
-                would_check.append(move)
+        # Filter out moves that would put the King in check, unless we're not
+        # worried about that
+        if not testing_check:
+            targets = self._remove_illegal_targets(piece, targets)
         
-        return [move for move in moves if not move in would_check]
+        # Pawns reaching the far rank can promote to any officer; Queen is
+        # the default.
+        moves = []
+        for pos in targets:
+            moves.append((piece, pos))
+            if piece.__class__ == Pawn and pos[1] in (0, 7):
+                for promotion in UNDERPROMOTIONS:
+                    moves.append((piece, pos, promotion))
+        return moves
     
-    def get_valid_moves(self, color, testing_check=False):
-        """All possible moves for the given color.
+    def _get_check_info(self, color):
+        """Find the pieces checking the given colour's King, and its pieces
+        that are pinned to it.
         
-        Returns a list of tuples, piece then move. Includes taking the King,
-        so check should be handled separately. Pass testing_check to allow moves
-        that would put the King at risk.
+        Returns (king, block_squares, pins). block_squares is None when not
+        in check; otherwise it's the set of positions a move other than a
+        King move must land on, to take a single checker or block it - empty
+        for double check. pins maps the square number of each pinned piece to
+        the set of positions it can move to without leaving the pin.
+        
+        Found once per position; the result is kept until the zobrist key
+        changes.
         
         """
-        moves = []
+        key = (self.zobrist_key, color)
+        if self._check_info_key == key:
+            return self._check_info
         
-        # Get every possible move
-        for piece in self.get_pieces(color):
-            moves.extend(self.get_valid_moves_for_piece(piece,
-                                                testing_check=testing_check))
-        return moves
+        king = self._kings.get(color)
+        block_squares = None
+        pins = {}
+        if king:
+            board = self._board
+            x, y = king.pos
+            square = x + y * 8
+            by_color = not color
+            checkers = []
+            
+            # Knights and pawns can only be dealt with by taking them
+            for pos in KNIGHT_TARGETS[square]:
+                piece = board[pos[0] + pos[1] * 8]
+                if (piece and piece.color == by_color and
+                    piece.__class__ == Knight):
+                    checkers.append([pos])
+            pawn_y = y + 1 if color == WHITE else y - 1
+            if 0 <= pawn_y <= 7:
+                for pawn_x in x - 1, x + 1:
+                    if 0 <= pawn_x <= 7:
+                        piece = board[pawn_x + pawn_y * 8]
+                        if (piece and piece.color == by_color and
+                            piece.__class__ == Pawn):
+                            checkers.append([(pawn_x, pawn_y)])
+            
+            # Look along each ray for a slider, with at most one of our
+            # pieces in the way
+            for directions, piece_classes in ((STRAIGHT_DIRECTIONS,
+                                               (Rook, Queen)),
+                                              (DIAGONAL_DIRECTIONS,
+                                               (Bishop, Queen))):
+                for direction in directions:
+                    ray = RAY_SQUARES[direction][square]
+                    pinned_square = None
+                    for index, pos in enumerate(ray):
+                        piece = board[pos[0] + pos[1] * 8]
+                        if not piece:
+                            continue
+                        if piece.color == color:
+                            if pinned_square is not None:
+                                break
+                            pinned_square = pos[0] + pos[1] * 8
+                            continue
+                        if piece.__class__ in piece_classes:
+                            if pinned_square is None:
+                                checkers.append(ray[:index + 1])
+                            else:
+                                pins[pinned_square] = set(ray[:index + 1])
+                        break
+            
+            if len(checkers) == 1:
+                block_squares = set(checkers[0])
+            elif checkers:
+                block_squares = set()
+        
+        self._check_info = (king, block_squares, pins)
+        self._check_info_key = key
+        return self._check_info
+    
+    def _remove_illegal_targets(self, piece, targets):
+        """Remove the positions the piece can't move to without leaving its
+        King in check.
+        
+        """
+        king, block_squares, pins = self._get_check_info(piece.color)
+        if not king:
+            return targets
+        board = self._board
+        square = piece.pos[0] + piece.pos[1] * 8
+        
+        # The King can go anywhere that isn't attacked. Take it off the
+        # board index while looking, so it doesn't shield the squares
+        # behind it from sliders.
+        if piece is king:
+            board[square] = None
+            legal_targets = [pos for pos in targets if
+                             not self._is_square_attacked(pos,
+                                                          not piece.color)]
+            board[square] = piece
+            return legal_targets
+        
+        pinned_to = pins.get(square)
+        legal_targets = []
+        for pos in targets:
+            if piece.__class__ == Pawn and pos == self.en_passant_pos:
+                # Taking en passant removes two pieces from the board, so
+                # it can uncover an attack that isn't a simple pin
+                if self._is_en_passant_legal(piece, pos):
+                    legal_targets.append(pos)
+                continue
+            if pinned_to is not None and pos not in pinned_to:
+                continue
+            if block_squares is not None and pos not in block_squares:
+                continue
+            legal_targets.append(pos)
+        return legal_targets
+    
+    def _is_en_passant_legal(self, pawn, pos):
+        """True if the pawn taking en passant on pos doesn't leave its King
+        in check. Tried out on the board index only.
+        
+        """
+        board = self._board
+        from_square = pawn.pos[0] + pawn.pos[1] * 8
+        taken_square = pos[0] + pawn.pos[1] * 8
+        to_square = pos[0] + pos[1] * 8
+        taken_pawn = board[taken_square]
+        board[from_square] = None
+        board[taken_square] = None
+        board[to_square] = pawn
+        legal = not self._is_square_attacked(self._kings[pawn.color].pos,
+                                             not pawn.color)
+        board[to_square] = None
+        board[taken_square] = taken_pawn
+        board[from_square] = pawn
+        return legal
+    
+    def get_valid_moves(self, color, testing_check=False):
+        """All possible moves for the given color.
+        
+        Returns a list of tuples, piece then move. Includes taking the King,
+        so check should be handled separately. Pass testing_check to allow moves
+        that would put the King at risk.
+        
+        """
+        key = (self.zobrist_key, color, testing_check, None)
+        cached_moves = self.move_cache.get(key)
+        if cached_moves is not None:
+            return decode_moves(self, cached_moves)
+        
+        # Get every possible move
+        moves = []
+        for piece in self.get_pieces(color):
+            moves.extend(self._generate_moves_for_piece(piece, testing_check))
+        self.move_cache.put(key, encode_moves(moves))
+        return moves
+    
+    def iter_legal_moves(self, color):
+        """Generate the legal moves for the given colour a piece at a time:
+        the King's first, then those of the pieces nearest it, which are the
+        likeliest to have a move when the King is in trouble. Moves for a
+        piece are only worked out once the ones before have been used.
+        
+        The game mustn't be changed while the moves are being generated.
+        
+        """
+        cached_moves = self.move_cache.get((self.zobrist_key, color, False,
+                                            None))
+        if cached_moves is not None:
+            for move in decode_moves(self, cached_moves):
+                yield move
+            return
+        king_x, king_y = self._kings[color].pos
+        for piece in sorted(self.get_pieces(color), key=lambda piece: max(
+                abs(piece.pos[0] - king_x), abs(piece.pos[1] - king_y))):
+            for move in self.get_valid_moves_for_piece(piece):
+                yield move
+    
+    def has_legal_move(self, color):
+        """True if the given colour can move, stopping at the first legal
+        move found.
+        
+        """
+        for move in self.iter_legal_moves(color):
+            return True
+        return False
+    
+    def perft(self, depth):
+        """Count the positions reached by every sequence of legal moves of
+        the given length. Used to check and time move generation.
+        
+        """
+        if depth == 0:
+            return 1
+        moves = self.get_valid_moves(self.color_to_move)
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for move in moves:
+            undo = self.make_move(move)
+            nodes += self.perft(depth - 1)
+            self.unmake_move(undo)
+        return nodes
+    
+    def divide(self, depth):
+        """Perft split by first move. Returns a list of (move, count) tuples.
+        
+        """
+        counts = []
+        for move in self.get_valid_moves(self.color_to_move):
+            undo = self.make_move(move)
+            counts.append((move, self.perft(depth - 1)))
+            self.unmake_move(undo)
+        return counts
+
+
+# Bitboards. Squares are numbered x + y * 8, so bit 0 is A1 and bit 63 is H8.
+def get_square_for_pos(pos):
+    """Square number (0-63) for a position tuple.
+    
+    """
+    return pos[0] + pos[1] * 8
+
+def iter_bits(bits):
+    """Square numbers of the set bits of a bitboard, lowest first.
+    
+    """
+    while bits:
+        low_bit = bits & -bits
+        yield low_bit.bit_length() - 1
+        bits ^= low_bit
+
+def _build_bitboard_table(position_table):
+    """Convert a table of positions for each square into bitboards.
+    
+    """
+    table = []
+    for positions in position_table:
+        bits = 0
+        for pos in positions:
+            bits |= 1 << get_square_for_pos(pos)
+        table.append(bits)
+    return table
+
+KNIGHT_ATTACKS = _build_bitboard_table(KNIGHT_TARGETS)
+KING_ATTACKS = _build_bitboard_table(KING_TARGETS)
+
+# Squares attacked by a pawn of the given colour on each square
+PAWN_ATTACKS = {
+    WHITE: _build_bitboard_table(_build_target_table([UP_LEFT, UP_RIGHT])),
+    BLACK: _build_bitboard_table(_build_target_table([DOWN_LEFT,
+                                                      DOWN_RIGHT]))}
+
+# Ray tables, paired with whether the square numbers increase along the ray
+# (so the nearest blocker is the lowest set bit rather than the highest)
+RAYS = dict((direction, _build_bitboard_table(RAY_SQUARES[direction]))
+            for direction in ALL_DIRECTIONS)
+DIAGONAL_RAYS = [(RAYS[direction], direction[0] + direction[1] * 8 > 0)
+                 for direction in DIAGONAL_DIRECTIONS]
+STRAIGHT_RAYS = [(RAYS[direction], direction[0] + direction[1] * 8 > 0)
+                 for direction in STRAIGHT_DIRECTIONS]
+
+# Castling rights kept when a piece moves from or to each square
+CASTLING_MASKS = [~0] * 64
+CASTLING_MASKS[4] = ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+CASTLING_MASKS[7] = ~WHITE_KING_SIDE
+CASTLING_MASKS[0] = ~WHITE_QUEEN_SIDE
+CASTLING_MASKS[60] = ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE)
+CASTLING_MASKS[63] = ~BLACK_KING_SIDE
+CASTLING_MASKS[56] = ~BLACK_QUEEN_SIDE
+
+
+def sliding_attacks(square, occupied, rays):
+    """Bitboard of the squares a slider on the given square attacks.
+    
+    Rays is DIAGONAL_RAYS or STRAIGHT_RAYS (or both for a queen). Each ray
+    stops at the first occupied square, which is included.
+    
+    """
+    attacks = 0
+    for table, increasing in rays:
+        ray = table[square]
+        blockers = ray & occupied
+        if blockers:
+            if increasing:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= table[blocker]
+        attacks |= ray
+    return attacks
+
+
+class BitboardGame(object):
+    """Game state stored as bitboards - one int per piece type and colour.
+    
+    Implements the same interface as Game, so the players and draw_game can
+    use either. Moves are generated on the bitboards; the piece objects handed
+    out by get_piece_at, get_pieces and the move lists are created on demand
+    and stay the same objects until the position changes.
+    
+    """
+    def __init__(self, game=None):
+        """Set up the initial position, or copy the position of a Game.
+        
+        """
+        if game is None:
+            game = Game()
+        
+        # Bitboards for each piece kind, by colour, and all pieces by colour
+        self._bitboards = {WHITE: [0] * 6, BLACK: [0] * 6}
+        self._occupied = {WHITE: 0, BLACK: 0}
+        
+        # (color, kind) of the piece on each square; None for empty squares
+        self._mailbox = [None] * 64
+        for piece in game.get_pieces():
+            square = get_square_for_pos(piece.pos)
+            kind = KINDS[piece.__class__]
+            self._bitboards[piece.color][kind] |= 1 << square
+            self._occupied[piece.color] |= 1 << square
+            self._mailbox[square] = (piece.color, kind)
+        
+        # Castling rights, as a mask of WHITE_KING_SIDE etc.
+        self._castling = game.get_castling_rights()
+        
+        # General state
+        self._color_to_move = game.color_to_move
+        self.idle_move_count = game.idle_move_count
+        self.fullmove_number = game.fullmove_number
+        self._en_passant_square = None
+        if game.en_passant_pos:
+            self._en_passant_square = get_square_for_pos(game.en_passant_pos)
+        self._last_moved_square = None
+        if game.last_moved_piece:
+            self._last_moved_square = get_square_for_pos(
+                game.last_moved_piece.pos)
+        self.zobrist_key = self.compute_zobrist_key()
+        self.scores = self.compute_scores()
+        
+        # Piece objects and attack maps for the current position
+        self._views = {}
+        self._attack_maps = {}
+        
+        # Legal move lists for recently seen positions
+        self.move_cache = MoveCache()
+        
+        # Endgame tablebase for check_endgame and the players to use, if any
+        self.tablebase = game.tablebase
+    
+    @property
+    def color_to_move(self):
+        """The colour of the player who moves next.
+        
+        """
+        return self._color_to_move
+    
+    @color_to_move.setter
+    def color_to_move(self, color):
+        if color != self._color_to_move:
+            self._color_to_move = color
+            self.zobrist_key ^= ZOBRIST_BLACK_TO_MOVE
+    
+    @property
+    def en_passant_pos(self):
+        """The square a pawn can be taken on en passant, or None.
+        
+        """
+        if self._en_passant_square is None:
+            return None
+        return POS_FOR_SQUARE[self._en_passant_square]
+    
+    def get_castling_rights(self):
+        """Castling rights as a mask of WHITE_KING_SIDE etc.
+        
+        """
+        return self._castling
+    
+    def compute_zobrist_key(self):
+        """The Zobrist key of the position, computed from scratch. The
+        zobrist_key attribute is updated as moves are made and should always
+        match this.
+        
+        """
+        key = ZOBRIST_CASTLING[self._castling]
+        for square, piece in enumerate(self._mailbox):
+            if piece:
+                key ^= ZOBRIST_PIECES[piece[0]][piece[1]][square]
+        if self.color_to_move == BLACK:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        if self._en_passant_square is not None:
+            key ^= ZOBRIST_EN_PASSANT[self._en_passant_square % 8]
+        return key
+    
+    def compute_scores(self):
+        """Each colour's total of PIECE_SQUARE_SCORES, computed from scratch.
+        The scores attribute is updated as moves are made and should always
+        match this.
+        
+        """
+        scores = {WHITE: 0, BLACK: 0}
+        for square, piece in enumerate(self._mailbox):
+            if piece:
+                scores[piece[0]] += PIECE_SQUARE_SCORES[piece[0]][piece[1]][
+                    square]
+        return scores
+    
+    @property
+    def last_moved_piece(self):
+        """The piece that made the last move, or None.
+        
+        """
+        if self._last_moved_square is None:
+            return None
+        return self._get_view(self._last_moved_square)
+    
+    def _get_view(self, square):
+        """The piece object for the piece on the given square.
+        
+        """
+        view = self._views.get(square)
+        if view is None:
+            color, kind = self._mailbox[square]
+            view = KIND_CLASSES[kind](color, POS_FOR_SQUARE[square])
+            self._views[square] = view
+        return view
+    
+    def get_piece_at(self, pos):
+        """The piece at the given position, or None if the square is empty or
+        off the board.
+        
+        """
+        x, y = pos
+        if 0 <= x <= 7 and 0 <= y <= 7 and self._mailbox[x + y * 8]:
+            return self._get_view(x + y * 8)
+        return None
+    
+    def get_pieces(self, color=None):
+        """Pieces with the given color, or all pieces.
+        
+        """
+        if color is None:
+            bits = self._occupied[WHITE] | self._occupied[BLACK]
+        else:
+            bits = self._occupied[color]
+        return [self._get_view(square) for square in iter_bits(bits)]
+    
+    def get_piece_count(self):
+        """Number of pieces on the board.
+        
+        """
+        return bin(self._occupied[WHITE] | self._occupied[BLACK]).count("1")
+    
+    def get_bitboards(self, out):
+        """Write the bitboards of the position into out, a row of 12 in a
+        uint64 NumPy array: one per piece kind for White, then one per kind
+        for Black. Needs NumPy.
+        
+        """
+        out[:6] = self._bitboards[WHITE]
+        out[6:] = self._bitboards[BLACK]
+    
+    def to_planes(self, out=None):
+        """The position as an (PLANE_COUNT, 8, 8) NumPy array of planes; see
+        encode_positions. Written to out if given. Needs NumPy.
+        
+        """
+        return get_position_planes(self, out)
+    
+    def is_square_attacked(self, pos, by_color):
+        """True if a piece of the given colour could take on the square.
+        
+        """
+        attack_map = self._attack_maps.get(by_color)
+        if attack_map is not None:
+            return attack_map[get_square_for_pos(pos)]
+        return self._is_square_attacked(get_square_for_pos(pos), by_color)
+    
+    def get_attack_map(self, color):
+        """Squares the given colour attacks in the current position, including
+        those its own pieces are on, as _is_square_attacked answers.
+        
+        Returns a list of 64 booleans indexed by x + y * 8, built once per
+        position.
+        
+        """
+        attack_map = self._attack_maps.get(color)
+        if attack_map is None:
+            bitboards = self._bitboards[color]
+            occupied = self._occupied[WHITE] | self._occupied[BLACK]
+            attacks = 0
+            for square in iter_bits(bitboards[PAWN_KIND]):
+                attacks |= PAWN_ATTACKS[color][square]
+            for square in iter_bits(bitboards[KNIGHT_KIND]):
+                attacks |= KNIGHT_ATTACKS[square]
+            for square in iter_bits(bitboards[KING_KIND]):
+                attacks |= KING_ATTACKS[square]
+            for kind, rays in ((BISHOP_KIND, DIAGONAL_RAYS),
+                               (ROOK_KIND, STRAIGHT_RAYS),
+                               (QUEEN_KIND, DIAGONAL_RAYS + STRAIGHT_RAYS)):
+                for square in iter_bits(bitboards[kind]):
+                    attacks |= sliding_attacks(square, occupied, rays)
+            attack_map = [bool(attacks >> square & 1) for square in range(64)]
+            self._attack_maps[color] = attack_map
+        return attack_map
+    
+    def _is_square_attacked(self, square, by_color, occupied=None):
+        """True if any piece of the given colour attacks the square number.
+        
+        Pass occupied to test against a different set of blocking pieces.
+        
+        """
+        bitboards = self._bitboards[by_color]
+        if occupied is None:
+            occupied = self._occupied[WHITE] | self._occupied[BLACK]
+        if KNIGHT_ATTACKS[square] & bitboards[KNIGHT_KIND]:
+            return True
+        if KING_ATTACKS[square] & bitboards[KING_KIND]:
+            return True
+        if PAWN_ATTACKS[not by_color][square] & bitboards[PAWN_KIND]:
+            return True
+        queens = bitboards[QUEEN_KIND]
+        diagonal_sliders = bitboards[BISHOP_KIND] | queens
+        if (diagonal_sliders and
+            sliding_attacks(square, occupied, DIAGONAL_RAYS) &
+            diagonal_sliders):
+            return True
+        straight_sliders = bitboards[ROOK_KIND] | queens
+        if (straight_sliders and
+            sliding_attacks(square, occupied, STRAIGHT_RAYS) &
+            straight_sliders):
+            return True
+        return False
+    
+    def in_check(self, color=None):
+        """If the current player's King is under threat.
+        
+        """
+        if color is None:
+            color = self.color_to_move
+        king_square = self._bitboards[color][KING_KIND].bit_length() - 1
+        return self._is_square_attacked(king_square, not color)
+    
+    def is_piece_at_risk(self, piece):
+        """True if the piece can be taken, otherwise False.
+        
+        """
+        return self.is_square_attacked(piece.pos, not piece.color)
+    
+    def get_attackers(self, pos, color, removed=()):
+        """Pieces of the given colour that could take on the square, looking
+        through the pieces on the positions in removed as if they'd gone.
+        Used for static exchange evaluation.
+        
+        """
+        square = get_square_for_pos(pos)
+        occupied = self._occupied[WHITE] | self._occupied[BLACK]
+        for removed_pos in removed:
+            occupied &= ~(1 << get_square_for_pos(removed_pos))
+        bitboards = self._bitboards[color]
+        attackers = (KNIGHT_ATTACKS[square] & bitboards[KNIGHT_KIND] |
+                     KING_ATTACKS[square] & bitboards[KING_KIND] |
+                     PAWN_ATTACKS[not color][square] & bitboards[PAWN_KIND])
+        queens = bitboards[QUEEN_KIND]
+        diagonal_sliders = (bitboards[BISHOP_KIND] | queens) & occupied
+        if diagonal_sliders:
+            attackers |= (sliding_attacks(square, occupied, DIAGONAL_RAYS) &
+                          diagonal_sliders)
+        straight_sliders = (bitboards[ROOK_KIND] | queens) & occupied
+        if straight_sliders:
+            attackers |= (sliding_attacks(square, occupied, STRAIGHT_RAYS) &
+                          straight_sliders)
+        return [self._get_view(attacker)
+                for attacker in iter_bits(attackers & occupied)]
+    
+    def _get_pseudo_moves(self, color, from_bits, castling=True):
+        """Moves for the pieces of the given colour on the squares in
+        from_bits, as (from square, to square) tuples, or (from square, to
+        square, kind) for underpromotions. Moves that leave the King in check
+        are included.
+        
+        """
+        moves = []
+        bitboards = self._bitboards[color]
+        ours = self._occupied[color]
+        theirs = self._occupied[not color]
+        occupied = ours | theirs
+        
+        # Pawns
+        if color == WHITE:
+            forward, start_rank = 8, 1
+        else:
+            forward, start_rank = -8, 6
+        en_passant_bits = 0
+        if self._en_passant_square is not None:
+            # Only the side that didn't just push can take en passant
+            if (self._en_passant_square // 8 == 2) != (color == WHITE):
+                en_passant_bits = 1 << self._en_passant_square
+        for square in iter_bits(bitboards[PAWN_KIND] & from_bits):
+            to = square + forward
+            targets = []
+            if not occupied & (1 << to):
+                targets.append(to)
+                if (square // 8 == start_rank and
+                    not occupied & (1 << (to + forward))):
+                    moves.append((square, to + forward))
+            takes = PAWN_ATTACKS[color][square] & (theirs | en_passant_bits)
+            targets.extend(iter_bits(takes))
+            for to in targets:
+                moves.append((square, to))
+                if to >= 56 or to < 8:
+                    for kind in UNDERPROMOTION_KINDS:
+                        moves.append((square, to, kind))
+        
+        # Knights and the King
+        for kind, table in (KNIGHT_KIND, KNIGHT_ATTACKS), (KING_KIND,
+                                                           KING_ATTACKS):
+            for square in iter_bits(bitboards[kind] & from_bits):
+                for to in iter_bits(table[square] & ~ours):
+                    moves.append((square, to))
+        
+        # Sliders
+        for kind, rays in ((BISHOP_KIND, DIAGONAL_RAYS),
+                           (ROOK_KIND, STRAIGHT_RAYS),
+                           (QUEEN_KIND, DIAGONAL_RAYS + STRAIGHT_RAYS)):
+            for square in iter_bits(bitboards[kind] & from_bits):
+                attacks = sliding_attacks(square, occupied, rays)
+                for to in iter_bits(attacks & ~ours):
+                    moves.append((square, to))
+        
+        # Castling
+        king = bitboards[KING_KIND] & from_bits
+        if castling and king:
+            moves.extend(self._get_castling_moves(color, occupied))
+        
+        return moves
+    
+    def _get_castling_moves(self, color, occupied):
+        """Castling moves for the given colour, as (from, to) tuples.
+        
+        """
+        if color == WHITE:
+            king_square = 4
+            sides = [(WHITE_KING_SIDE, [5, 6], [5, 6], 6),
+                     (WHITE_QUEEN_SIDE, [1, 2, 3], [3, 2], 2)]
+        else:
+            king_square = 60
+            sides = [(BLACK_KING_SIDE, [61, 62], [61, 62], 62),
+                     (BLACK_QUEEN_SIDE, [57, 58, 59], [59, 58], 58)]
+        moves = []
+        for right, squares_between, squares_crossed, to in sides:
+            if not self._castling & right:
+                continue
+            
+            # Squares between the king and rook must be vacant
+            if any(occupied & (1 << square) for square in squares_between):
+                continue
+            
+            # Can't castle out of check, or across a square in check
+            if self._is_square_attacked(king_square, not color):
+                continue
+            without_king = occupied ^ (1 << king_square)
+            if any(self._is_square_attacked(square, not color, without_king)
+                   for square in squares_crossed):
+                continue
+            moves.append((king_square, to))
+        return moves
+    
+    def _make(self, from_square, to, promotion=QUEEN_KIND):
+        """Make a move given as square numbers. Pawns reaching the far rank
+        become the promotion kind. Returns the undo tuple for _unmake.
+        
+        """
+        mailbox = self._mailbox
+        color, kind = mailbox[from_square]
+        bitboards = self._bitboards[color]
+        
+        # Take a piece, either on the target square or en passant
+        taken_square = to
+        if kind == PAWN_KIND and to == self._en_passant_square:
+            taken_square = to - 8 if color == WHITE else to + 8
+        taken = mailbox[taken_square]
+        scores = self.scores
+        undo = (from_square, to, kind, taken, taken_square, self._castling,
+                self._en_passant_square, self.idle_move_count,
+                self._last_moved_square, self.color_to_move,
+                self.zobrist_key, scores[WHITE], scores[BLACK], self._views,
+                self._attack_maps)
+        self._views = {}
+        self._attack_maps = {}
+        key = self.zobrist_key
+        if taken:
+            bit = 1 << taken_square
+            self._bitboards[not color][taken[1]] ^= bit
+            self._occupied[not color] ^= bit
+            mailbox[taken_square] = None
+            key ^= ZOBRIST_PIECES[not color][taken[1]][taken_square]
+            scores[not color] -= PIECE_SQUARE_SCORES[not color][taken[1]][
+                taken_square]
+        
+        # Move the piece, promoting pawns that reach the far rank
+        move_bits = (1 << from_square) | (1 << to)
+        self._occupied[color] ^= move_bits
+        mailbox[from_square] = None
+        keys = ZOBRIST_PIECES[color]
+        piece_scores = PIECE_SQUARE_SCORES[color]
+        if kind == PAWN_KIND and (to >= 56 or to < 8):
+            bitboards[PAWN_KIND] ^= 1 << from_square
+            bitboards[promotion] |= 1 << to
+            mailbox[to] = (color, promotion)
+            key ^= keys[PAWN_KIND][from_square] ^ keys[promotion][to]
+            scores[color] += (piece_scores[promotion][to] -
+                              piece_scores[PAWN_KIND][from_square])
+        else:
+            bitboards[kind] ^= move_bits
+            mailbox[to] = (color, kind)
+            key ^= keys[kind][from_square] ^ keys[kind][to]
+            scores[color] += (piece_scores[kind][to] -
+                              piece_scores[kind][from_square])
+        
+        # Castling - move the rook too
+        if kind == KING_KIND and abs(to - from_square) == 2:
+            if to > from_square:
+                rook_from, rook_to = to + 1, to - 1
+            else:
+                rook_from, rook_to = to - 2, to + 1
+            rook_bits = (1 << rook_from) | (1 << rook_to)
+            bitboards[ROOK_KIND] ^= rook_bits
+            self._occupied[color] ^= rook_bits
+            mailbox[rook_to] = mailbox[rook_from]
+            mailbox[rook_from] = None
+            key ^= keys[ROOK_KIND][rook_from] ^ keys[ROOK_KIND][rook_to]
+            scores[color] += (piece_scores[ROOK_KIND][rook_to] -
+                              piece_scores[ROOK_KIND][rook_from])
+        
+        # Update the rest of the state
+        key ^= ZOBRIST_CASTLING[self._castling]
+        self._castling &= CASTLING_MASKS[from_square] & CASTLING_MASKS[to]
+        key ^= ZOBRIST_CASTLING[self._castling]
+        if self._en_passant_square is not None:
+            key ^= ZOBRIST_EN_PASSANT[self._en_passant_square % 8]
+        if kind == PAWN_KIND and abs(to - from_square) == 16:
+            self._en_passant_square = (from_square + to) // 2
+            key ^= ZOBRIST_EN_PASSANT[to % 8]
+        else:
+            self._en_passant_square = None
+        self.zobrist_key = key
+        if kind == PAWN_KIND or taken:
+            self.idle_move_count = 0
+        else:
+            self.idle_move_count += 1
+        self._last_moved_square = to
+        
+        return undo
+    
+    def _unmake(self, undo):
+        """Take back a move made with _make.
+        
+        """
+        (from_square, to, kind, taken, taken_square, castling,
+         en_passant_square, idle_move_count, last_moved_square,
+         color_to_move, zobrist_key, white_score, black_score, self._views,
+         self._attack_maps) = undo
+        mailbox = self._mailbox
+        color = mailbox[to][0]
+        bitboards = self._bitboards[color]
+        
+        # Put back the rook after castling
+        if kind == KING_KIND and abs(to - from_square) == 2:
+            if to > from_square:
+                rook_from, rook_to = to + 1, to - 1
+            else:
+                rook_from, rook_to = to - 2, to + 1
+            rook_bits = (1 << rook_from) | (1 << rook_to)
+            bitboards[ROOK_KIND] ^= rook_bits
+            self._occupied[color] ^= rook_bits
+            mailbox[rook_from] = mailbox[rook_to]
+            mailbox[rook_to] = None
+        
+        # Move the piece back, undoing any promotion
+        move_bits = (1 << from_square) | (1 << to)
+        self._occupied[color] ^= move_bits
+        bitboards[mailbox[to][1]] ^= 1 << to
+        bitboards[kind] ^= 1 << from_square
+        mailbox[from_square] = (color, kind)
+        mailbox[to] = None
+        
+        # Put back anything that was taken
+        if taken:
+            bit = 1 << taken_square
+            self._bitboards[not color][taken[1]] |= bit
+            self._occupied[not color] |= bit
+            mailbox[taken_square] = taken
+        
+        self._castling = castling
+        self._en_passant_square = en_passant_square
+        self.idle_move_count = idle_move_count
+        self._last_moved_square = last_moved_square
+        self._color_to_move = color_to_move
+        self.zobrist_key = zobrist_key
+        self.scores[WHITE] = white_score
+        self.scores[BLACK] = black_score
+    
+    def _get_check_masks(self, color):
+        """Find the pieces checking the given colour's King, and its pieces
+        that are pinned to it.
+        
+        Returns (check_mask, pin_masks). check_mask is None when not in
+        check; otherwise it's a bitboard of the squares a move other than a
+        King move must land on, to take a single checker or block it - 0 for
+        double check. pin_masks maps the square of each pinned piece to a
+        bitboard of the squares it can move to without leaving the pin.
+        
+        """
+        king_square = self._bitboards[color][KING_KIND].bit_length() - 1
+        theirs = self._bitboards[not color]
+        ours = self._occupied[color]
+        occupied = ours | self._occupied[not color]
+        
+        # Knights and pawns can only be dealt with by taking them
+        check_mask = ((KNIGHT_ATTACKS[king_square] & theirs[KNIGHT_KIND]) |
+                      (PAWN_ATTACKS[color][king_square] & theirs[PAWN_KIND]))
+        checks = bin(check_mask).count("1")
+        
+        # Look along each ray for a slider, with at most one of our pieces in
+        # the way
+        pin_masks = {}
+        queens = theirs[QUEEN_KIND]
+        for directions, sliders in ((DIAGONAL_DIRECTIONS,
+                                     theirs[BISHOP_KIND] | queens),
+                                    (STRAIGHT_DIRECTIONS,
+                                     theirs[ROOK_KIND] | queens)):
+            for direction in directions:
+                table = RAYS[direction]
+                ray = table[king_square]
+                if not ray & sliders:
+                    continue
+                increasing = direction[0] + direction[1] * 8 > 0
+                blockers = ray & occupied
+                nearest = []
+                while blockers and len(nearest) < 2:
+                    if increasing:
+                        blocker = (blockers & -blockers).bit_length() - 1
+                    else:
+                        blocker = blockers.bit_length() - 1
+                    nearest.append(blocker)
+                    blockers ^= 1 << blocker
+                if sliders & (1 << nearest[0]):
+                    check_mask |= ray ^ table[nearest[0]]
+                    checks += 1
+                elif (ours & (1 << nearest[0]) and len(nearest) == 2 and
+                      sliders & (1 << nearest[1])):
+                    pin_masks[nearest[0]] = ray ^ table[nearest[1]]
+        
+        if not checks:
+            check_mask = None
+        elif checks > 1:
+            check_mask = 0
+        return check_mask, pin_masks
+    
+    def _is_en_passant_legal(self, from_square, to, color):
+        """True if the pawn on from_square taking en passant doesn't leave
+        the King in check. Taking removes two pieces from the board, so it
+        can uncover an attack that isn't a simple pin.
+        
+        """
+        king_square = self._bitboards[color][KING_KIND].bit_length() - 1
+        taken_square = to - 8 if color == WHITE else to + 8
+        occupied = ((self._occupied[WHITE] | self._occupied[BLACK]) ^
+                    (1 << from_square) ^ (1 << taken_square) | (1 << to))
+        theirs = self._bitboards[not color]
+        if KNIGHT_ATTACKS[king_square] & theirs[KNIGHT_KIND]:
+            return False
+        if (PAWN_ATTACKS[color][king_square] & theirs[PAWN_KIND] &
+            ~(1 << taken_square)):
+            return False
+        queens = theirs[QUEEN_KIND]
+        if (sliding_attacks(king_square, occupied, DIAGONAL_RAYS) &
+            (theirs[BISHOP_KIND] | queens)):
+            return False
+        if (sliding_attacks(king_square, occupied, STRAIGHT_RAYS) &
+            (theirs[ROOK_KIND] | queens)):
+            return False
+        return True
+    
+    def _remove_illegal_moves(self, color, moves):
+        """Remove the moves that leave the given colour's King in check.
+        
+        """
+        check_mask, pin_masks = self._get_check_masks(color)
+        king_square = self._bitboards[color][KING_KIND].bit_length() - 1
+        pawns = self._bitboards[color][PAWN_KIND]
+        en_passant_square = self._en_passant_square
+        
+        # The King can go anywhere that isn't attacked. Take it off the board
+        # while looking, so it doesn't shield the squares behind it from
+        # sliders.
+        without_king = ((self._occupied[WHITE] | self._occupied[BLACK]) ^
+                        (1 << king_square))
+        
+        legal_moves = []
+        for move in moves:
+            from_square, to = move[0], move[1]
+            if from_square == king_square:
+                if not self._is_square_attacked(to, not color, without_king):
+                    legal_moves.append(move)
+                continue
+            if (to == en_passant_square and pawns & (1 << from_square) and
+                from_square % 8 != to % 8):
+                if self._is_en_passant_legal(from_square, to, color):
+                    legal_moves.append(move)
+                continue
+            if check_mask is not None and not check_mask & (1 << to):
+                continue
+            pin_mask = pin_masks.get(from_square)
+            if pin_mask is not None and not pin_mask & (1 << to):
+                continue
+            legal_moves.append(move)
+        return legal_moves
+    
+    def _get_moves(self, color, from_bits, testing_check):
+        """Moves as (from square, to square) tuples. See get_valid_moves.
+        
+        """
+        moves = self._get_pseudo_moves(color, from_bits,
+                                       castling=not testing_check)
+        if testing_check:
+            return moves
+        return self._remove_illegal_moves(color, moves)
+    
+    def _get_game_move(self, move):
+        """Convert a move from square numbers to the (piece, pos) form.
+        
+        """
+        if len(move) == 3:
+            return (self._get_view(move[0]), POS_FOR_SQUARE[move[1]],
+                    KIND_CLASSES[move[2]])
+        return (self._get_view(move[0]), POS_FOR_SQUARE[move[1]])
+    
+    def get_valid_moves_for_piece(self, piece, testing_check=False):
+        """Get the moves the given piece can legally make.
+        
+        """
+        square = get_square_for_pos(piece.pos)
+        return self._get_cached_moves(piece.color, square, testing_check)
+    
+    def get_valid_moves(self, color, testing_check=False):
+        """All possible moves for the given color, as (piece, pos) tuples, or
+        (piece, pos, promotion class) for underpromotions.
+        
+        Pass testing_check to allow moves that would put the King at risk.
+        
+        """
+        return self._get_cached_moves(color, None, testing_check)
+    
+    def iter_legal_moves(self, color):
+        """Generate the legal moves for the given colour in three groups:
+        the King's first, then those of the pieces next to it, which are the
+        likeliest to have a move when the King is in trouble, then the rest.
+        Each group's moves are only worked out once the ones before have
+        been used.
+        
+        The game mustn't be changed while the moves are being generated.
+        
+        """
+        cached_moves = self.move_cache.get((self.zobrist_key, color, False,
+                                            None))
+        if cached_moves is not None:
+            for move in decode_moves(self, cached_moves):
+                yield move
+            return
+        # The King, the pieces next to it, then the rest
+        king_bits = self._bitboards[color][KING_KIND]
+        near_bits = (KING_ATTACKS[king_bits.bit_length() - 1] &
+                     self._occupied[color])
+        for from_bits in (king_bits, near_bits,
+                          self._occupied[color] & ~(king_bits | near_bits)):
+            if not from_bits:
+                continue
+            for move in self._get_moves(color, from_bits, False):
+                yield self._get_game_move(move)
+    
+    def has_legal_move(self, color):
+        """True if the given colour can move, stopping at the first legal
+        move found.
+        
+        """
+        for move in self.iter_legal_moves(color):
+            return True
+        return False
+    
+    def _get_cached_moves(self, color, square, testing_check):
+        """Moves in the (piece, pos) form for one square, or every square if
+        square is None, using the move cache.
+        
+        """
+        # If the moves for the whole side are cached, pick this square's out
+        all_key = (self.zobrist_key, color, testing_check, None)
+        if square is not None and all_key in self.move_cache:
+            return decode_moves(self, [code for code in
+                                       self.move_cache.get(all_key)
+                                       if code & MOVE_SQUARE_MASK == square])
+        
+        key = (self.zobrist_key, color, testing_check, square)
+        cached_moves = self.move_cache.get(key)
+        if cached_moves is not None:
+            return decode_moves(self, cached_moves)
+        if square is None:
+            from_bits = self._occupied[color]
+        else:
+            from_bits = 1 << square
+        moves = [self._get_game_move(move) for move in
+                 self._get_moves(color, from_bits, testing_check)]
+        self.move_cache.put(key, encode_moves(moves))
+        return moves
+    
+    def move_piece_to(self, piece, pos, promotion=Queen):
+        """Move the piece on the square of the given piece to pos.
+        
+        Returns a record that can be passed to unmake_move.
+        
+        """
+        return self._make(get_square_for_pos(piece.pos),
+                          get_square_for_pos(pos), KINDS[promotion])
+    
+    def make_move(self, move):
+        """Make a move and pass the turn to the other player.
+        
+        Returns a record that can be passed to unmake_move.
+        
+        """
+        undo = self.move_piece_to(*move)
+        if self.color_to_move == BLACK:
+            self.fullmove_number += 1
+        self.color_to_move = not self.color_to_move
+        return undo
+    
+    def unmake_move(self, undo):
+        """Take back a move made with make_move or move_piece_to.
+        
+        """
+        # The colour to move before the move is in the undo tuple
+        if undo[9] == BLACK and self.color_to_move == WHITE:
+            self.fullmove_number -= 1
+        self._unmake(undo)
+    
+    def check_endgame(self):
+        """Raises EndGame if the previous move ended the game.
+        
+        """
+        if not self.has_legal_move(self.color_to_move):
+            if self.in_check():
+                winner = not self.color_to_move
+                raise EndGame("Checkmate! %s wins" %
+                              COLOR_NAMES[winner].title(), winner)
+            else:
+                raise EndGame("Stalemate!")
+        
+        if self.idle_move_count >= 50:
+            raise EndGame("Draw (fifty idle moves)")
+        
+        if self.tablebase:
+            check_tablebase_endgame(self)
+    
+    def perft(self, depth):
+        """Count the positions reached by every sequence of legal moves of
+        the given length. Used to check and time move generation.
+        
+        """
+        if depth == 0:
+            return 1
+        color = self.color_to_move
+        moves = self._get_moves(color, self._occupied[color], False)
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for move in moves:
+            undo = self._make(*move)
+            self.color_to_move = not color
+            nodes += self.perft(depth - 1)
+            self._unmake(undo)
+        return nodes
+    
+    def divide(self, depth):
+        """Perft split by first move. Returns a list of (move, count) tuples.
+        
+        """
+        counts = []
+        for move in self.get_valid_moves(self.color_to_move):
+            undo = self.make_move(move)
+            counts.append((move, self.perft(depth - 1)))
+            self.unmake_move(undo)
+        return counts
+    
+    @classmethod
+    def from_fen(cls, fen):
+        """A game set up from a position in Forsyth-Edwards Notation.
+        
+        """
+        return cls(Game.from_fen(fen))
+    
+    def to_fen(self):
+        """The position in Forsyth-Edwards Notation.
+        
+        """
+        return get_fen(self)
+
+
+# Game state implementations that main() can choose between
+GAME_BACKENDS = {"object": Game, "bitboard": BitboardGame}
+
+# Standard perft positions and their known node counts for depths 1, 2, ...
+PERFT_POSITIONS = [
+    ("start",
+     "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete",
+     "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603]),
+    ("en passant",
+     "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624]),
+    ("promotion",
+     "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333]),
+    ("promotion mirrored",
+     "r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+     [6, 264, 9467, 422333]),
+    ("discovered check",
+     "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487]),
+    ("middle game",
+     "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594]),
+]
+
+# Unless told otherwise, the perft suite goes as deep as it can without
+# going over this many nodes per position
+PERFT_SUITE_NODES = 100000
+
+# Where the perft suite keeps its timings, and how much slower than them it
+# can be before it fails
+PERFT_TIMINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "perft_timings.json")
+PERFT_TOLERANCE = 0.25
+
+# Players that can take part in a tournament
+TOURNAMENT_PLAYERS = ["computer", "search"]
+
+# Error rates for stopping a tournament early with a sequential probability
+# ratio test: the chance of accepting the better Elo (elo1) when the true
+# difference is elo0, and the other way round
+SPRT_ALPHA = 0.05
+SPRT_BETA = 0.05
+
+# The test estimates the variance of game scores from the results, which
+# takes a few games to settle, so it never stops before this many
+SPRT_MIN_GAMES = 30
+
+# Standard Algebraic Notation for a move, once check marks and annotations
+# are stripped: piece letter, from file and rank if needed to tell pieces
+# apart, capture, to square and promotion
+SAN_PATTERN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?(x)?([a-h][1-8])"
+                         r"(?:=?([NBRQ]))?$")
+SAN_CASTLING = {"O-O": 6, "O-O-O": 2, "0-0": 6, "0-0-0": 2}
+
+# PGN: tag pairs, and the tokens of the move text. Comments can run over
+# several lines, so one without its closing brace takes the rest of the line.
+PGN_TAG = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+PGN_TOKEN = re.compile(r"\{[^}]*\}?|;.*|\(|\)|\$\d+|\d+\.+|[^\s{}();]+")
+PGN_RESULTS = {WHITE: "1-0", BLACK: "0-1", None: "1/2-1/2"}
+PGN_TAG_ORDER = ["Event", "Site", "Date", "Round", "White", "Black", "Result"]
+
+# Opening book records: position's zobrist key, move packed by encode_move
+# and weight, big-endian and sorted by key so a lookup can binary search
+BOOK_RECORD = struct.Struct(">QHH")
+BOOK_MAX_WEIGHT = 0xffff
+# Plies of each game that go into a book
+BOOK_MAX_PLIES = 20
+# Book weight for a move from each side's result: two for a win and one for
+# a draw (or an unknown result), like Polyglot books
+BOOK_RESULT_WEIGHTS = {"1-0": {WHITE: 2, BLACK: 0},
+                       "0-1": {WHITE: 0, BLACK: 2},
+                       "1/2-1/2": {WHITE: 1, BLACK: 1}}
+
+# Endgame tablebases: pawnless endings with up to this many pieces, stored
+# in this directory (by default), one file per set of pieces
+TABLEBASE_MAX_PIECES = 4
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "tablebases")
+TABLEBASE_EXTENSION = ".tb"
+# Built when none are named
+TABLEBASE_MATERIAL = ["KQK", "KRK", "KBK", "KNK"]
+# Pieces in a tablebase name, e.g. "KQKR", are in this order for each side
+TABLEBASE_PIECE_ORDER = "KQRBN"
+# Results of a tablebase probe, for the side to move
+TABLEBASE_WIN = 1
+TABLEBASE_DRAW = 0
+TABLEBASE_LOSS = -1
+# Longer than any mate an entry can hold
+TABLEBASE_MAX_PLIES = 256
+
+# Endings check mode builds, with the longest mate in each (in plies, for
+# the losing side to move), and positions to probe them with, with the
+# result for the side to move
+CHECK_TABLEBASES = [("KQK", 20), ("KRK", 32)]
+CHECK_TABLEBASE_POSITIONS = [
+    ("7k/8/6K1/8/8/8/8/1Q6 w - - 0 1", (TABLEBASE_WIN, 1)),
+    ("Q6k/8/6K1/8/8/8/8/8 b - - 0 1", (TABLEBASE_LOSS, 0)),
+    ("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1", (TABLEBASE_DRAW, 0)),
+    ("7k/6Q1/8/8/8/8/8/K7 b - - 0 1", (TABLEBASE_DRAW, 0)),
+    ("7k/8/6K1/8/8/8/8/R7 w - - 0 1", (TABLEBASE_WIN, 1)),
+    ("r7/8/8/8/8/6k1/8/7K b - - 0 1", (TABLEBASE_WIN, 1)),
+    ("R6k/8/6K1/8/8/8/8/8 b - - 0 1", (TABLEBASE_LOSS, 0)),
+    ("k7/8/8/8/8/8/6r1/7K w - - 0 1", (TABLEBASE_DRAW, 0)),
+    ("4k3/8/8/8/8/8/8/R3K3 w Q - 0 1", None),
+    ("4k3/8/8/8/8/8/8/QR2K3 w - - 0 1", None),
+]
+
+# UCI: moves are from and to squares with a promotion letter, e.g. "e7e8q"
+UCI_MOVE_PATTERN = re.compile(r"^([a-h][1-8])([a-h][1-8])([nbrq]?)$")
+UCI_ENGINE_NAME = "Simple command-line chess"
+UCI_AUTHOR = "maximile"
+# Deepest "go infinite" or a clock-limited search will go
+UCI_MAX_DEPTH = 64
+# With a clock and no "movestogo", assume this many moves are left to play
+UCI_MOVES_TO_GO = 30
+# Seconds kept back from each move's share of the clock for replying
+UCI_MOVE_OVERHEAD = 0.05
+
+
+def get_coords_for_grid_ref(grid_ref):
+    """Convert traditional coordinates to our coordinates.
+
+    e.g. A1 -> (0, 0)
+         H8 -> (7, 7)
+
+    """
+    x_for_file = {"A": 0, "B": 1, "C": 2, "D": 3, "E": 4, "F": 5, "G": 6,
+                  "H": 7}
+    y_for_rank = {"1": 0, "2": 1, "3": 2, "4": 3, "5": 4, "6": 5, "7": 6,
+                  "8": 7}
+    file_letter = grid_ref[0]
+    rank_number = grid_ref[1]
+    return (x_for_file[file_letter], y_for_rank[rank_number])
+
+def get_grid_ref_for_pos(coords):
+    """Convert traditional coordinates to our coordinates.
+
+    e.g. A1 -> (0, 0)
+         H8 -> (7, 7)
+
+    """
+    files = ["A", "B", "C", "D", "E", "F", "G", "H"]
+    ranks = ["1", "2", "3", "4", "5", "6", "7", "8"]
+    return (files[coords[0]] + ranks[coords[1]])
+
+def get_square_strings(game, selected_piece=None):
+    """The 64 squares of the board as ANSI-coloured strings, two characters
+    wide, in the order they're drawn: left to right along the top rank (black's
+    back rank), then down the board.
+    
+    """
+    # Get possible moves for selected piece
+    if selected_piece:
+        valid_moves = game.get_valid_moves_for_piece(selected_piece)
+        valid_squares = [move[1] for move in valid_moves]
+    else:
+        valid_squares = []
+    
+    # One pass over the pieces rather than a lookup for every square
+    board = [None] * 64
+    for piece in game.get_pieces():
+        board[piece.pos[0] + piece.pos[1] * 8] = piece
+    
+    square_strings = []
+    for y in reversed(range(8)):
+        for x in range(8):
+            # Get foreground text (must make up two characters)
+            piece = board[x + y * 8]
+            if piece:
+                if piece == selected_piece or piece == game.last_moved_piece:
+                    piece_char = SELECTED_PIECE_CHARACTERS[piece.__class__]
+                else:
+                    piece_char = PIECE_CHARACTERS[piece.__class__]
+                foreground_text = piece_char + " "
+            else:
+                foreground_text = "  "
+            
+            # Get background colour
+            if (x, y) in valid_squares:
+                square_color = HIGHLIGHTED
+            elif x % 2 == y % 2:
+                square_color = DARK
+            else:
+                square_color = LIGHT
+            piece_color = WHITE
+            if piece and piece.color == BLACK:
+                piece_color = BLACK
+            begin_code = ANSI_BEGIN % "%s;%s" % (ANSI_BG[square_color],
+                                                 ANSI_FG[piece_color])
+            square_strings.append("%s%s%s" % (begin_code, foreground_text,
+                                              ANSI_END))
+    return square_strings
+
+def get_board_string(square_strings):
+    """The whole board, with rank and file labels, from the square strings.
+    
+    """
+    rank_strings = []
+    for row in range(8):
+        rank_strings.append(" %i " % (8 - row) +
+                            "".join(square_strings[row * 8:row * 8 + 8]))
+    return "\n".join(rank_strings) + "\n" + BOARD_FILE_LABELS + "\n"
+
+def draw_game(game, selected_piece=None):
+    """Print a string that represents the current game state.
+    
+    Uses ANSI color codes to make it readable - game isn't playable without
+    color support in the terminal.
+    
+    """
+    sys.stdout.write(get_board_string(get_square_strings(game,
+                                                         selected_piece)))
+    sys.stdout.flush()
+
+
+class BoardRenderer(object):
+    """Draws the board over and over in the same place, repainting only the
+    squares that changed since the last frame.
+    
+    The first frame is drawn in full, followed by a status line. After that
+    the cursor is moved up into the board with ANSI escapes, so nothing else
+    may be written to the terminal in between; call invalidate() if it was,
+    and the next frame is drawn in full below it. Each frame goes out in one
+    write.
+    
+    """
+    # Lines from the top rank to the one below the status line
+    HEIGHT = 10
+    
+    def __init__(self, output_file=None):
+        self.output_file = output_file or sys.stdout
+        self._square_strings = None
+        self._status = None
+    
+    def invalidate(self):
+        """Forget the last frame, so the next one is drawn in full.
+        
+        """
+        self._square_strings = None
+    
+    def draw(self, game, status=""):
+        """Show the game's position, with a line of text below it.
+        
+        """
+        square_strings = get_square_strings(game)
+        if self._square_strings is None:
+            frame = get_board_string(square_strings) + status + "\n"
+        else:
+            # Up to each changed square, draw it and come back down
+            parts = []
+            for index, square_string in enumerate(square_strings):
+                if square_string == self._square_strings[index]:
+                    continue
+                lines_up = self.HEIGHT - index // 8
+                parts.append("\033[%iA\033[%iG%s\033[%iB\r" %
+                             (lines_up, 4 + index % 8 * 2, square_string,
+                              lines_up))
+            if status != self._status:
+                parts.append("\033[1A%s\033[K\n" % status)
+            frame = "".join(parts)
+        self._square_strings = square_strings
+        self._status = status
+        if frame:
+            self.output_file.write(frame)
+            self.output_file.flush()
+
+
+def encode_move(move):
+    """Pack a (piece, pos) or (piece, pos, promotion class) move into a
+    16-bit int. See MOVE_TO_SHIFT.
+    
+    """
+    from_pos, to_pos = move[0].pos, move[1]
+    code = (from_pos[0] + from_pos[1] * 8 |
+            (to_pos[0] + to_pos[1] * 8) << MOVE_TO_SHIFT)
+    if len(move) == 3:
+        code |= MOVE_PROMOTION_CODES[move[2]] << MOVE_PROMOTION_SHIFT
+    return code
+
+def decode_move(game, code):
+    """Unpack a move packed by encode_move, using the piece now on its from
+    square in the given game.
+    
+    """
+    piece = game.get_piece_at(POS_FOR_SQUARE[code & MOVE_SQUARE_MASK])
+    to_pos = POS_FOR_SQUARE[code >> MOVE_TO_SHIFT & MOVE_SQUARE_MASK]
+    promotion = MOVE_PROMOTIONS[code >> MOVE_PROMOTION_SHIFT &
+                                MOVE_PROMOTION_MASK]
+    if promotion:
+        return (piece, to_pos, promotion)
+    return (piece, to_pos)
+
+def encode_moves(moves):
+    """Pack a list of moves into an array of 16-bit ints.
+    
+    """
+    return array("H", [encode_move(move) for move in moves])
+
+def decode_moves(game, codes):
+    """Unpack an array of moves packed by encode_moves.
+    
+    """
+    return [decode_move(game, code) for code in codes]
+
+def get_fen(game):
+    """Forsyth-Edwards Notation for the position of a game of either
+    backend.
+    
+    """
+    ranks = []
+    for y in reversed(range(8)):
+        rank = ""
+        empty_squares = 0
+        for x in range(8):
+            piece = game.get_piece_at((x, y))
+            if not piece:
+                empty_squares += 1
+                continue
+            if empty_squares:
+                rank += str(empty_squares)
+                empty_squares = 0
+            letter = PIECE_LETTERS[piece.__class__]
+            rank += letter.upper() if piece.color == WHITE else letter
+        if empty_squares:
+            rank += str(empty_squares)
+        ranks.append(rank)
+    
+    rights = game.get_castling_rights()
+    castling = "".join(letter for right, letter in
+                       ((WHITE_KING_SIDE, "K"), (WHITE_QUEEN_SIDE, "Q"),
+                        (BLACK_KING_SIDE, "k"), (BLACK_QUEEN_SIDE, "q"))
+                       if rights & right)
+    en_passant = "-"
+    if game.en_passant_pos:
+        en_passant = get_grid_ref_for_pos(game.en_passant_pos).lower()
+    return "%s %s %s %s %i %i" % ("/".join(ranks),
+                                  "w" if game.color_to_move == WHITE else "b",
+                                  castling or "-", en_passant,
+                                  game.idle_move_count, game.fullmove_number)
+
+def read_fen_file(path, game_class=Game):
+    """Generate a game for each position in a file of FENs, one per line,
+    reading the file as it goes.
+    
+    Blank lines and lines starting with # are skipped. EPD files work too:
+    anything after the first four fields that isn't a move count is
+    ignored. Raises ValueError with the line number for a bad position.
+    
+    """
+    with open(path) as fen_file:
+        for line_number, line in enumerate(fen_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            fields = fields[:4] + [field for field in fields[4:6]
+                                   if field.isdigit()]
+            try:
+                yield game_class.from_fen(" ".join(fields))
+            except ValueError as e:
+                raise ValueError("%s, line %i: %s" % (path, line_number, e))
+
+def _get_piece_at_by_scan(game, pos):
+    """get_piece_at as it was before Game kept a square index: a walk along
+    the piece list. For run_move_benchmark to compare against.
+    
+    """
+    for piece in game._pieces:
+        if piece.pos == pos:
+            return piece
+    return None
+
+def _get_pieces_by_scan(game, color=None):
+    """get_pieces as it was before Game kept a list for each colour.
+    
+    """
+    return [piece for piece in game._pieces
+            if color is None or piece.color == color]
+
+def run_move_benchmark(backend, calls=MOVE_BENCHMARK_CALLS):
+    """Time move generation and legality checks, each against the way it
+    used to be done.
+    
+    get_valid_moves(WHITE) from the start position is timed, and for the
+    object backend, again with get_piece_at and get_pieces scanning the
+    piece list as they used to instead of using the square index. Then every
+    move along a seeded random game is checked for leaving its King in
+    check, by make_move/unmake_move and by making it on a deep copy of the
+    game, counting the objects each copy allocates.
+    
+    """
+    game_class = GAME_BACKENDS[backend]
+    print "Move benchmark: %s backend, %i calls" % (backend, calls)
+    if game_class is Game:
+        variants = [("square index", {}),
+                    ("piece list scan",
+                     {"get_piece_at": _get_piece_at_by_scan,
+                      "get_pieces": _get_pieces_by_scan})]
+    else:
+        variants = [(backend, {})]
+    for name, scans in variants:
+        game = game_class()
+        # Time the move generator itself, not lookups in the move cache
+        game.move_cache.max_size = 0
+        originals = dict((method_name, game_class.__dict__[method_name])
+                         for method_name in scans)
+        for method_name, method in scans.items():
+            setattr(game_class, method_name, method)
+        try:
+            start_time = time.time()
+            for call in range(calls):
+                game.get_valid_moves(WHITE)
+            elapsed = time.time() - start_time
+        finally:
+            for method_name, method in originals.items():
+                setattr(game_class, method_name, method)
+        print "get_valid_moves(WHITE), %-16s %8.3f ms/call" % (
+            name + ":", elapsed * 1000 / calls)
+    
+    checks = copied = 0
+    times = [0.0, 0.0]
+    game = game_class()
+    game.move_cache.max_size = 0
+    choices = random.Random(0)
+    for ply in range(MOVE_BENCHMARK_PLIES):
+        color = game.color_to_move
+        moves = game.get_valid_moves(color, testing_check=True)
+        checks += len(moves)
+        start_time = time.time()
+        for move in moves:
+            undo = game.make_move(move)
+            game.in_check(color)
+            game.unmake_move(undo)
+        times[0] += time.time() - start_time
+        start_time = time.time()
+        for move in moves:
+            memo = {}
+            game_copy = copy.deepcopy(game, memo)
+            game_copy.make_move((game_copy.get_piece_at(move[0].pos),) +
+                                tuple(move[1:]))
+            game_copy.in_check(color)
+            copied += len(memo)
+        times[1] += time.time() - start_time
+        legal_moves = game.get_valid_moves(color)
+        if not legal_moves:
+            break
+        game.make_move(choices.choice(legal_moves))
+    print "Legality checks: %i moves" % checks
+    print "  make/unmake: %8.3f ms/move  no objects copied" % (
+        times[0] * 1000 / checks)
+    print "  deep copy:   %8.3f ms/move  %i objects copied per move" % (
+        times[1] * 1000 / checks, copied // checks)
+
+def run_backend_comparison(games=COMPARE_GAMES, seed=0):
+    """Play seeded random games on every backend side by side, checking at
+    each ply that they agree on the legal moves and on check. Prints how
+    many positions were compared. Returns True if the backends always
+    agreed.
+    
+    """
+    backends = sorted(GAME_BACKENDS)
+    print "Comparing backends: %s" % ", ".join(backends)
+    choices = random.Random(seed)
+    positions = 0
+    for game_number in range(1, games + 1):
+        backend_games = [GAME_BACKENDS[backend]() for backend in backends]
+        for ply in range(COMPARE_MAX_PLIES):
+            color = backend_games[0].color_to_move
+            move_lists = [sorted((move[0].pos,) + tuple(move[1:])
+                                 for move in game.get_valid_moves(color))
+                          for game in backend_games]
+            checks = [game.in_check(color) for game in backend_games]
+            positions += 1
+            if (any(moves != move_lists[0] for moves in move_lists) or
+                any(check != checks[0] for check in checks)):
+                print "Game %i, ply %i: the backends disagree" % (
+                    game_number, ply + 1)
+                for backend, moves, check in zip(backends, move_lists,
+                                                 checks):
+                    print "  %s: %i moves%s" % (backend, len(moves),
+                                                ", in check" if check else "")
+                return False
+            if not move_lists[0]:
+                break
+            move = choices.choice(move_lists[0])
+            for game in backend_games:
+                game.make_move((game.get_piece_at(move[0]),) + move[1:])
+    print "%i games, %i positions: ok" % (games, positions)
+    return True
+
+def get_static_exchange(game, move):
+    """Material the player making the move can expect to win with it, in
+    PIECE_VALUES units, once the captures that follow on the target square
+    are over. Each side takes with its cheapest piece first, and stops when
+    taking again would lose material. Pins aren't noticed.
+    
+    A move to a square where it can be taken for nothing scores minus the
+    moving piece's value; a safe move with no capture scores 0.
+    
+    """
+    piece, pos = move[:2]
+    taken_piece = game.get_piece_at(pos)
+    removed = set([piece.pos])
+    gain = 0
+    if taken_piece:
+        gain = PIECE_VALUES[taken_piece.__class__]
+    elif piece.__class__ == Pawn and pos[0] != piece.pos[0]:
+        # En passant
+        gain = PIECE_VALUES[Pawn]
+        removed.add((pos[0], piece.pos[1]))
+    value = PIECE_VALUES[piece.__class__]
+    if piece.__class__ == Pawn and pos[1] in (0, 7):
+        promotion = move[2] if len(move) > 2 else Queen
+        gain += PIECE_VALUES[promotion] - value
+        value = PIECE_VALUES[promotion]
+    return gain - get_exchange_loss(game, pos, not piece.color, value,
+                                    removed)
+
+def get_exchange_loss(game, pos, color, value, removed=()):
+    """What the given colour can win by taking a piece worth value on the
+    square, then carrying on with the exchange as in get_static_exchange,
+    or 0 if it's better off not starting. The pieces on the positions in
+    removed have already moved away.
+    
+    """
+    # The value of the piece taken by each capture in turn
+    taken_values = []
+    removed = set(removed)
+    while True:
+        attackers = game.get_attackers(pos, color, removed)
+        if not attackers:
+            break
+        attacker = min(attackers,
+                       key=lambda piece: PIECE_VALUES[piece.__class__])
+        taken_values.append(value)
+        value = PIECE_VALUES[attacker.__class__]
+        removed.add(attacker.pos)
+        color = not color
+    
+    # Work back from the end: each side only takes if what it wins is more
+    # than it loses in the captures after
+    loss = 0
+    for taken_value in reversed(taken_values):
+        loss = max(taken_value - loss, 0)
+    return loss
+
+def get_move_string(move):
+    """A move in from-to form, e.g. 'E2E4', with the piece letter added for
+    underpromotions, e.g. 'A7A8N'.
+    
+    """
+    move_string = (get_grid_ref_for_pos(move[0].pos) +
+                   get_grid_ref_for_pos(move[1]))
+    if len(move) == 3:
+        move_string += PIECE_LETTERS[move[2]].upper()
+    return move_string
+
+def get_san(game, move):
+    """Standard Algebraic Notation for a move in the game's current
+    position, e.g. "Nbd2", "exd6", "e8=N", "O-O" or "Qh5#".
+    
+    """
+    piece, pos = move[0], move[1]
+    piece_class = piece.__class__
+    square = get_grid_ref_for_pos(pos).lower()
+    if piece_class == King and abs(pos[0] - piece.pos[0]) == 2:
+        san = "O-O" if pos[0] == 6 else "O-O-O"
+    elif piece_class == Pawn:
+        san = square
+        if pos[0] != piece.pos[0]:
+            san = get_grid_ref_for_pos(piece.pos)[0].lower() + "x" + square
+        if pos[1] in (0, 7):
+            promotion = move[2] if len(move) == 3 else Queen
+            san += "=" + PIECE_LETTERS[promotion].upper()
+    else:
+        # Name the from file, rank or both if another piece of the same kind
+        # could go to the same square
+        rivals = [other.pos for other in game.get_pieces(piece.color)
+                  if other is not piece and other.__class__ == piece_class and
+                  any(other_move[1] == pos for other_move in
+                      game.get_valid_moves_for_piece(other))]
+        from_ref = get_grid_ref_for_pos(piece.pos).lower()
+        if not rivals:
+            disambiguation = ""
+        elif all(rival[0] != piece.pos[0] for rival in rivals):
+            disambiguation = from_ref[0]
+        elif all(rival[1] != piece.pos[1] for rival in rivals):
+            disambiguation = from_ref[1]
+        else:
+            disambiguation = from_ref
+        capture = "x" if game.get_piece_at(pos) else ""
+        san = (PIECE_LETTERS[piece_class].upper() + disambiguation + capture +
+               square)
+    
+    # Check and mate
+    undo = game.make_move(move)
+    if game.in_check():
+        san += "+" if game.get_valid_moves(game.color_to_move) else "#"
+    game.unmake_move(undo)
+    return san
+
+def get_move_for_san(game, san):
+    """The move in the game's current position that a move in Standard
+    Algebraic Notation stands for. Raises ValueError if it isn't legal or
+    doesn't say which piece moves.
+    
+    """
+    color = game.color_to_move
+    stripped = san.rstrip("+#!?")
+    if stripped in SAN_CASTLING:
+        piece_class, from_file, from_rank = King, None, None
+        rank = 0 if color == WHITE else 7
+        pos = (SAN_CASTLING[stripped], rank)
+        promotion = None
+        castling = True
+    else:
+        match = SAN_PATTERN.match(stripped)
+        if not match:
+            raise ValueError("Bad move %r" % san)
+        letter, file_char, rank_char, capture, square, promotion = \
+            match.groups()
+        piece_class = PIECE_CLASSES_FOR_LETTERS[letter.lower()] if letter \
+            else Pawn
+        from_file = "abcdefgh".index(file_char) if file_char else None
+        from_rank = int(rank_char) - 1 if rank_char else None
+        pos = get_coords_for_grid_ref(square.upper())
+        castling = False
+        if promotion:
+            promotion = PIECE_CLASSES_FOR_LETTERS[promotion.lower()]
+        if piece_class == Pawn and not capture:
+            from_file = pos[0]
+    
+    candidates = []
+    for piece in game.get_pieces(color):
+        if (piece.__class__ != piece_class or
+            from_file is not None and piece.pos[0] != from_file or
+            from_rank is not None and piece.pos[1] != from_rank):
+            continue
+        if castling and piece.pos != (4, pos[1]):
+            continue
+        
+        # Only work out the moves of pieces that could get there on an empty
+        # board
+        x_distance = abs(pos[0] - piece.pos[0])
+        y_distance = abs(pos[1] - piece.pos[1])
+        if piece_class == Knight:
+            if (x_distance, y_distance) not in ((1, 2), (2, 1)):
+                continue
+        elif piece_class in (Bishop, Rook, Queen):
+            diagonal = x_distance == y_distance
+            straight = not x_distance or not y_distance
+            if (not (diagonal or straight) or
+                diagonal and piece_class == Rook or
+                straight and piece_class == Bishop):
+                continue
+        
+        for move in game.get_valid_moves_for_piece(piece):
+            if move[1] != pos:
+                continue
+            move_promotion = move[2] if len(move) == 3 else Queen
+            if promotion and move_promotion != promotion:
+                continue
+            if not promotion and len(move) == 3:
+                continue
+            candidates.append(move)
+    if len(candidates) != 1:
+        raise ValueError("%s move %r" % ("Ambiguous" if candidates
+                                         else "Illegal", san))
+    return candidates[0]
+
+def get_uci_move(move):
+    """A move in UCI's long algebraic notation, e.g. "e2e4" or "e7e8q".
+    
+    """
+    promotion = None
+    if move[0].__class__ == Pawn and move[1][1] in (0, 7):
+        promotion = move[2] if len(move) == 3 else Queen
+    move_string = (get_grid_ref_for_pos(move[0].pos) +
+                   get_grid_ref_for_pos(move[1])).lower()
+    if promotion:
+        move_string += PIECE_LETTERS[promotion]
+    return move_string
+
+def get_move_for_uci(game, move_string):
+    """The move in the game's current position for a move in UCI's long
+    algebraic notation. Raises ValueError if it isn't legal.
+    
+    """
+    match = UCI_MOVE_PATTERN.match(move_string)
+    if not match:
+        raise ValueError("Bad move %r" % move_string)
+    from_pos = get_coords_for_grid_ref(match.group(1).upper())
+    pos = get_coords_for_grid_ref(match.group(2).upper())
+    piece = game.get_piece_at(from_pos)
+    if piece and piece.color == game.color_to_move:
+        move = (piece, pos)
+        if match.group(3) and match.group(3) != "q":
+            move = (piece, pos, PIECE_CLASSES_FOR_LETTERS[match.group(3)])
+        if move in game.get_valid_moves_for_piece(piece):
+            return move
+    raise ValueError("Illegal move %r" % move_string)
+
+def get_pgn(headers, san_moves, result, first_move_number=1,
+            black_first=False):
+    """A game in Portable Game Notation.
+    
+    headers is a dict of tag names and values; the standard seven come first
+    and any others follow in alphabetical order. Moves are SAN strings.
+    
+    """
+    headers = dict(headers, Result=result)
+    lines = []
+    tag_names = [name for name in PGN_TAG_ORDER if name in headers]
+    tag_names += sorted(name for name in headers if name not in PGN_TAG_ORDER)
+    for name in tag_names:
+        value = str(headers[name]).replace("\\", "\\\\").replace('"', '\\"')
+        lines.append('[%s "%s"]' % (name, value))
+    lines.append("")
+    
+    # Move text, wrapped to under 80 columns
+    tokens = []
+    move_number = first_move_number
+    for index, san in enumerate(san_moves):
+        black = (index % 2 == 1) != black_first
+        if not black:
+            tokens.append("%i." % move_number)
+        elif index == 0:
+            tokens.append("%i..." % move_number)
+        tokens.append(san)
+        if black:
+            move_number += 1
+    tokens.append(result)
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 79:
+            lines.append(line)
+            line = token
+        else:
+            line = line + " " + token if line else token
+    lines.append(line)
+    return "\n".join(lines) + "\n\n"
+
+def read_pgn_file(path):
+    """Generate (headers, moves) for each game in a PGN file, reading the
+    file as it goes so only one game is held at a time.
+    
+    headers is a dict of the game's tag pairs and moves is a list of SAN
+    strings. Comments, variations and annotations are skipped.
+    
+    """
+    headers = {}
+    moves = []
+    in_comment = False
+    variation_depth = 0
+    with open(path) as pgn_file:
+        for line in pgn_file:
+            if in_comment:
+                if "}" not in line:
+                    continue
+                line = line[line.index("}") + 1:]
+                in_comment = False
+            elif line.startswith("%"):
+                continue
+            
+            # A tag after some moves starts the next game
+            match = PGN_TAG.match(line)
+            if match:
+                if moves:
+                    yield headers, moves
+                    headers, moves = {}, []
+                value = match.group(2).replace('\\"', '"').replace("\\\\",
+                                                                    "\\")
+                headers[match.group(1)] = value
+                continue
+            
+            for token in PGN_TOKEN.findall(line):
+                first = token[0]
+                if first == "{":
+                    in_comment = not token.endswith("}")
+                elif first == "(":
+                    variation_depth += 1
+                elif first == ")":
+                    variation_depth -= 1
+                elif (variation_depth or first in ";$" or
+                      first.isdigit() and token[-1] == "."):
+                    continue
+                elif token in ("1-0", "0-1", "1/2-1/2", "*"):
+                    headers.setdefault("Result", token)
+                    yield headers, moves
+                    headers, moves = {}, []
+                else:
+                    moves.append(token)
+    if headers or moves:
+        yield headers, moves
+
+def replay_pgn_game(headers, san_moves, game_class=Game):
+    """A game of the given backend with the moves of a game from
+    read_pgn_file made, starting from its FEN tag if it has one. Raises
+    ValueError for a bad position or move.
+    
+    """
+    if "FEN" in headers:
+        game = game_class.from_fen(headers["FEN"])
+    else:
+        game = game_class()
+    for san in san_moves:
+        game.make_move(get_move_for_san(game, san))
+    return game
+
+def build_opening_book(games, path, max_plies=BOOK_MAX_PLIES,
+                       game_class=Game):
+    """Write an opening book for OpeningBook from games given as (headers,
+    moves) pairs, as generated by read_pgn_file.
+    
+    The first max_plies moves of each game are weighted by how the side that
+    played them did (see BOOK_RESULT_WEIGHTS) and summed per position and
+    move. A game stops counting at a move that can't be played. Returns the
+    number of games read and the number of records written.
+    
+    """
+    weights = collections.defaultdict(int)
+    game_count = 0
+    for headers, san_moves in games:
+        game_count += 1
+        result_weights = BOOK_RESULT_WEIGHTS.get(headers.get("Result"),
+                                                 {WHITE: 1, BLACK: 1})
+        try:
+            if "FEN" in headers:
+                game = game_class.from_fen(headers["FEN"])
+            else:
+                game = game_class()
+            for san in san_moves[:max_plies]:
+                move = get_move_for_san(game, san)
+                weights[game.zobrist_key, encode_move(move)] += \
+                    result_weights[game.color_to_move]
+                game.make_move(move)
+        except ValueError:
+            continue
+    
+    # Scale down to fit, keeping every move that was ever worth playing
+    scale = 1.0
+    if weights and max(weights.values()) > BOOK_MAX_WEIGHT:
+        scale = float(BOOK_MAX_WEIGHT) / max(weights.values())
+    records = 0
+    with open(path, "wb") as book_file:
+        for (key, code), weight in sorted(weights.items()):
+            if not weight:
+                continue
+            book_file.write(BOOK_RECORD.pack(key, code,
+                                             max(int(weight * scale), 1)))
+            records += 1
+    return game_count, records
+
+
+class OpeningBook(object):
+    """Looks up moves in an opening book written by build_opening_book.
+    
+    The file is memory-mapped and binary searched rather than read in, so
+    opening it is instant and only the pages a lookup touches are loaded,
+    however big the book is. Processes using the same book share them.
+    
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size % BOOK_RECORD.size:
+            self._file.close()
+            raise ValueError("%s isn't an opening book" % path)
+        self._records = size // BOOK_RECORD.size
+        self._map = None
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+    
+    def __len__(self):
+        return self._records
+    
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+    
+    def _get_record(self, index):
+        return BOOK_RECORD.unpack_from(self._map, index * BOOK_RECORD.size)
+    
+    def get_moves(self, game):
+        """The book's moves for the game's position, as (move, weight)
+        pairs. Moves that aren't legal in the position (from a different
+        position with the same key) are left out.
+        
+        """
+        key = game.zobrist_key
+        
+        # First record with the key or above
+        low, high = 0, self._records
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        
+        moves = []
+        index = low
+        while index < self._records:
+            record_key, code, weight = self._get_record(index)
+            index += 1
+            if record_key != key:
+                break
+            move = decode_move(game, code)
+            piece = move[0]
+            if (piece and piece.color == game.color_to_move and
+                move in game.get_valid_moves_for_piece(piece)):
+                moves.append((move, weight))
+        return moves
+    
+    def choose_move(self, game):
+        """A move from the book for the game's position, picked at random
+        with its weight, or None if the position isn't in the book.
+        
+        """
+        moves = self.get_moves(game)
+        if not moves:
+            return None
+        choice = random.randint(1, sum(weight for move, weight in moves))
+        for move, weight in moves:
+            choice -= weight
+            if choice <= 0:
+                return move
+
+
+def _build_tablebase_transforms():
+    """For each square, which of the eight symmetries of the board moves a
+    King there into the a1-d1-d4 triangle, and for each symmetry, where it
+    takes each square. Mirroring across the diagonal (bit 4) is only done to
+    get off the wrong side of it; see get_tablebase_index for Kings on it.
+    
+    """
+    transforms = []
+    for square in range(64):
+        x, y = square % 8, square // 8
+        flip_x, flip_y = x > 3, y > 3
+        if flip_x:
+            x = 7 - x
+        if flip_y:
+            y = 7 - y
+        transforms.append(flip_x | flip_y << 1 | (y > x) << 2)
+    squares = []
+    for transform in range(8):
+        table = []
+        for square in range(64):
+            x, y = square % 8, square // 8
+            if transform & 1:
+                x = 7 - x
+            if transform & 2:
+                y = 7 - y
+            if transform & 4:
+                x, y = y, x
+            table.append(x + y * 8)
+        squares.append(table)
+    return transforms, squares
+
+# The first King's squares after the board has been turned, and each one's
+# number in a tablebase index
+TABLEBASE_TRIANGLE = [x + y * 8 for x in range(4) for y in range(x + 1)]
+TABLEBASE_TRIANGLE_INDEX = dict((square, index) for index, square in
+                                enumerate(TABLEBASE_TRIANGLE))
+TABLEBASE_DIAGONAL = set([0, 9, 18, 27])
+TABLEBASE_TRANSFORMS, TABLEBASE_TRANSFORMED_SQUARES = \
+    _build_tablebase_transforms()
+
+def get_tablebase_name(sides):
+    """Name of the tablebase for a pair of sides' pieces, as letters, e.g.
+    ("KR", "KQ") -> "KQKR". Returns the name and whether the sides were
+    swapped to put the stronger one first, or None and False for bare Kings.
+    
+    """
+    def get_strength(letters):
+        return (sum(PIECE_VALUES[PIECE_CLASSES_FOR_LETTERS[letter.lower()]]
+                    for letter in letters[1:]),
+                [-TABLEBASE_PIECE_ORDER.index(letter) for letter in letters])
+    sides = ["".join(sorted(letters, key=TABLEBASE_PIECE_ORDER.index))
+             for letters in sides]
+    if sides == ["K", "K"]:
+        return None, False
+    swapped = get_strength(sides[1]) > get_strength(sides[0])
+    if swapped:
+        sides.reverse()
+    return sides[0] + sides[1], swapped
+
+def is_tablebase_name(name):
+    """True if the name, e.g. "KQKR", is one build_tablebase can work out:
+    a King then other pieces for each side, stronger side first, no Pawns
+    and no more than TABLEBASE_MAX_PIECES pieces in all.
+    
+    """
+    if (len(name) > TABLEBASE_MAX_PIECES or name.count("K") != 2 or
+        not name.startswith("K") or
+        set(name) - set(TABLEBASE_PIECE_ORDER)):
+        return False
+    split = name.index("K", 1)
+    return get_tablebase_name([name[:split], name[split:]]) == (name, False)
+
+def get_tablebase_size(name):
+    """Number of positions in a tablebase: either side to move, the first
+    King in the triangle and the other pieces anywhere.
+    
+    """
+    return 2 * len(TABLEBASE_TRIANGLE) * 64 ** (len(name) - 1)
+
+def get_tablebase_twin(name):
+    """The first of two identical pieces in a tablebase name, e.g. 1 for
+    "KBBK", or None.
+    
+    """
+    for slot in range(1, len(name) - 1):
+        if name[slot] == name[slot + 1] != "K":
+            return slot
+    return None
+
+def get_tablebase_index(side_to_move, squares, twin=None):
+    """Index of a position in a tablebase, from the side to move (0 for the
+    first side in the name) and the square of each piece, in name order.
+    twin is get_tablebase_twin for the name.
+    
+    Every position has one index however the board is turned: the first
+    King goes in the a1-d1-d4 triangle, and if that leaves it on the
+    diagonal, whichever way round across the diagonal lists the lower
+    squares first is used. Identical pieces are listed lowest square first.
+    
+    """
+    transform = TABLEBASE_TRANSFORMS[squares[0]]
+    transforms = [transform]
+    if TABLEBASE_TRANSFORMED_SQUARES[transform][squares[0]] in \
+            TABLEBASE_DIAGONAL:
+        transforms.append(transform | 4)
+    best = None
+    for transform in transforms:
+        transformed = TABLEBASE_TRANSFORMED_SQUARES[transform]
+        moved = [transformed[square] for square in squares]
+        if twin is not None and moved[twin] > moved[twin + 1]:
+            moved[twin], moved[twin + 1] = moved[twin + 1], moved[twin]
+        if best is None or moved < best:
+            best = moved
+    index = (side_to_move * len(TABLEBASE_TRIANGLE) +
+             TABLEBASE_TRIANGLE_INDEX[best[0]])
+    for square in best[1:]:
+        index = index * 64 + square
+    return index
+
+def get_tablebase_result(value):
+    """(TABLEBASE_WIN, DRAW or LOSS, plies to mate) for the side to move,
+    from a tablebase entry: 0 for a draw, otherwise the plies until mate
+    plus one. Mates an odd number of plies away are wins.
+    
+    """
+    if not value:
+        return TABLEBASE_DRAW, 0
+    plies = value - 1
+    return (TABLEBASE_WIN if plies % 2 else TABLEBASE_LOSS), plies
+
+def _get_tablebase_attacks(letter, square, occupied):
+    if letter == "K":
+        return KING_ATTACKS[square]
+    if letter == "N":
+        return KNIGHT_ATTACKS[square]
+    if letter == "R":
+        return sliding_attacks(square, occupied, STRAIGHT_RAYS)
+    if letter == "B":
+        return sliding_attacks(square, occupied, DIAGONAL_RAYS)
+    return sliding_attacks(square, occupied, DIAGONAL_RAYS + STRAIGHT_RAYS)
+
+
+class _TablebaseGenerator(object):
+    """Works out one tablebase by retrograde analysis. See build_tablebase.
+    
+    Positions are lists of squares in name order. A position's entry is only
+    filled in once its result is known for certain; those left at 0 at the
+    end are draws, or never legal, or not the position's own index (see
+    get_tablebase_index).
+    
+    """
+    def __init__(self, name, subtables):
+        self.name = name
+        self.twin = get_tablebase_twin(name)
+        split = name.index("K", 1)
+        self.letters = list(name)
+        self.sides = [0] * split + [1] * (len(name) - split)
+        self.slots = [range(split), range(split, len(name))]
+        self.kings = [0, split]
+        self.values = bytearray(get_tablebase_size(name))
+        
+        # Distinct positions each position can move to without taking,
+        # counted down as they turn out to be won for the other side. One
+        # more is added for positions that can take into a draw or a win.
+        self.counts = bytearray(len(self.values))
+        # Longest loss a position can take into, where it has one
+        self.capture_losses = {}
+        
+        # For each piece that can be taken: the tablebase that leaves (None
+        # for bare Kings), whether its sides are the other way round and the
+        # pieces left, in its name order
+        self.captures = {}
+        for slot in range(len(name)):
+            if name[slot] == "K":
+                continue
+            sides = ["".join(letter for other, letter in enumerate(name)
+                             if self.sides[other] == side and other != slot)
+                     for side in (0, 1)]
+            subname, swapped = get_tablebase_name(sides)
+            order = [other for other in range(len(name)) if other != slot]
+            order.sort(key=lambda other: (self.sides[other] != swapped,
+                                          TABLEBASE_PIECE_ORDER.index(
+                                              name[other])))
+            self.captures[slot] = (subtables.get(subname), swapped, order,
+                                   subname and get_tablebase_twin(subname))
+    
+    def decode(self, index):
+        squares = []
+        for slot in range(len(self.letters) - 1):
+            squares.append(index & 63)
+            index >>= 6
+        squares.append(TABLEBASE_TRIANGLE[index % len(TABLEBASE_TRIANGLE)])
+        squares.reverse()
+        return index // len(TABLEBASE_TRIANGLE), squares
+    
+    def is_attacked(self, square, side, squares, occupied, taken=None):
+        """True if a piece of the side attacks the square.
+        
+        """
+        letters = self.letters
+        for slot in self.slots[side]:
+            if slot != taken and _get_tablebase_attacks(
+                    letters[slot], squares[slot], occupied) >> square & 1:
+                return True
+        return False
+    
+    def get_moves(self, side, squares, occupied):
+        """Generate (position after, piece taken or None) for each legal
+        move of the side.
+        
+        """
+        letters = self.letters
+        own = 0
+        for slot in self.slots[side]:
+            own |= 1 << squares[slot]
+        enemy_slots = dict((squares[slot], slot)
+                           for slot in self.slots[1 - side])
+        king = self.kings[side]
+        for slot in self.slots[side]:
+            square = squares[slot]
+            targets = _get_tablebase_attacks(letters[slot], square,
+                                             occupied) & ~own
+            for target in iter_bits(targets):
+                moved = list(squares)
+                moved[slot] = target
+                taken = enemy_slots.get(target)
+                if not self.is_attacked(moved[king], 1 - side, moved,
+                                        occupied ^ 1 << square | 1 << target,
+                                        taken):
+                    yield moved, taken
+    
+    def get_previous_positions(self, side_to_move, squares):
+        """Generate the positions that could have come before this one,
+        without a capture.
+        
+        """
+        side = 1 - side_to_move
+        letters = self.letters
+        occupied = 0
+        for square in squares:
+            occupied |= 1 << square
+        for slot in self.slots[side]:
+            square = squares[slot]
+            targets = _get_tablebase_attacks(letters[slot], square,
+                                             occupied) & ~occupied
+            for target in iter_bits(targets):
+                moved = list(squares)
+                moved[slot] = target
+                if not self.is_attacked(moved[self.kings[side_to_move]], side,
+                                        moved,
+                                        occupied ^ 1 << square | 1 << target):
+                    yield get_tablebase_index(side, moved, self.twin)
+    
+    def get_capture_value(self, side_to_move, squares, taken):
+        """Entry for the position after a capture, from the smaller
+        tablebase. The taken piece's square in squares is ignored.
+        
+        """
+        subtable, swapped, order, twin = self.captures[taken]
+        if subtable is None:
+            return 0
+        return subtable[get_tablebase_index(side_to_move ^ swapped,
+                                            [squares[slot] for slot in order],
+                                            twin)]
+    
+    def generate(self):
+        values, counts = self.values, self.counts
+        # Positions whose result has been found, by plies to mate, waiting
+        # to be passed on to the positions before them, and wins found by
+        # capturing that a quicker win could still beat
+        found = collections.defaultdict(list)
+        capture_wins = collections.defaultdict(list)
+        
+        # Start with the result of every position that takes, or can't move
+        index = 0
+        piece_count = len(self.letters)
+        for side in (0, 1):
+            for king_square in TABLEBASE_TRIANGLE:
+                for others in itertools.product(range(64),
+                                                repeat=piece_count - 1):
+                    squares = (king_square,) + others
+                    index += 1
+                    occupied = 0
+                    for square in squares:
+                        occupied |= 1 << square
+                    if (bin(occupied).count("1") != piece_count or
+                        self.is_attacked(squares[self.kings[1 - side]], side,
+                                         squares, occupied) or
+                        get_tablebase_index(side, squares,
+                                            self.twin) != index - 1):
+                        continue
+                    self._start_position(index - 1, side, squares, occupied,
+                                         found, capture_wins)
+        
+        # Work back from mates, one ply at a time
+        plies = 0
+        while found or capture_wins:
+            for index in capture_wins.pop(plies, []):
+                if not values[index]:
+                    values[index] = plies + 1
+                    found[plies].append(index)
+            for index in found.pop(plies, []):
+                side, squares = self.decode(index)
+                previous_positions = set(self.get_previous_positions(
+                    side, squares))
+                for previous in previous_positions:
+                    if values[previous]:
+                        continue
+                    if plies % 2 == 0:
+                        # The side to move here loses, so the side that moved
+                        # here wins
+                        values[previous] = plies + 2
+                        found[plies + 1].append(previous)
+                        continue
+                    counts[previous] -= 1
+                    if not counts[previous]:
+                        # Every move loses
+                        loss = max(plies, self.capture_losses.get(previous,
+                                                                  0)) + 1
+                        values[previous] = loss + 1
+                        found[loss].append(previous)
+            plies += 1
+        return values
+    
+    def _start_position(self, index, side, squares, occupied, found,
+                        capture_wins):
+        next_positions = set()
+        can_move = False
+        best_win = longest_loss = None
+        can_draw = False
+        for moved, taken in self.get_moves(side, squares, occupied):
+            can_move = True
+            if taken is None:
+                next_positions.add(get_tablebase_index(1 - side, moved,
+                                                       self.twin))
+                continue
+            outcome, plies = get_tablebase_result(
+                self.get_capture_value(1 - side, moved, taken))
+            if outcome == TABLEBASE_LOSS:
+                if best_win is None or plies + 1 < best_win:
+                    best_win = plies + 1
+            elif outcome == TABLEBASE_WIN:
+                if longest_loss is None or plies > longest_loss:
+                    longest_loss = plies
+            else:
+                can_draw = True
+        
+        if not can_move:
+            if self.is_attacked(squares[self.kings[side]], 1 - side, squares,
+                                occupied):
+                self.values[index] = 1
+                found[0].append(index)
+            return
+        if best_win is not None:
+            capture_wins[best_win].append(index)
+        if longest_loss is not None:
+            self.capture_losses[index] = longest_loss
+        # Taking into a win or a draw means the position can't be lost
+        self.counts[index] = len(next_positions) + (can_draw or
+                                                    best_win is not None)
+        if not self.counts[index]:
+            # Every move takes into a loss
+            self.values[index] = longest_loss + 2
+            found[longest_loss + 1].append(index)
+
+
+def build_tablebase(name, directory=TABLEBASE_DIR):
+    """Work out a tablebase and write it to name + ".tb" in the directory,
+    building any it depends on (for after a capture) first. Returns the
+    tablebase's entries.
+    
+    Each entry is a byte: 0 for a draw, or the plies until mate plus one,
+    for the side to move. See get_tablebase_index for the layout.
+    
+    """
+    subtables = {}
+    split = name.index("K", 1)
+    for slot in range(len(name)):
+        if name[slot] == "K":
+            continue
+        sides = [name[:split], name[split:]]
+        side = int(slot >= split)
+        sides[side] = sides[side][:slot - split * side] + \
+            sides[side][slot - split * side + 1:]
+        subname = get_tablebase_name(sides)[0]
+        if subname is None or subname in subtables:
+            continue
+        path = os.path.join(directory, subname + TABLEBASE_EXTENSION)
+        if os.path.exists(path):
+            with open(path, "rb") as table_file:
+                subtables[subname] = bytearray(table_file.read())
+        else:
+            subtables[subname] = build_tablebase(subname, directory)
+    
+    values = _TablebaseGenerator(name, subtables).generate()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, name + TABLEBASE_EXTENSION),
+              "wb") as table_file:
+        table_file.write(values)
+    return values
+
+
+class Tablebase(object):
+    """Endgame tablebases written by build_tablebase, probed through memory
+    maps. Each file is opened the first time a position needs it.
+    
+    """
+    def __init__(self, directory=TABLEBASE_DIR):
+        self.directory = directory
+        self._tables = {}
+        self._files = []
+    
+    def close(self):
+        for table in self._tables.values():
+            if table:
+                table.close()
+        for table_file in self._files:
+            table_file.close()
+        self._tables = {}
+        self._files = []
+    
+    def _get_table(self, name):
+        """Memory map of the named tablebase, or None if it hasn't been
+        built.
+        
+        """
+        if name not in self._tables:
+            table = None
+            path = os.path.join(self.directory, name + TABLEBASE_EXTENSION)
+            if os.path.exists(path):
+                table_file = open(path, "rb")
+                self._files.append(table_file)
+                if (os.fstat(table_file.fileno()).st_size !=
+                    get_tablebase_size(name)):
+                    raise ValueError("%s is the wrong size" % path)
+                table = mmap.mmap(table_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self._tables[name] = table
+        return self._tables[name]
+    
+    def probe(self, game):
+        """(TABLEBASE_WIN, DRAW or LOSS, plies to mate) for the player to
+        move in the game, or None if the position isn't covered.
+        
+        """
+        if game.get_piece_count() > TABLEBASE_MAX_PIECES:
+            return None
+        if game.get_castling_rights():
+            return None
+        pieces = {WHITE: [], BLACK: []}
+        for piece in game.get_pieces():
+            if piece.__class__ == Pawn:
+                return None
+            letter = PIECE_LETTERS[piece.__class__].upper()
+            pieces[piece.color].append((TABLEBASE_PIECE_ORDER.index(letter),
+                                        letter, piece.pos))
+        for color in pieces:
+            pieces[color].sort()
+        name, swapped = get_tablebase_name(
+            ["".join(letter for order, letter, pos in pieces[color])
+             for color in (WHITE, BLACK)])
+        if name is None:
+            return TABLEBASE_DRAW, 0
+        table = self._get_table(name)
+        if table is None:
+            return None
+        first_color = BLACK if swapped else WHITE
+        squares = [get_square_for_pos(pos) for color in (first_color,
+                                                         not first_color)
+                   for order, letter, pos in pieces[color]]
+        side_to_move = int(game.color_to_move != first_color)
+        return get_tablebase_result(ord(table[get_tablebase_index(
+            side_to_move, squares, get_tablebase_twin(name))]))
+
+
+def check_tablebase_endgame(game):
+    """Raise EndGame if the game's position is in its tablebase, with the
+    result perfect play would reach.
+    
+    """
+    result = game.tablebase.probe(game)
+    if result is None:
+        return
+    outcome, plies = result
+    if outcome == TABLEBASE_DRAW:
+        raise EndGame("Draw (tablebase)")
+    winner = game.color_to_move
+    if outcome == TABLEBASE_LOSS:
+        winner = not winner
+    raise EndGame("%s wins (tablebase: mate in %i)" %
+                  (COLOR_NAMES[winner].title(), (plies + 1) // 2), winner)
+
+
+# Batched move generation. Everything here works on NumPy arrays of
+# bitboards, one element per position, so each operation covers the whole
+# batch at once.
+
+def _build_batch_file_masks():
+    """Bitboards of the squares a shift of dx files can land on without
+    wrapping round the edge of the board, for dx from -2 to 2.
+    
+    """
+    masks = {}
+    for dx in range(-2, 3):
+        bits = 0
+        for square in range(64):
+            if 0 <= square % 8 - dx <= 7:
+                bits |= 1 << square
+        masks[dx] = bits
+    return masks
+
+BATCH_FILE_MASKS = _build_batch_file_masks()
+BATCH_ALL_SQUARES = (1 << 64) - 1
+BATCH_RANKS = [0xff << (rank * 8) for rank in range(8)]
+
+# Planes of a position for machine learning: one per piece kind for White
+# then Black, indexed [plane, rank, file] from a1, then planes filled with
+# ones for White to move and each castling right, and one with the en
+# passant square set
+PIECE_PLANES = 12
+SIDE_TO_MOVE_PLANE = 12
+CASTLING_PLANES = [(13, WHITE_KING_SIDE), (14, WHITE_QUEEN_SIDE),
+                   (15, BLACK_KING_SIDE), (16, BLACK_QUEEN_SIDE)]
+EN_PASSANT_PLANE = 17
+PLANE_COUNT = 18
+
+# Positions to encode at a time in encode_positions
+ENCODE_CHUNK_SIZE = 4096
+
+# Count of set bits in each byte value, for counting squares in bitboards,
+# the shifts that pick out each square's bit, and the bits themselves
+if numpy is not None:
+    BATCH_POPCOUNTS = numpy.array([bin(byte).count("1")
+                                   for byte in range(256)], numpy.uint8)
+    BATCH_SQUARE_SHIFTS = numpy.arange(64, dtype=numpy.uint64)
+    BATCH_SQUARE_BITS = numpy.uint64(1) << BATCH_SQUARE_SHIFTS
+
+def _batch_shift_squares(bits, shift):
+    """Add shift to the square number of every square in the bitboards,
+    dropping squares that go off either end. Files can wrap round.
+    
+    """
+    if shift > 0:
+        return bits << numpy.uint64(shift)
+    elif shift < 0:
+        return bits >> numpy.uint64(-shift)
+    return bits
+
+def _batch_shift(bits, dx, dy):
+    """Move every square in the bitboards dx files and dy ranks, dropping
+    squares that go off the board.
+    
+    """
+    bits = _batch_shift_squares(bits, dx + dy * 8)
+    if dx:
+        bits = bits & numpy.uint64(BATCH_FILE_MASKS[dx])
+    return bits
+
+def _batch_slide(bits, empty, direction):
+    """Squares attacked in one direction by sliders on the squares in bits,
+    up to and including the first occupied square. Uses Kogge-Stone
+    fills: three shifts instead of seven. Masking empty squares against
+    wrapping once up front keeps the fill itself on the board.
+    
+    """
+    dx, dy = direction
+    shift = dx + dy * 8
+    empty = empty & numpy.uint64(BATCH_FILE_MASKS[dx])
+    for step in 1, 2, 4:
+        bits = bits | (empty & _batch_shift_squares(bits, shift * step))
+        empty = empty & _batch_shift_squares(empty, shift * step)
+    return _batch_shift(bits, dx, dy)
+
+def _batch_steps(bits, offsets):
+    """Squares one step away from those in bits, by each of the offsets.
+    
+    """
+    targets = numpy.zeros_like(bits)
+    for dx, dy in offsets:
+        targets |= _batch_shift(bits, dx, dy)
+    return targets
+
+def _batch_pawn_attacks(pawns, white):
+    """Squares attacked by pawns, which go up the board where white is set
+    and down it elsewhere.
+    
+    """
+    return numpy.where(white, _batch_steps(pawns, [UP_LEFT, UP_RIGHT]),
+                       _batch_steps(pawns, [DOWN_LEFT, DOWN_RIGHT]))
+
+def _batch_attacks(pieces, white, occupied):
+    """Squares attacked by each position's pieces. pieces is an (N, 6)
+    array of one side's bitboards, by kind.
+    
+    """
+    empty = ~occupied
+    attacks = (_batch_pawn_attacks(pieces[:, PAWN_KIND], white) |
+               _batch_steps(pieces[:, KNIGHT_KIND], KNIGHT_OFFSETS) |
+               _batch_steps(pieces[:, KING_KIND], ALL_DIRECTIONS))
+    queens = pieces[:, QUEEN_KIND]
+    for directions, sliders in (
+            (DIAGONAL_DIRECTIONS, pieces[:, BISHOP_KIND] | queens),
+            (STRAIGHT_DIRECTIONS, pieces[:, ROOK_KIND] | queens)):
+        for direction in directions:
+            attacks |= _batch_slide(sliders, empty, direction)
+    return attacks
+
+def batch_popcount(bits):
+    """Number of squares in each bitboard of a uint64 array.
+    
+    """
+    bits = numpy.ascontiguousarray(bits, numpy.uint64)
+    return BATCH_POPCOUNTS[bits.view(numpy.uint8)].reshape(
+        bits.shape + (8,)).sum(axis=-1, dtype=numpy.int64)
+
+def _batch_square_numbers(bits):
+    """Square number of the single square in each bitboard.
+    
+    """
+    return batch_popcount(bits - numpy.uint64(1))
+
+
+class PositionBatch(object):
+    """Many positions held as NumPy arrays, so that move counts, attack maps
+    and checks can be worked out for all of them at once with whole-array
+    bit operations. Needs NumPy.
+    
+    bitboards is an (N, 12) uint64 array: White's pieces by kind
+    (PAWN_KIND to KING_KIND), then Black's. white_to_move is an (N,) bool
+    array, castling an (N,) array of WHITE_KING_SIDE etc. masks, and
+    en_passant an (N,) array of en passant square numbers, -1 for none.
+    
+    Counts agree with the games' get_valid_moves: legal counts with
+    get_valid_moves(color), pseudo-legal ones with testing_check=True.
+    
+    """
+    def __init__(self, bitboards, white_to_move, castling, en_passant):
+        if numpy is None:
+            raise RuntimeError("PositionBatch needs NumPy")
+        self.bitboards = numpy.asarray(bitboards, numpy.uint64)
+        self.white_to_move = numpy.asarray(white_to_move, bool)
+        self.castling = numpy.asarray(castling, numpy.uint8)
+        self.en_passant = numpy.asarray(en_passant, numpy.int8)
+    
+    @classmethod
+    def empty(cls, count):
+        """A batch of count empty boards, for set_position to fill in.
+        
+        """
+        if numpy is None:
+            raise RuntimeError("PositionBatch needs NumPy")
+        return cls(numpy.zeros((count, 12), numpy.uint64),
+                   numpy.zeros(count, bool), numpy.zeros(count, numpy.uint8),
+                   numpy.full(count, -1, numpy.int8))
+    
+    @classmethod
+    def from_games(cls, games):
+        """A batch of the current positions of a sequence of games, of
+        either backend.
+        
+        """
+        batch = cls.empty(len(games))
+        for index, game in enumerate(games):
+            batch.set_position(index, game)
+        return batch
+    
+    def set_position(self, index, game):
+        """Replace the position at index with the game's current one.
+        
+        """
+        game.get_bitboards(self.bitboards[index])
+        self.white_to_move[index] = game.color_to_move == WHITE
+        self.castling[index] = game.get_castling_rights()
+        if game.en_passant_pos:
+            self.en_passant[index] = get_square_for_pos(game.en_passant_pos)
+        else:
+            self.en_passant[index] = -1
+    
+    def __len__(self):
+        return len(self.bitboards)
+    
+    def to_planes(self, out=None):
+        """The positions as an (N, PLANE_COUNT, 8, 8) array of planes (see
+        PIECE_PLANES etc.), written to out if given, or else a new uint8
+        array.
+        
+        """
+        count = len(self)
+        if out is None:
+            out = numpy.empty((count, PLANE_COUNT, 8, 8), numpy.uint8)
+        out[:, :PIECE_PLANES] = (
+            (self.bitboards[:, :, None] >> BATCH_SQUARE_SHIFTS) &
+            numpy.uint64(1)).reshape(count, PIECE_PLANES, 8, 8)
+        out[:, SIDE_TO_MOVE_PLANE] = self.white_to_move[:, None, None]
+        for plane, right in CASTLING_PLANES:
+            out[:, plane] = ((self.castling & right) != 0)[:, None, None]
+        out[:, EN_PASSANT_PLANE] = 0
+        rows = numpy.nonzero(self.en_passant >= 0)[0]
+        squares = self.en_passant[rows]
+        out[rows, EN_PASSANT_PLANE, squares // 8, squares % 8] = 1
+        return out
+    
+    def _get_white(self, color):
+        """(N,) bool array of which positions the given colour (or the side
+        to move, for None) is White in.
+        
+        """
+        if color is None:
+            return self.white_to_move
+        return numpy.full(len(self), color == WHITE, bool)
+    
+    def _get_sides(self, white):
+        """(N, 6) arrays of the bitboards for one side, and the other.
+        
+        """
+        white = white[:, None]
+        return (numpy.where(white, self.bitboards[:, :6],
+                            self.bitboards[:, 6:]),
+                numpy.where(white, self.bitboards[:, 6:],
+                            self.bitboards[:, :6]))
+    
+    def get_attacks(self, color=None):
+        """Bitboards of the squares the given colour (by default the side to
+        move) attacks in each position, including squares its own pieces
+        are on.
+        
+        """
+        white = self._get_white(color)
+        own, enemy = self._get_sides(white)
+        occupied = (numpy.bitwise_or.reduce(own, axis=1) |
+                    numpy.bitwise_or.reduce(enemy, axis=1))
+        return _batch_attacks(own, white, occupied)
+    
+    def in_check(self, color=None):
+        """(N,) bool array of whether the given colour (by default the side
+        to move) is in check in each position.
+        
+        """
+        white = self._get_white(color)
+        own, enemy = self._get_sides(white)
+        occupied = (numpy.bitwise_or.reduce(own, axis=1) |
+                    numpy.bitwise_or.reduce(enemy, axis=1))
+        return (_batch_attacks(enemy, ~white, occupied) &
+                own[:, KING_KIND]) != 0
+    
+    def get_move_masks(self, color=None, legal=True):
+        """The moves for the given colour (by default the side to move) in
+        each position, as an (N, 64) uint64 array of target squares for the
+        piece on each square. Pawns moving to the far rank have one target
+        for all four promotions. Without legal, moves are pseudo-legal: they
+        may leave the King in check, and castling is left out.
+        
+        """
+        return self._generate(self._get_white(color), legal)[0]
+    
+    def count_moves(self, color=None, legal=True):
+        """(N,) array of the number of moves the given colour (by default the
+        side to move) has in each position, counting each promotion
+        separately. See get_move_masks.
+        
+        """
+        return self._count_moves(self._get_white(color), legal)
+    
+    def get_mobility(self):
+        """(N,) array of how many more pseudo-legal moves the side to move has
+        than the other side, in each position.
+        
+        """
+        return (self._count_moves(self.white_to_move, False) -
+                self._count_moves(~self.white_to_move, False))
+    
+    def _count_moves(self, white, legal):
+        masks, promotions = self._generate(white, legal)
+        return batch_popcount(masks).sum(axis=1) + promotions * 3
+    
+    def _generate(self, white, legal):
+        """Move masks (see get_move_masks) and the number of moves to the far
+        rank by pawns, for the side that's White where white is set.
+        
+        """
+        count = len(self)
+        all_squares = numpy.uint64(BATCH_ALL_SQUARES)
+        nothing = numpy.uint64(0)
+        own, enemy = self._get_sides(white)
+        own_all = numpy.bitwise_or.reduce(own, axis=1)
+        enemy_all = numpy.bitwise_or.reduce(enemy, axis=1)
+        occupied = own_all | enemy_all
+        empty = ~occupied
+        king = own[:, KING_KIND]
+        
+        check_mask = numpy.full(count, BATCH_ALL_SQUARES, numpy.uint64)
+        pins = []
+        if legal:
+            # Pieces giving check, and for each direction from the King, an
+            # own piece pinned along it and the squares it can move to
+            checkers = ((_batch_steps(king, KNIGHT_OFFSETS) &
+                         enemy[:, KNIGHT_KIND]) |
+                        (_batch_pawn_attacks(king, white) &
+                         enemy[:, PAWN_KIND]))
+            blocking_squares = numpy.zeros(count, numpy.uint64)
+            queens = enemy[:, QUEEN_KIND]
+            for directions, sliders in (
+                    (DIAGONAL_DIRECTIONS, enemy[:, BISHOP_KIND] | queens),
+                    (STRAIGHT_DIRECTIONS, enemy[:, ROOK_KIND] | queens)):
+                for direction in directions:
+                    ray = _batch_slide(king, empty, direction)
+                    checker = ray & sliders
+                    checkers |= checker
+                    blocking_squares |= numpy.where(checker != 0, ray,
+                                                    nothing)
+                    blocker = ray & own_all
+                    through = _batch_slide(king, empty | blocker, direction)
+                    pinned = numpy.where((through & sliders) != 0, blocker,
+                                         nothing)
+                    if pinned.any():
+                        pins.append((pinned, through))
+            checker_count = batch_popcount(checkers)
+            check_mask = numpy.where(
+                checker_count == 0, all_squares,
+                numpy.where(checker_count == 1, checkers | blocking_squares,
+                            nothing))
+        
+        # Pieces other than the King, a square at a time so each piece's
+        # moves are kept apart
+        masks = numpy.zeros((count, 64), numpy.uint64)
+        promotions = numpy.zeros(count, numpy.int64)
+        far_rank = numpy.where(white, numpy.uint64(BATCH_RANKS[7]),
+                               numpy.uint64(BATCH_RANKS[0]))
+        double_rank = numpy.where(white, numpy.uint64(BATCH_RANKS[2]),
+                                  numpy.uint64(BATCH_RANKS[5]))
+        diagonal_sliders = own[:, BISHOP_KIND] | own[:, QUEEN_KIND]
+        straight_sliders = own[:, ROOK_KIND] | own[:, QUEEN_KIND]
+        movers = own_all & ~king
+        for square in range(64):
+            bit = numpy.uint64(1 << square)
+            if not (movers & bit).any():
+                continue
+            targets = _batch_steps(own[:, KNIGHT_KIND] & bit, KNIGHT_OFFSETS)
+            for directions, sliders in (
+                    (DIAGONAL_DIRECTIONS, diagonal_sliders & bit),
+                    (STRAIGHT_DIRECTIONS, straight_sliders & bit)):
+                if sliders.any():
+                    for direction in directions:
+                        targets |= _batch_slide(sliders, empty, direction)
+            targets &= ~own_all
+            pawns = own[:, PAWN_KIND] & bit
+            if pawns.any():
+                single = numpy.where(white, pawns << numpy.uint64(8),
+                                     pawns >> numpy.uint64(8)) & empty
+                double = numpy.where(white,
+                                     (single & double_rank) <<
+                                     numpy.uint64(8),
+                                     (single & double_rank) >>
+                                     numpy.uint64(8)) & empty
+                targets |= (single | double |
+                            (_batch_pawn_attacks(pawns, white) & enemy_all))
+            if legal:
+                targets &= check_mask
+                for pinned, through in pins:
+                    targets = numpy.where((pinned & bit) != 0,
+                                          targets & through, targets)
+            masks[:, square] = targets
+            if pawns.any():
+                promotions += batch_popcount(
+                    numpy.where(pawns != 0, targets & far_rank, nothing))
+        
+        self._add_king_moves(masks, white, own, enemy, occupied, legal)
+        self._add_en_passant(masks, white, own, enemy, occupied, legal)
+        return masks, promotions
+    
+    def _add_king_moves(self, masks, white, own, enemy, occupied, legal):
+        """Add the King's moves to the move masks, with castling if legal.
+        
+        """
+        king = own[:, KING_KIND]
+        own_all = numpy.bitwise_or.reduce(own, axis=1)
+        targets = _batch_steps(king, ALL_DIRECTIONS) & ~own_all
+        if legal:
+            # Squares the King can't go to, looking through where it is now
+            danger = _batch_attacks(enemy, ~white, occupied ^ king)
+            targets &= ~danger
+            
+            # Castling: the squares between empty, and the King not in
+            # check or passing through or landing on an attacked square
+            for right, rank, between, path, to in (
+                    (WHITE_KING_SIDE, 0, (5, 6), (4, 5, 6), 6),
+                    (WHITE_QUEEN_SIDE, 0, (1, 2, 3), (4, 3, 2), 2),
+                    (BLACK_KING_SIDE, 7, (5, 6), (4, 5, 6), 6),
+                    (BLACK_QUEEN_SIDE, 7, (1, 2, 3), (4, 3, 2), 2)):
+                between_bits = sum(1 << (x + rank * 8) for x in between)
+                path_bits = sum(1 << (x + rank * 8) for x in path)
+                allowed = (((self.castling & right) != 0) &
+                           (white == (rank == 0)) &
+                           ((occupied & numpy.uint64(between_bits)) == 0) &
+                           ((danger & numpy.uint64(path_bits)) == 0))
+                targets |= numpy.where(allowed,
+                                       numpy.uint64(1 << (to + rank * 8)),
+                                       numpy.uint64(0))
+        rows = numpy.nonzero(king)[0]
+        masks[rows, _batch_square_numbers(king[rows])] |= targets[rows]
+    
+    def _add_en_passant(self, masks, white, own, enemy, occupied, legal):
+        """Add en passant captures to the move masks. Only the side that didn't
+        just move a pawn two squares can take.
+        
+        """
+        has_en_passant = ((self.en_passant >= 0) &
+                          ((self.en_passant // 8 == 5) == white))
+        if not has_en_passant.any():
+            return
+        target = numpy.where(
+            has_en_passant,
+            numpy.left_shift(numpy.uint64(1),
+                             numpy.maximum(self.en_passant, 0).astype(
+                                 numpy.uint64)),
+            numpy.uint64(0))
+        taken = numpy.where(white, target >> numpy.uint64(8),
+                            target << numpy.uint64(8))
+        king = own[:, KING_KIND]
+        for dx in -1, 1:
+            # The pawn that could take, beside the one that can be taken
+            pawn = _batch_shift(taken, dx, 0) & own[:, PAWN_KIND]
+            allowed = pawn != 0
+            if legal:
+                # Play it out and see if the King is attacked afterwards:
+                # it can take the pawn giving check, or uncover a check
+                # along the rank that isn't a simple pin
+                after = occupied ^ pawn ^ taken ^ target
+                empty = ~after
+                enemy_pawns = enemy[:, PAWN_KIND] & ~taken
+                attacked = ((_batch_steps(king, KNIGHT_OFFSETS) &
+                             enemy[:, KNIGHT_KIND]) |
+                            (_batch_pawn_attacks(king, white) &
+                             enemy_pawns) |
+                            (_batch_steps(king, ALL_DIRECTIONS) &
+                             enemy[:, KING_KIND]))
+                queens = enemy[:, QUEEN_KIND]
+                for directions, sliders in (
+                        (DIAGONAL_DIRECTIONS, enemy[:, BISHOP_KIND] | queens),
+                        (STRAIGHT_DIRECTIONS, enemy[:, ROOK_KIND] | queens)):
+                    for direction in directions:
+                        attacked |= _batch_slide(king, empty,
+                                                 direction) & sliders
+                allowed &= attacked == 0
+            rows = numpy.nonzero(allowed)[0]
+            masks[rows, _batch_square_numbers(pawn[rows])] |= target[rows]
+
+
+def encode_positions(games, out=None, count=None,
+                     chunk_size=ENCODE_CHUNK_SIZE):
+    """Write the planes of each game's position (see PositionBatch.to_planes)
+    into out, an (N, PLANE_COUNT, 8, 8) NumPy array of any number type, a
+    chunk of games at a time. out can be memory-mapped (see
+    open_planes_file) to write more positions than fit in memory. Returns
+    out, or the part of it written if there were fewer games than rows.
+    
+    With no out, the planes go in a new uint8 array of count rows (by
+    default, as many as there are games, if games is a sequence), or one
+    that doubles in size as it fills if the number of games isn't known.
+    
+    Raises ValueError if there are more games than out has rows.
+    
+    """
+    if numpy is None:
+        raise RuntimeError("encode_positions needs NumPy")
+    grow = False
+    if out is None:
+        if count is None and hasattr(games, "__len__"):
+            count = len(games)
+        grow = count is None
+        out = numpy.empty((chunk_size if grow else count, PLANE_COUNT, 8, 8),
+                          numpy.uint8)
+    # Every chunk is set in the same batch, so nothing is allocated per game
+    batch_size = max(min(chunk_size, len(out)), 1)
+    batch = PositionBatch.empty(batch_size)
+    start = filled = 0
+    for game in games:
+        batch.set_position(filled, game)
+        filled += 1
+        if filled == batch_size:
+            out = _write_batch_planes(batch, filled, out, start, grow)
+            start += filled
+            filled = 0
+    if filled:
+        out = _write_batch_planes(batch, filled, out, start, grow)
+        start += filled
+    return out[:start]
+
+def _write_batch_planes(batch, count, out, start, grow):
+    """Write the planes of the first count positions in the batch into out
+    from row start, for encode_positions. If out is too small, a copy twice
+    the size is made if grow is set, or else ValueError is raised. Returns
+    out.
+    
+    """
+    if start + count > len(out):
+        if not grow:
+            raise ValueError("More than %i positions to encode" % len(out))
+        grown = numpy.empty((len(out) * 2,) + out.shape[1:], out.dtype)
+        grown[:start] = out[:start]
+        out = grown
+    if count < len(batch):
+        batch = PositionBatch(batch.bitboards[:count],
+                              batch.white_to_move[:count],
+                              batch.castling[:count],
+                              batch.en_passant[:count])
+    batch.to_planes(out[start:start + count])
+    return out
+
+def get_position_planes(game, out=None):
+    """The planes of the game's position, as a (PLANE_COUNT, 8, 8) array, for
+    the backends' to_planes.
+    
+    """
+    if numpy is None:
+        raise RuntimeError("to_planes needs NumPy")
+    return encode_positions([game], None if out is None else out[None])[0]
+
+def open_planes_file(path, count, dtype="uint8"):
+    """Create a .npy file of planes for count positions, memory-mapped for
+    encode_positions to write to.
+    
+    """
+    return numpy.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                        shape=(count, PLANE_COUNT, 8, 8))
+
+def run_pgn_replay(path, backend):
+    """Replay every game in a PGN file, printing how many games and moves
+    were read and how fast. Returns the number of games that couldn't be
+    replayed.
+    
+    """
+    games = moves = errors = 0
+    start_time = time.time()
+    for headers, san_moves in read_pgn_file(path):
+        try:
+            replay_pgn_game(headers, san_moves, GAME_BACKENDS[backend])
+        except ValueError as e:
+            errors += 1
+            print "Game %i: %s" % (games + 1, e)
+        games += 1
+        moves += len(san_moves)
+    elapsed = max(time.time() - start_time, 1e-6)
+    print "Games: %i (%i couldn't be replayed)" % (games, errors)
+    print "Moves: %i" % moves
+    print "Time: %.2fs (%i games/s, %i moves/s)" % (elapsed, games / elapsed,
+                                                   moves / elapsed)
+    return errors
+
+def run_perft(game, depth):
+    """Print perft for the game split by first move, with the total and the
+    speed.
+    
+    """
+    start_time = time.time()
+    counts = game.divide(depth)
+    elapsed = time.time() - start_time
+    for move_string, count in sorted((get_move_string(move), count)
+                                     for move, count in counts):
+        print "%s: %i" % (move_string, count)
+    nodes = sum(count for move, count in counts)
+    print
+    print "Nodes: %i" % nodes
+    print "Time: %.2fs (%i nodes/s)" % (elapsed, nodes / max(elapsed, 1e-6))
+
+def get_perft_suite_depth(known_counts, depth=None):
+    """Depth to search a perft suite position to: the given depth if its
+    known counts go that far, or else as deep as they go while staying under
+    PERFT_SUITE_NODES.
+    
+    """
+    if depth:
+        return min(depth, len(known_counts))
+    position_depth = 1
+    while (position_depth < len(known_counts) and
+           known_counts[position_depth] <= PERFT_SUITE_NODES):
+        position_depth += 1
+    return position_depth
+
+def run_perft_suite(backend, depth=None, save_timings=False,
+                    timings_path=PERFT_TIMINGS_PATH):
+    """Check move generation against the standard perft positions.
+    
+    Each position is searched to the given depth, or as deep as its known
+    counts go while staying under PERFT_SUITE_NODES. Speeds are compared
+    with those stored in timings_path by an earlier run with save_timings,
+    and anything more than PERFT_TOLERANCE slower counts as a failure.
+    Returns True if everything passed.
+    
+    """
+    timings = {}
+    if os.path.exists(timings_path):
+        with open(timings_path) as timings_file:
+            timings = json.load(timings_file)
+    backend_timings = timings.setdefault(backend, {})
+    
+    passed = True
+    print "Backend: %s" % backend
+    for name, fen, known_counts in PERFT_POSITIONS:
+        position_depth = get_perft_suite_depth(known_counts, depth)
+        game = GAME_BACKENDS[backend].from_fen(fen)
+        start_time = time.time()
+        nodes = game.perft(position_depth)
+        elapsed = max(time.time() - start_time, 1e-6)
+        nodes_per_second = int(nodes / elapsed)
+        
+        # Check the count, then the speed against the stored timing
+        if nodes != known_counts[position_depth - 1]:
+            result = "FAILED (expected %i)" % known_counts[position_depth - 1]
+            passed = False
+        else:
+            result = "ok"
+            stored = backend_timings.get(name)
+            if stored and stored["depth"] == position_depth:
+                slowest = stored["nodes_per_second"] * (1 - PERFT_TOLERANCE)
+                if nodes_per_second < slowest:
+                    result = ("SLOWER (stored %i nodes/s)" %
+                              stored["nodes_per_second"])
+                    passed = False
+        print "%-18s depth %i %9i nodes %7.2fs %8i nodes/s  %s" % (
+            name, position_depth, nodes, elapsed, nodes_per_second, result)
+        
+        if save_timings:
+            backend_timings[name] = {"depth": position_depth,
+                                     "nodes_per_second": nodes_per_second}
+    
+    if save_timings:
+        with open(timings_path, "w") as timings_file:
+            json.dump(timings, timings_file, indent=2, sort_keys=True)
+        print "Saved timings to %s" % timings_path
+    return passed
+
+def run_perft_comparison(depth=None, fen=None, path=None):
+    """Run perft on every backend and check they agree, move by move.
+    
+    The positions are the FEN given, the FENs in the file at path, or the
+    perft suite. Suite positions are searched as deep as run_perft_suite
+    would; others to the given depth (default 3). Prints each backend's
+    time, and the first moves whose counts differ. Returns True if all
+    counts agree.
+    
+    """
+    if fen:
+        positions = [("fen", fen, None)]
+    elif path:
+        positions = [("position %i" % number, game.to_fen(), None)
+                     for number, game in enumerate(read_fen_file(path), 1)]
+    else:
+        positions = PERFT_POSITIONS
+    backends = sorted(GAME_BACKENDS)
+    print "Comparing backends: %s" % ", ".join(backends)
+    passed = True
+    for name, position_fen, known_counts in positions:
+        if known_counts:
+            position_depth = get_perft_suite_depth(known_counts, depth)
+        else:
+            position_depth = depth or 3
+        results = []
+        for backend in backends:
+            game = GAME_BACKENDS[backend].from_fen(position_fen)
+            start_time = time.time()
+            counts = dict((get_move_string(move), count)
+                          for move, count in game.divide(position_depth))
+            results.append((counts, time.time() - start_time))
+        move_strings = set()
+        for counts, elapsed in results:
+            move_strings.update(counts)
+        different = sorted(move_string for move_string in move_strings
+                           if len(set(counts.get(move_string) for
+                                      counts, elapsed in results)) > 1)
+        if different:
+            result = "DIFFERENT after %s" % ", ".join(different)
+            passed = False
+        else:
+            result = "ok"
+        print "%-18s depth %i %9i nodes  %s  %s" % (
+            name, position_depth, sum(results[0][0].values()),
+            "  ".join("%s %6.2fs" % (backend, elapsed) for backend, (
+                counts, elapsed) in zip(backends, results)),
+            result)
+    return passed
 
+def get_check_positions(backend, games=CHECK_GAMES, seed=0):
+    """Generate the positions check mode tests: the perft suite's, then
+    every position along some seeded random games.
+    
+    Each is yielded as a game of the given backend, which the caller may
+    make moves in as long as it takes them back.
+    
+    """
+    game_class = GAME_BACKENDS[backend]
+    for name, fen, known_counts in PERFT_POSITIONS:
+        yield game_class.from_fen(fen)
+    choices = random.Random(seed)
+    for game_number in range(games):
+        game = game_class()
+        for ply in range(CHECK_MAX_PLIES):
+            yield game
+            moves = game.get_valid_moves(game.color_to_move)
+            if not moves:
+                break
+            game.make_move(choices.choice(moves))
 
-def get_coords_for_grid_ref(grid_ref):
-    """Convert traditional coordinates to our coordinates.
+def check_fen(backend):
+    """Check that every check position's FEN loads back into the same
+    position: the same FEN, zobrist key and legal moves. Returns a
+    description of the first failure, or None.
+    
+    """
+    game_class = GAME_BACKENDS[backend]
+    for game in get_check_positions(backend):
+        fen = game.to_fen()
+        try:
+            loaded = game_class.from_fen(fen)
+        except ValueError as e:
+            return str(e)
+        color = game.color_to_move
+        if loaded.to_fen() != fen:
+            return "%s reloads as %s" % (fen, loaded.to_fen())
+        if loaded.zobrist_key != game.zobrist_key:
+            return "%s reloads with a different zobrist key" % fen
+        if (sorted(get_move_string(move) for move in
+                   loaded.get_valid_moves(color)) !=
+            sorted(get_move_string(move) for move in
+                   game.get_valid_moves(color))):
+            return "%s reloads with different legal moves" % fen
+    return None
 
-    e.g. A1 -> (0, 0)
-         H8 -> (7, 7)
+def check_pgn(backend):
+    """Check that SAN and PGN round trip: every legal move in every check
+    position reads back from its SAN as the same move, and random games
+    from the start and the perft suite positions, written as PGN, read back
+    with the same moves and final position. Returns a description of the
+    first failure, or None.
+    
+    """
+    game_class = GAME_BACKENDS[backend]
+    for game in get_check_positions(backend):
+        for move in game.get_valid_moves(game.color_to_move):
+            san = get_san(game, move)
+            try:
+                read_move = get_move_for_san(game, san)
+            except ValueError as e:
+                return str(e)
+            if read_move != move:
+                return "%s in %s reads back as %s, not %s" % (
+                    san, game.to_fen(), get_move_string(read_move),
+                    get_move_string(move))
+    
+    choices = random.Random(0)
+    fens = ([None] * CHECK_GAMES +
+            [fen for name, fen, known_counts in PERFT_POSITIONS])
+    written = []
+    handle, path = tempfile.mkstemp(suffix=".pgn")
+    try:
+        with os.fdopen(handle, "w") as pgn_file:
+            for fen in fens:
+                headers = {"Event": "check"}
+                if fen:
+                    game = game_class.from_fen(fen)
+                    headers.update(SetUp="1", FEN=fen)
+                else:
+                    game = game_class()
+                first_move_number = game.fullmove_number
+                black_first = game.color_to_move == BLACK
+                san_moves = []
+                for ply in range(CHECK_MAX_PLIES):
+                    moves = game.get_valid_moves(game.color_to_move)
+                    if not moves:
+                        break
+                    move = choices.choice(moves)
+                    san_moves.append(get_san(game, move))
+                    game.make_move(move)
+                written.append((san_moves, game.to_fen()))
+                pgn_file.write(get_pgn(headers, san_moves, "*",
+                                       first_move_number, black_first))
+        read_games = list(read_pgn_file(path))
+    finally:
+        os.remove(path)
+    if len(read_games) != len(written):
+        return "wrote %i games and read back %i" % (len(written),
+                                                    len(read_games))
+    for number, ((headers, san_moves), (written_moves, fen)) in enumerate(
+            zip(read_games, written), 1):
+        if san_moves != written_moves:
+            return "game %i reads back with different moves" % number
+        try:
+            game = replay_pgn_game(headers, san_moves, game_class)
+        except ValueError as e:
+            return "game %i: %s" % (number, e)
+        if game.to_fen() != fen:
+            return "game %i replays to %s, not %s" % (number, game.to_fen(),
+                                                      fen)
+    return None
 
+def check_book(backend):
+    """Check opening book lookups. A book is built from some seeded random
+    games, and every position in their first BOOK_MAX_PLIES moves must look
+    up exactly the moves played from it, with their summed weights. The perft
+    suite positions other than the start must not be found. Returns a
+    description of the first failure, or None.
+    
     """
-    x_for_file = {"A": 0, "B": 1, "C": 2, "D": 3, "E": 4, "F": 5, "G": 6,
-                  "H": 7}
-    y_for_rank = {"1": 0, "2": 1, "3": 2, "4": 3, "5": 4, "6": 5, "7": 6,
-                  "8": 7}
-    file_letter = grid_ref[0]
-    rank_number = grid_ref[1]
-    return (x_for_file[file_letter], y_for_rank[rank_number])
+    game_class = GAME_BACKENDS[backend]
+    choices = random.Random(0)
+    results = ["1-0", "0-1", "1/2-1/2"]
+    games = []
+    expected = collections.defaultdict(collections.Counter)
+    for game_number in range(CHECK_GAMES):
+        result = results[game_number % len(results)]
+        game = game_class()
+        san_moves = []
+        for ply in range(BOOK_MAX_PLIES):
+            moves = game.get_valid_moves(game.color_to_move)
+            if not moves:
+                break
+            move = choices.choice(moves)
+            expected[game.zobrist_key][get_move_string(move)] += \
+                BOOK_RESULT_WEIGHTS[result][game.color_to_move]
+            san_moves.append(get_san(game, move))
+            game.make_move(move)
+        games.append(({"Result": result}, san_moves))
+    
+    handle, path = tempfile.mkstemp(suffix=".book")
+    os.close(handle)
+    try:
+        build_opening_book(games, path, game_class=game_class)
+        book = OpeningBook(path)
+        try:
+            for number, (headers, san_moves) in enumerate(games, 1):
+                game = game_class()
+                for san in san_moves:
+                    found = dict((get_move_string(move), weight) for
+                                 move, weight in book.get_moves(game))
+                    wanted = dict((move_string, weight) for
+                                  move_string, weight in
+                                  expected[game.zobrist_key].items()
+                                  if weight)
+                    if found != wanted:
+                        return "game %i, %s: book has %s, not %s" % (
+                            number, game.to_fen(), sorted(found.items()),
+                            sorted(wanted.items()))
+                    game.make_move(get_move_for_san(game, san))
+            for name, fen, known_counts in PERFT_POSITIONS:
+                game = game_class.from_fen(fen)
+                if game.zobrist_key not in expected and book.get_moves(game):
+                    return "%s isn't in the book's games, but has moves" % (
+                        name)
+        finally:
+            book.close()
+    finally:
+        os.remove(path)
+    return None
 
-def get_grid_ref_for_pos(coords):
-    """Convert traditional coordinates to our coordinates.
+def check_tablebase(backend):
+    """Check the tablebases: CHECK_TABLEBASES are built in a temporary
+    directory, their longest mates must be the known ones, and each of
+    CHECK_TABLEBASE_POSITIONS must probe as expected. Returns a description
+    of the first failure, or None.
+    
+    """
+    game_class = GAME_BACKENDS[backend]
+    directory = tempfile.mkdtemp()
+    tablebase = Tablebase(directory)
+    try:
+        for name, longest in CHECK_TABLEBASES:
+            values = build_tablebase(name, directory)
+            found = max(get_tablebase_result(value)[1] for value in values)
+            if found != longest:
+                return "%s's longest mate is %i plies, not %i" % (
+                    name, found, longest)
+        for fen, expected in CHECK_TABLEBASE_POSITIONS:
+            result = tablebase.probe(game_class.from_fen(fen))
+            if result != expected:
+                return "%s probes as %s, not %s" % (fen, result, expected)
+    finally:
+        tablebase.close()
+        shutil.rmtree(directory)
+    return None
 
-    e.g. A1 -> (0, 0)
-         H8 -> (7, 7)
+def check_scores(backend):
+    """Check that the running piece-square scores match compute_scores in
+    every check position, after each of its legal moves, and once the move
+    is taken back. Returns a description of the first failure, or None.
+    
+    """
+    for game in get_check_positions(backend):
+        fen = game.to_fen()
+        scores = game.compute_scores()
+        if game.scores != scores:
+            return "%s has running scores %r, not %r" % (fen, game.scores,
+                                                        scores)
+        for move in game.get_valid_moves(game.color_to_move):
+            move_string = get_move_string(move)
+            undo = game.make_move(move)
+            try:
+                if game.scores != game.compute_scores():
+                    return "%s after %s has running scores %r, not %r" % (
+                        fen, move_string, game.scores,
+                        game.compute_scores())
+            finally:
+                game.unmake_move(undo)
+            if game.scores != scores:
+                return "%s has running scores %r after taking back %s" % (
+                    fen, game.scores, move_string)
+    return None
 
+def check_batch(backend):
+    """Check a PositionBatch of every check position against the games: its
+    legal and pseudo-legal move counts, and whether the side to move is in
+    check. Returns a description of the first failure, or None.
+    
     """
-    files = ["A", "B", "C", "D", "E", "F", "G", "H"]
-    ranks = ["1", "2", "3", "4", "5", "6", "7", "8"]
-    return (files[coords[0]] + ranks[coords[1]])
+    game_class = GAME_BACKENDS[backend]
+    games = []
+    expected = []
+    for game in get_check_positions(backend):
+        color = game.color_to_move
+        games.append(game_class.from_fen(game.to_fen()))
+        expected.append(
+            (len(game.get_valid_moves(color)),
+             len(game.get_valid_moves(color, testing_check=True)),
+             game.in_check(color)))
+    batch = PositionBatch.from_games(games)
+    results = zip(batch.count_moves(), batch.count_moves(legal=False),
+                  batch.in_check())
+    for game, counts, batch_counts in zip(games, expected, results):
+        if tuple(batch_counts) != counts:
+            return ("%s: the batch has %i legal and %i pseudo-legal moves "
+                    "and in check %s, not %i, %i and %s" % (
+                        (game.to_fen(),) + tuple(batch_counts) + counts))
+    return None
 
-def draw_game(game, selected_piece=None):
-    """Print a string that represents the current game state.
+def check_planes(backend):
+    """Check that each check position's planes, from to_planes and from
+    encode_positions, both growing its own array and writing into a given
+    one a few positions at a time, are the ones its pieces, side to move,
+    castling rights and en passant square should give. Returns a
+    description of the first failure, or None.
     
-    Uses ANSI color codes to make it readable - game isn't playable without
-    color support in the terminal.
+    """
+    game_class = GAME_BACKENDS[backend]
+    games = []
+    expected = []
+    for game in get_check_positions(backend):
+        planes = numpy.zeros((PLANE_COUNT, 8, 8), numpy.uint8)
+        for piece in game.get_pieces():
+            planes[(0 if piece.color == WHITE else 6) +
+                   KINDS[piece.__class__], piece.pos[1], piece.pos[0]] = 1
+        if game.color_to_move == WHITE:
+            planes[SIDE_TO_MOVE_PLANE] = 1
+        for plane, right in CASTLING_PLANES:
+            if game.get_castling_rights() & right:
+                planes[plane] = 1
+        if game.en_passant_pos:
+            x, y = game.en_passant_pos
+            planes[EN_PASSANT_PLANE, y, x] = 1
+        if not numpy.array_equal(game.to_planes(), planes):
+            return "%s has the wrong planes from to_planes" % game.to_fen()
+        games.append(game_class.from_fen(game.to_fen()))
+        expected.append(planes)
+    
+    # The positions go straight from the generator, so their number isn't
+    # known up front
+    encoded = [("a growing array", encode_positions(
+                    get_check_positions(backend), chunk_size=100)),
+               ("an int16 array", encode_positions(
+                    games, numpy.zeros((len(games), PLANE_COUNT, 8, 8),
+                                       numpy.int16), chunk_size=7))]
+    for name, planes in encoded:
+        if len(planes) != len(games):
+            return "encode_positions wrote %i positions into %s, not %i" % (
+                len(planes), name, len(games))
+        for game, game_planes, expected_planes in zip(games, planes,
+                                                      expected):
+            if not numpy.array_equal(game_planes, expected_planes):
+                return ("%s has the wrong planes from encode_positions "
+                        "into %s" % (game.to_fen(), name))
+    return None
+
+def run_checks():
+    """Run every check on every backend, printing the results. Returns
+    True if they all passed.
     
     """
-    # Get a string for each rank
-    rank_strings = []
+    # Each check, and whether it needs NumPy
+    checks = [("FEN round trip", check_fen, False),
+              ("SAN/PGN round trip", check_pgn, False),
+              ("opening book", check_book, False),
+              ("tablebase probes", check_tablebase, False),
+              ("running scores", check_scores, False),
+              ("batch move counts", check_batch, True),
+              ("position planes", check_planes, True)]
+    passed = True
+    for name, check, needs_numpy in checks:
+        for backend in sorted(GAME_BACKENDS):
+            if needs_numpy and numpy is None:
+                print "%-18s %-8s skipped: needs NumPy" % (name, backend)
+                continue
+            failure = check(backend)
+            if failure:
+                passed = False
+            print "%-18s %-8s %s" % (name, backend,
+                                     "FAILED: %s" % failure if failure
+                                     else "ok")
+    return passed
+
+def run_search_benchmark(backend, depth, workers):
+    """Search each of the perft suite's positions to a fixed depth, first in
+    this process alone and then with a SearchPool of the given size,
+    printing the times and the speedup. Returns True if the pool found the
+    same moves and scores.
     
-    # Get possible moves for selected piece
-    if selected_piece:
-        valid_moves = game.get_valid_moves_for_piece(selected_piece)
-        valid_squares = [move[1] for move in valid_moves]
+    """
+    print "Search benchmark: depth %i, %i workers" % (depth, workers)
+    pool = SearchPool(workers)
+    passed = True
+    total_times = [0.0, 0.0]
+    try:
+        for name, fen, known_counts in PERFT_POSITIONS:
+            results = []
+            for player_pool in None, pool:
+                game = GAME_BACKENDS[backend].from_fen(fen)
+                player = SearchPlayer(game, game.color_to_move,
+                                      max_depth=depth, verbose=False,
+                                      pool=player_pool)
+                start_time = time.time()
+                move = player.get_move()
+                results.append((get_move_string(move), player.score,
+                                max(time.time() - start_time, 1e-6)))
+            (move, score, single_time), (pool_move, pool_score,
+                                         pool_time) = results
+            total_times[0] += single_time
+            total_times[1] += pool_time
+            if (move, score) == (pool_move, pool_score):
+                result = "ok"
+            else:
+                result = "DIFFERENT (%s, score %i)" % (pool_move, pool_score)
+                passed = False
+            print "%-18s %-8s score %6i %7.2fs %7.2fs %5.2fx  %s" % (
+                name, move, score, single_time, pool_time,
+                single_time / pool_time, result)
+    finally:
+        pool.close()
+    print "Speedup with %i workers: %.2fx (%.2fs vs. %.2fs)" % (
+        workers, total_times[0] / max(total_times[1], 1e-6),
+        total_times[0], total_times[1])
+    return passed
+
+def get_batch_positions(backend, path=None):
+    """Games for the batch benchmark: the positions in a FEN file, or the
+    perft suite's positions and everything two plies on from them.
+    
+    """
+    game_class = GAME_BACKENDS[backend]
+    if path:
+        return list(read_fen_file(path, game_class))
+    games = []
+    for name, fen, known_counts in PERFT_POSITIONS:
+        game = game_class.from_fen(fen)
+        games.append(game_class.from_fen(fen))
+        for move in game.get_valid_moves(game.color_to_move):
+            undo = game.make_move(move)
+            games.append(game_class.from_fen(get_fen(game)))
+            for reply in game.get_valid_moves(game.color_to_move):
+                reply_undo = game.make_move(reply)
+                games.append(game_class.from_fen(get_fen(game)))
+                game.unmake_move(reply_undo)
+            game.unmake_move(undo)
+    return games
+
+def run_batch_benchmark(backend, path=None):
+    """Count the legal and pseudo-legal moves in a set of positions (see
+    get_batch_positions) with a PositionBatch, then one game at a time,
+    printing the positions per second for each. Returns True if the counts
+    agree.
+    
+    """
+    games = get_batch_positions(backend, path)
+    print "Batch move generation: %i positions" % len(games)
+    start_time = time.time()
+    batch = PositionBatch.from_games(games)
+    convert_time = time.time() - start_time
+    counts = []
+    for legal in True, False:
+        start_time = time.time()
+        batch_counts = batch.count_moves(legal=legal)
+        batch_time = max(time.time() - start_time, 1e-6)
+        start_time = time.time()
+        game_counts = [len(game.get_valid_moves(game.color_to_move,
+                                                testing_check=not legal))
+                       for game in games]
+        game_time = max(time.time() - start_time, 1e-6)
+        mismatches = sum(1 for batch_count, game_count in
+                         zip(batch_counts, game_counts)
+                         if batch_count != game_count)
+        print ("%-12s batch %10.0f pos/s  %s %10.0f pos/s  %5.1fx  %s" % (
+            "legal" if legal else "pseudo-legal", len(games) / batch_time,
+            backend, len(games) / game_time, game_time / batch_time,
+            "%i DIFFERENT" % mismatches if mismatches else "ok"))
+        counts.append(mismatches)
+    print "Converting to a batch: %.0f pos/s" % (
+        len(games) / max(convert_time, 1e-6))
+    return not any(counts)
+
+def run_encode_benchmark(backend, path=None, output_path=None):
+    """Encode a set of positions (see get_batch_positions) as planes, in
+    memory and then to a memory-mapped .npy file if given, printing the
+    positions per second for each.
+    
+    """
+    games = get_batch_positions(backend, path)
+    print "Encoding %i positions as %i planes" % (len(games), PLANE_COUNT)
+    targets = [("memory", lambda: None)]
+    if output_path:
+        targets.append((output_path,
+                        lambda: open_planes_file(output_path, len(games))))
+    for name, get_out in targets:
+        start_time = time.time()
+        out = encode_positions(games, get_out())
+        if isinstance(out, numpy.memmap):
+            out.flush()
+        print "%-20s %10.0f pos/s  %i bytes" % (
+            name, len(games) / max(time.time() - start_time, 1e-6),
+            out.nbytes)
+
+def play_tournament_game(task):
+    """Play one headless game for run_tournament.
+    
+    Task is (index, seed, backend, white, black, depth, time limit,
+    record, book path, tablebase directory), where white and black are
+    names from TOURNAMENT_PLAYERS and the last two may be None.
+    Returns a dict with the winning colour (None for a draw), the number of
+    plies and the time taken, and if record is set the moves in SAN.
+    
+    """
+    (index, seed, backend, white, black, depth, time_limit, record,
+     book_path, tablebase_dir) = task
+    random.seed(seed)
+    game = GAME_BACKENDS[backend]()
+    book = OpeningBook(book_path) if book_path else None
+    if tablebase_dir:
+        game.tablebase = Tablebase(tablebase_dir)
+    players = {}
+    for color, player_name in (WHITE, white), (BLACK, black):
+        if player_name == "search":
+            players[color] = SearchPlayer(game, color, max_depth=depth,
+                                          time_limit=time_limit,
+                                          verbose=False, book=book)
+        else:
+            players[color] = ComputerPlayer(game, color, book)
+    
+    start_time = time.time()
+    plies = 0
+    san_moves = []
+    try:
+        while True:
+            move = players[game.color_to_move].get_move()
+            if record:
+                san_moves.append(get_san(game, move))
+            game.make_move(move)
+            plies += 1
+            game.check_endgame()
+    except EndGame as e:
+        winner = e.winner
+    if book:
+        book.close()
+    if game.tablebase:
+        game.tablebase.close()
+    return {"index": index, "seed": seed, "winner": winner, "plies": plies,
+            "time": time.time() - start_time, "moves": san_moves}
+
+def get_sprt_llr(wins, draws, losses, elo0, elo1):
+    """Log-likelihood ratio that the Elo difference is elo1 rather than
+    elo0, given the results so far. Uses a normal approximation to the
+    distribution of game scores.
+    
+    """
+    games = wins + draws + losses
+    if not games:
+        return 0.0
+    score = (wins + draws * 0.5) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 +
+                losses * score ** 2) / games
+    if not variance:
+        return 0.0
+    score0 = 1 / (1 + 10 ** (-elo0 / 400.0))
+    score1 = 1 / (1 + 10 ** (-elo1 / 400.0))
+    return ((score1 - score0) * (2 * score - score0 - score1) /
+            (2 * variance / games))
+
+def run_tournament(games, player_a="computer", player_b="computer",
+                   backend="object", depth=3, time_limit=None, seed=0,
+                   workers=None, sprt=None, pgn_path=None, book_path=None,
+                   tablebase_dir=None):
+    """Play games between two players across a pool of worker processes.
+    
+    Players swap colours every game, and game i seeds the random module
+    with seed + i, so any game can be replayed on its own. Results are
+    reported from player A's point of view. sprt is an (elo0, elo1) pair:
+    the tournament stops as soon as the results show which is more likely.
+    Games are added to the PGN file at pgn_path, if given, as they finish.
+    Both players use the opening book at book_path and the endgame
+    tablebases in tablebase_dir, if given.
+    Returns the counts of A's wins, draws and losses.
+    
+    """
+    tasks = []
+    for index in range(games):
+        if index % 2 == 0:
+            white, black = player_a, player_b
+        else:
+            white, black = player_b, player_a
+        tasks.append((index, seed + index, backend, white, black, depth,
+                      time_limit, bool(pgn_path), book_path, tablebase_dir))
+    if sprt:
+        lower_bound = math.log(SPRT_BETA / (1 - SPRT_ALPHA))
+        upper_bound = math.log((1 - SPRT_BETA) / SPRT_ALPHA)
+    
+    # One game per task; they're long enough that passing results back
+    # costs next to nothing, and results arrive in time to stop early.
+    workers = workers or multiprocessing.cpu_count()
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(play_tournament_game, tasks)
     else:
-        valid_squares = []
+        results = (play_tournament_game(task) for task in tasks)
     
-    # Ranks, top to bottom:
-    for y in reversed(range(8)):
-        rank_string = " %i " % (y + 1)
-        for x in range(8):
-            # Get foreground text (must make up two characters)
-            piece = game.get_piece_at((x, y))
-            if piece:
-                if piece == selected_piece or piece == game.last_moved_piece:
-                    piece_char = SELECTED_PIECE_CHARACTERS[piece.__class__]
-                else:
-                    piece_char = PIECE_CHARACTERS[piece.__class__]
-                foreground_text = piece_char + " "
-            else:
-                foreground_text = "  "
-            
-            # Get background colour
-            if (x, y) in valid_squares:
-                square_color = HIGHLIGHTED
-            elif x % 2 == y % 2:
-                square_color = DARK
+    print "Tournament: %s (A) vs. %s (B), %i games, %i workers" % (
+        player_a, player_b, games, workers)
+    wins = draws = losses = 0
+    plies = 0
+    game_time = 0.0
+    verdict = None
+    pgn_file = open(pgn_path, "a") if pgn_path else None
+    start_time = time.time()
+    try:
+        for result in results:
+            a_color = WHITE if result["index"] % 2 == 0 else BLACK
+            if pgn_file:
+                names = {a_color: "%s (A)" % player_a,
+                         not a_color: "%s (B)" % player_b}
+                headers = {"Event": "Tournament", "Site": "?",
+                           "Date": time.strftime("%Y.%m.%d"),
+                           "Round": result["index"] + 1,
+                           "White": names[WHITE], "Black": names[BLACK],
+                           "Seed": result["seed"]}
+                pgn_file.write(get_pgn(headers, result["moves"],
+                                       PGN_RESULTS[result["winner"]]))
+            if result["winner"] is None:
+                draws += 1
+            elif result["winner"] == a_color:
+                wins += 1
             else:
-                square_color = LIGHT
-            piece_color = WHITE
-            if piece and piece.color == BLACK:
-                piece_color = BLACK
-            begin_code = ANSI_BEGIN % "%s;%s" % (ANSI_BG[square_color],
-                                                 ANSI_FG[piece_color])
-            rank_string += "%s%s%s" % (begin_code, foreground_text, ANSI_END)
-        rank_strings.append(rank_string)
-    file_labels = "   A B C D E F G H"
+                losses += 1
+            plies += result["plies"]
+            game_time += result["time"]
+            if sprt and wins + draws + losses >= SPRT_MIN_GAMES:
+                llr = get_sprt_llr(wins, draws, losses, *sprt)
+                if llr >= upper_bound:
+                    verdict = "A is %+g Elo or better" % sprt[1]
+                elif llr <= lower_bound:
+                    verdict = "A is %+g Elo or worse" % sprt[0]
+                if verdict:
+                    break
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        if pgn_file:
+            pgn_file.close()
+    elapsed = max(time.time() - start_time, 1e-6)
     
-    print "\n".join(rank_strings) + "\n" + file_labels
+    played = wins + draws + losses
+    score = (wins + draws * 0.5) / max(played, 1)
+    print "A: %i wins, %i draws, %i losses (%.1f%%)" % (wins, draws, losses,
+                                                        score * 100)
+    if 0 < score < 1:
+        print "Elo difference: %+.0f" % (-400 * math.log10(1 / score - 1))
+    print "Average length: %.1f plies" % (plies / float(max(played, 1)))
+    print "Speed: %i moves/s per worker, %i moves/s in all (%.2fs)" % (
+        plies / max(game_time, 1e-6), plies / elapsed, elapsed)
+    if sprt:
+        print "SPRT (%g, %g): LLR %.2f, bounds %.2f, %.2f - %s" % (
+            sprt[0], sprt[1], get_sprt_llr(wins, draws, losses, *sprt),
+            lower_bound, upper_bound,
+            verdict or "inconclusive after %i games" % played)
+    return wins, draws, losses
 
 
 def main():
-    game = Game()
+    parser = argparse.ArgumentParser(description="Simple command-line chess "
+                                                 "game.")
+    parser.add_argument("mode", nargs="?",
+                        choices=["play", "bench", "compare", "perft",
+                                 "tournament", "replay", "uci", "book",
+                                 "tablebase", "batch", "encode", "check"],
+                        default="play",
+                        help="play a game (the default), time the search "
+                             "engine with and without worker processes (or "
+                             "move generation), check the backends agree, "
+                             "count moves with perft, play computer players "
+                             "against each other, replay the games in a PGN "
+                             "file, run as a UCI engine, build an opening "
+                             "book from a PGN file, build endgame "
+                             "tablebases, time batched move generation "
+                             "with NumPy, time encoding positions as NumPy "
+                             "planes, or run the self-checks")
+    parser.add_argument("--backend", choices=sorted(GAME_BACKENDS),
+                        default="object",
+                        help="game state implementation (default: object)")
+    parser.add_argument("--depth", type=int, default=None,
+                        help="search engine depth in plies (default: 3), or "
+                             "perft depth")
+    parser.add_argument("--time", type=float, default=None,
+                        help="search engine time limit per move, in seconds")
+    parser.add_argument("--fen", default=None,
+                        help="start from this position; for perft, split the "
+                             "count for it by move instead of running the "
+                             "standard suite")
+    parser.add_argument("--compare", action="store_true",
+                        help="perft: run every backend and fail if their "
+                             "counts differ, on the suite, --fen or "
+                             "--positions")
+    parser.add_argument("--moves", action="store_true",
+                        help="bench: time move generation and legality "
+                             "checks against the piece list scans and "
+                             "deep copies they replaced, instead of the "
+                             "search")
+    parser.add_argument("--save-timings", action="store_true",
+                        help="perft: store the suite's speeds for later runs "
+                             "to compare against")
+    parser.add_argument("--move-cache", type=int, default=MOVE_CACHE_SIZE,
+                        metavar="SIZE",
+                        help="legal move lists to keep for recently seen "
+                             "positions (default: %i; 0 disables)" %
+                             MOVE_CACHE_SIZE)
+    parser.add_argument("--games", type=int, default=100,
+                        help="tournament: number of games (default: 100)")
+    parser.add_argument("--players", nargs=2, metavar=("A", "B"),
+                        choices=TOURNAMENT_PLAYERS,
+                        default=["computer", "computer"],
+                        help="tournament: the two players, from %s "
+                             "(default: computer computer)" %
+                             ", ".join(TOURNAMENT_PLAYERS))
+    parser.add_argument("--workers", type=int, default=None,
+                        help="tournament: processes to play games in "
+                             "(default: one per CPU); play, uci and bench: "
+                             "processes for the search engine to share its "
+                             "moves between (default: 1, or for bench, one "
+                             "per CPU)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed for the computer players; for "
+                             "tournament, the seed for the first game, with "
+                             "each game after adding one (default: 0)")
+    parser.add_argument("--sprt", nargs=2, type=float, default=None,
+                        metavar=("ELO0", "ELO1"),
+                        help="tournament: stop once A is shown to be ELO0 "
+                             "or ELO1 stronger than B")
+    parser.add_argument("--pgn", default=None, metavar="PATH",
+                        help="add games played to this PGN file, or for "
+                             "replay, the file to read")
+    parser.add_argument("--book", default=None, metavar="PATH",
+                        help="opening book for computer players to use, or "
+                             "for book mode, the file to write")
+    parser.add_argument("--tablebases", nargs="?", const=TABLEBASE_DIR,
+                        default=None, metavar="DIR",
+                        help="endgame tablebases for computer players and "
+                             "the end of game check to use, or for "
+                             "tablebase mode, where to write them (default: "
+                             "%s)" % TABLEBASE_DIR)
+    parser.add_argument("--material", nargs="+", default=TABLEBASE_MATERIAL,
+                        metavar="NAME",
+                        help="tablebase: the endings to build, e.g. KQKR "
+                             "(default: %s)" % " ".join(TABLEBASE_MATERIAL))
+    parser.add_argument("--positions", default=None, metavar="PATH",
+                        help="batch and encode: file of FENs to use "
+                             "instead of the perft suite and the positions "
+                             "two plies on from it; perft --compare: file "
+                             "of FENs to compare on")
+    parser.add_argument("--output", default=None, metavar="PATH",
+                        help="encode: .npy file to write the planes to as "
+                             "well")
+    parser.add_argument("--render-every", type=int, default=1, metavar="N",
+                        help="play: draw the board after every Nth move of "
+                             "a computer player (default: 1; 0 never)")
+    parser.add_argument("--no-render", action="store_const", const=0,
+                        dest="render_every",
+                        help="play: don't draw the board for computer "
+                             "players; the same as --render-every 0")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="PATH",
+                        default=os.environ.get(PROFILE_ENV_VAR),
+                        help="play: count and time calls to the game's "
+                             "move generation for each turn and print a "
+                             "summary, or write them to PATH as JSON; "
+                             "setting %s to 1 or a path does the same" %
+                             PROFILE_ENV_VAR)
+    args = parser.parse_args()
+    
+    if args.mode == "compare":
+        if not run_backend_comparison():
+            sys.exit(1)
+        return
+    
+    if args.mode == "check":
+        if not run_checks():
+            sys.exit(1)
+        return
+    
+    if args.mode == "book":
+        if not args.pgn or not args.book:
+            parser.error("book needs a PGN file to read (--pgn PATH) and a "
+                         "book file to write (--book PATH)")
+        start_time = time.time()
+        games, records = build_opening_book(read_pgn_file(args.pgn),
+                                            args.book)
+        print "Book: %i moves from %i games written to %s (%.2fs)" % (
+            records, games, args.book, time.time() - start_time)
+        return
+    
+    if args.mode == "tablebase":
+        for name in args.material:
+            if not is_tablebase_name(name):
+                parser.error("%s isn't a pawnless ending of up to %i pieces"
+                             % (name, TABLEBASE_MAX_PIECES))
+        for name in args.material:
+            start_time = time.time()
+            values = build_tablebase(name, args.tablebases or TABLEBASE_DIR)
+            wins = sum(1 for value in values if value and value % 2 == 0)
+            longest = max(max(values), 1) - 1
+            print ("%s: %i positions, %i wins, longest mate %i plies "
+                   "(%.2fs)" % (name, len(values), wins, longest,
+                                time.time() - start_time))
+        return
+    
+    book = None
+    if args.book:
+        try:
+            book = OpeningBook(args.book)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    tablebase = None
+    if args.tablebases:
+        if not os.path.isdir(args.tablebases):
+            parser.error("No tablebases in %s; build them with tablebase "
+                         "mode" % args.tablebases)
+        tablebase = Tablebase(args.tablebases)
+    if args.seed is not None:
+        random.seed(args.seed)
+    
+    if args.mode == "bench":
+        if args.moves:
+            run_move_benchmark(args.backend)
+            return
+        if not run_search_benchmark(args.backend, args.depth or 3,
+                                    args.workers or
+                                    multiprocessing.cpu_count()):
+            sys.exit(1)
+        return
+    
+    if args.mode in ("batch", "encode"):
+        if numpy is None:
+            parser.error("%s needs NumPy" % args.mode)
+        try:
+            if args.mode == "encode":
+                run_encode_benchmark(args.backend, args.positions,
+                                     args.output)
+                return
+            passed = run_batch_benchmark(args.backend, args.positions)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+        if not passed:
+            sys.exit(1)
+        return
+    
+    if args.mode == "perft":
+        if args.compare:
+            try:
+                passed = run_perft_comparison(args.depth, args.fen,
+                                              args.positions)
+            except (IOError, ValueError) as e:
+                parser.error(str(e))
+            if not passed:
+                sys.exit(1)
+        elif args.fen:
+            try:
+                game = GAME_BACKENDS[args.backend].from_fen(args.fen)
+            except ValueError as e:
+                parser.error(str(e))
+            game.move_cache.max_size = args.move_cache
+            run_perft(game, args.depth or 3)
+        elif not run_perft_suite(args.backend, args.depth, args.save_timings):
+            sys.exit(1)
+        return
+    
+    if args.mode == "tournament":
+        if args.sprt and args.sprt[0] >= args.sprt[1]:
+            parser.error("--sprt ELO0 must be less than ELO1")
+        run_tournament(args.games, args.players[0], args.players[1],
+                       backend=args.backend, depth=args.depth or 3,
+                       time_limit=args.time, seed=args.seed or 0,
+                       workers=args.workers, sprt=args.sprt,
+                       pgn_path=args.pgn, book_path=args.book,
+                       tablebase_dir=args.tablebases)
+        return
+    
+    if args.mode == "replay":
+        if not args.pgn:
+            parser.error("replay needs a PGN file (--pgn PATH)")
+        if run_pgn_replay(args.pgn, args.backend):
+            sys.exit(1)
+        return
+    
+    # Processes for the search engine to share root moves between
+    pool = None
+    if args.workers and args.workers > 1:
+        pool = SearchPool(args.workers, args.tablebases)
+    
+    if args.mode == "uci":
+        try:
+            UCIEngine(args.backend, depth=args.depth or 3,
+                      move_cache=args.move_cache, book=book,
+                      tablebase=tablebase, pool=pool).run()
+        finally:
+            if pool:
+                pool.close()
+        return
+    
+    if args.fen:
+        try:
+            game = GAME_BACKENDS[args.backend].from_fen(args.fen)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        game = GAME_BACKENDS[args.backend]()
+    game.move_cache.max_size = args.move_cache
+    game.tablebase = tablebase
+    
+    # Search statistics go on the status line under the board
+    def search_player(color):
+        return SearchPlayer(game, color, max_depth=args.depth or 3,
+                            time_limit=args.time, verbose=False, book=book,
+                            pool=pool)
+    
+    def computer_player(color):
+        return ComputerPlayer(game, color, book)
     
     # Get the game type
     print "Let's play chess! Select a game type:"
@@ -687,43 +5643,127 @@ def main():
     print "2. Computer vs. human"
     print "3. Human vs. computer"
     print "4. Human vs. human"
+    print "5. Search engine vs. computer"
+    print "6. Computer vs. search engine"
+    print "7. Human vs. search engine"
     print
     while True:
         option = raw_input("Selection: ").strip()
-        if not option in ["1", "2", "3", "4"]:
-            print "Select an option above (1-4)"
+        if not option in ["1", "2", "3", "4", "5", "6", "7"]:
+            print "Select an option above (1-7)"
             continue
         if option == "1":
-            players = {WHITE: ComputerPlayer(game, WHITE),
-                       BLACK: ComputerPlayer(game, BLACK)}
+            players = {WHITE: computer_player(WHITE),
+                       BLACK: computer_player(BLACK)}
         elif option == "2":
-            players = {WHITE: ComputerPlayer(game, WHITE),
+            players = {WHITE: computer_player(WHITE),
                        BLACK: HumanPlayer(game, BLACK)}
         elif option == "3":
             players = {WHITE: HumanPlayer(game, WHITE),
-                       BLACK: ComputerPlayer(game, BLACK)}
+                       BLACK: computer_player(BLACK)}
         elif option == "4":
             players = {WHITE: HumanPlayer(game, WHITE),
                        BLACK: HumanPlayer(game, BLACK)}
+        elif option == "5":
+            players = {WHITE: search_player(WHITE),
+                       BLACK: computer_player(BLACK)}
+        elif option == "6":
+            players = {WHITE: computer_player(WHITE),
+                       BLACK: search_player(BLACK)}
+        elif option == "7":
+            players = {WHITE: HumanPlayer(game, WHITE),
+                       BLACK: search_player(BLACK)}
         else:
             raise RuntimeError("Never reached.")
         break
     
+    # Record the game for PGN, starting wherever the game starts
+    player_names = {ComputerPlayer: "Computer", HumanPlayer: "Human",
+                    SearchPlayer: "Search engine"}
+    pgn_headers = {"Event": "Casual game", "Site": "?",
+                   "Date": time.strftime("%Y.%m.%d"), "Round": "-",
+                   "White": player_names[players[WHITE].__class__],
+                   "Black": player_names[players[BLACK].__class__]}
+    if args.fen:
+        pgn_headers.update(SetUp="1", FEN=game.to_fen())
+    first_move_number = game.fullmove_number
+    black_first = game.color_to_move == BLACK
+    san_moves = []
+    
+    profiler = None
+    if args.profile and args.profile != "0":
+        profiler = Profiler()
+        profiler.install()
+    
     # Main game loop
+    renderer = BoardRenderer()
+    status = ""
+    plies = 0
     try:
         while True:
-            # time.sleep(0.01)
-            draw_game(game)
-            
             player_to_move = players[game.color_to_move]
+            if isinstance(player_to_move, HumanPlayer):
+                # Always show the board to a human, and start again below
+                # whatever they type
+                renderer.draw(game, status)
+                renderer.invalidate()
+            elif args.render_every and not plies % args.render_every:
+                renderer.draw(game, status)
+            
+            if profiler:
+                profiler.start_turn()
             move = player_to_move.get_move()
-            game.move_piece_to(move[0], move[1])
-            game.color_to_move = not game.color_to_move
+            if profiler:
+                turn = profiler.end_turn(
+                    ply=plies + 1, color=COLOR_NAMES[game.color_to_move],
+                    player=player_names[player_to_move.__class__],
+                    move=get_move_string(move))
+                if args.profile in ("-", "1"):
+                    print "Profile: " + get_profile_string(turn, limit=3)
+                    renderer.invalidate()
+            status = "%s played %s" % (COLOR_NAMES[game.color_to_move].title(),
+                                       get_move_string(move))
+            if player_to_move.played_book_move:
+                status += " (book)"
+            elif isinstance(player_to_move, SearchPlayer):
+                status += (" (depth %i, %i nodes, %.2fs, score %i)" %
+                           (player_to_move.depth_reached,
+                            player_to_move.nodes, player_to_move.search_time,
+                            player_to_move.score))
+            if args.pgn:
+                san_moves.append(get_san(game, move))
+            game.make_move(move)
+            plies += 1
             game.check_endgame()
             
     except EndGame as e:
-        draw_game(game)
+        if args.render_every:
+            renderer.draw(game, status)
         print e
+        print "Move cache: %i hits, %i misses" % (game.move_cache.hits,
+                                                 game.move_cache.misses)
+        if args.pgn:
+            with open(args.pgn, "a") as pgn_file:
+                pgn_file.write(get_pgn(pgn_headers, san_moves,
+                                       PGN_RESULTS[e.winner],
+                                       first_move_number, black_first))
+            print "Game added to %s" % args.pgn
+        if profiler:
+            summary = profiler.summary()
+            if args.profile in ("-", "1"):
+                print "Profile for the game:"
+                print get_profile_string(summary)
+            else:
+                summary.update(backend=args.backend, result=str(e))
+                with open(args.profile, "w") as profile_file:
+                    json.dump(summary, profile_file, indent=2,
+                              sort_keys=True)
+                print "Profile written to %s" % args.profile
+    finally:
+        if profiler:
+            profiler.uninstall()
+        if pool:
+            pool.close()
     
 
 class AbstractPlayer(object):
@@ -731,12 +5771,53 @@ class AbstractPlayer(object):
     the chess game.
     
     get_move must be subclassed; player objects will have this method called
-    repeatedly until the game is over.
+    repeatedly until the game is over. Computer players should try
+    get_book_move and get_tablebase_move first.
     
     """
-    def __init__(self, game, color):
+    def __init__(self, game, color, book=None):
         self.game = game
         self.color = color
+        self.book = book
+        self.played_book_move = False
+    
+    def get_book_move(self):
+        """A move from the player's opening book for the current position,
+        or None if there's no book or the position isn't in it.
+        
+        """
+        move = None
+        if self.book:
+            move = self.book.choose_move(self.game)
+        self.played_book_move = move is not None
+        return move
+    
+    def get_tablebase_move(self):
+        """The best move according to the game's tablebase - the quickest
+        win, else a draw, else the slowest loss - or None if the position
+        isn't in it.
+        
+        """
+        game = self.game
+        if (not game.tablebase or
+            game.get_piece_count() > TABLEBASE_MAX_PIECES or
+            game.tablebase.probe(game) is None):
+            return None
+        best_move = best_score = None
+        for move in game.get_valid_moves(self.color):
+            undo = game.make_move(move)
+            try:
+                result = game.tablebase.probe(game)
+            finally:
+                game.unmake_move(undo)
+            if result is None:
+                # Takes into a tablebase that hasn't been built
+                return None
+            outcome, plies = result
+            score = -outcome * (TABLEBASE_MAX_PLIES - plies)
+            if best_score is None or score > best_score:
+                best_move, best_score = move, score
+        return best_move
     
     def get_move(self):
         """Return the move that the player wants to make based on the
@@ -751,57 +5832,70 @@ class ComputerPlayer(AbstractPlayer):
     
     Considers checkmate, checks, captures, retreats and pawn advances.
     No forward-planning though, so it's extremely basic and easy to beat.
+    Whether a move risks material is worked out by get_static_exchange.
     
     """
     def get_move(self):
         if not self.game.color_to_move == self.color:
             raise RuntimeError("Not my turn!")
         
-        available_moves = self.game.get_valid_moves(self.color)
+        book_move = self.get_book_move() or self.get_tablebase_move()
+        if book_move:
+            return book_move
+        
+        # Always promote to a Queen
+        available_moves = [move for move in
+                           self.game.get_valid_moves(self.color)
+                           if len(move) == 2]
         
         # Find checking moves
         checking_moves = []
-        riskless_checking_moves = []
         for move in available_moves:
-            test_game = copy.deepcopy(self.game)
-            test_game.move_piece_to(move[0], move[1])
-            if test_game.in_check(not self.color):
-                # Check for potential mates
-                if not test_game.get_valid_moves(not self.color):
-                    return move
+            undo = self.game.make_move(move)
+            in_check = self.game.in_check(not self.color)
+            # Check for potential mates
+            mate = in_check and not self.game.has_legal_move(not self.color)
+            self.game.unmake_move(undo)
+            if mate:
+                return move
+            if in_check:
                 checking_moves.append(move)
-                if not test_game.is_piece_at_risk(move[0]):
-                    riskless_checking_moves.append(move)
+        riskless_checking_moves = [
+            move for move in checking_moves if
+            get_static_exchange(self.game, move) >= 0]
         
         # Find taking moves
         taking_moves = [move for move in available_moves if
                         self.game.get_piece_at(move[1])]
         
-        # Retreats
-        retreats = {}
+        # Retreats: moves to safety for pieces the other side would win
+        # material by taking. Only pieces on the attack map can be at risk.
+        self.game.get_attack_map(not self.color)
+        pieces_at_risk = [piece for piece in self.game.get_pieces(self.color)
+                          if self.game.is_piece_at_risk(piece) and
+                          get_exchange_loss(self.game, piece.pos,
+                                            not self.color,
+                                            PIECE_VALUES[piece.__class__])]
+        retreats = []
         for move in available_moves:
-            if self.game.is_piece_at_risk(move[0]):
-                test_game = copy.deepcopy(self.game)
-                test_game.move_piece_to(move[0], move[1])
-                if test_game.is_piece_at_risk(test_game.get_piece_at(move[1])):
-                    continue
-                retreats[move] = move[0].value
+            if (move[0] in pieces_at_risk and
+                get_static_exchange(self.game, move) >= 0):
+                retreats.append((move, move[0].value))
         highest_value = -999999
         best_retreat = None
-        for move, value in retreats.items():
+        for move, value in retreats:
             if value > highest_value:
                 best_retreat = move
                 highest_value = value
         if best_retreat:
             return best_retreat
         
-        # Find riskless taking moves (free material)
-        riskless_taking_moves = []
-        for move in taking_moves:
-            test_game = copy.deepcopy(self.game)
-            test_game.move_piece_to(move[0], move[1])
-            if not test_game.is_piece_at_risk(test_game.get_piece_at(move[1])):
-                riskless_taking_moves.append(move)
+        # Find taking moves that win material, once the exchange is over.
+        # Taking a piece worth more than the one taking always does.
+        riskless_taking_moves = [
+            move for move in taking_moves if
+            (self.game.get_piece_at(move[1]).value > move[0].value or
+             get_static_exchange(self.game, move) > 0)]
         if riskless_taking_moves:
             return random.choice(riskless_taking_moves)
         
@@ -810,15 +5904,10 @@ class ComputerPlayer(AbstractPlayer):
             return random.choice(riskless_checking_moves)
         
         # Find the best value taking move
-        valued_taking_moves = {}
-        for move in taking_moves:
-            our_piece = move[0]
-            their_piece = self.game.get_piece_at(move[1])
-            move_value = their_piece.value - our_piece.value
-            valued_taking_moves[move] = move_value
         highest_value = -999999
         best_taking_move = None
-        for move, value in valued_taking_moves.items():
+        for move in taking_moves:
+            value = get_static_exchange(self.game, move)
             if value > highest_value:
                 best_taking_move = move
                 highest_value = value
@@ -832,7 +5921,7 @@ class ComputerPlayer(AbstractPlayer):
         if pawn_moves:
             good_options.append(random.choice(pawn_moves))
         if checking_moves:
-            good_options.append(checking_moves)
+            good_options.append(random.choice(checking_moves))
         if best_taking_move:
             good_options.append(best_taking_move)
         if good_options:
@@ -841,6 +5930,372 @@ class ComputerPlayer(AbstractPlayer):
         # Make any move
         return random.choice(available_moves)
 
+
+class SearchTimeout(Exception):
+    """Raised inside SearchPlayer's search when it runs out of time or is
+    told to stop.
+    
+    """
+    pass
+
+
+class SearchPlayer(AbstractPlayer):
+    """AI-controlled player that looks ahead.
+    
+    Negamax search with alpha-beta pruning and iterative deepening: it
+    searches one ply deep, then two, and so on up to max_depth, stopping
+    early if time_limit (in seconds) runs out or stop_event (a
+    threading.Event) is set. Positions are scored on material and where the
+    pieces stand (see PIECE_SQUARE_SCORES), or exactly if they're in the
+    game's tablebase. With check_evaluation set (or CHESS_CHECK_EVALUATION
+    in the environment), the game's running scores are checked against a
+    full recount at every position scored.
+    
+    If given, report is called with the depth, score and best move each time
+    a depth is finished. Moves in the opening book are played without a
+    search.
+    
+    With a SearchPool, the first root move is searched here and the rest
+    are shared out between the pool's processes, bounded by its score. The
+    best move and score are the same as without one.
+    
+    """
+    def __init__(self, game, color, max_depth=3, time_limit=None,
+                 verbose=True, stop_event=None, report=None, book=None,
+                 pool=None, check_evaluation=None):
+        super(SearchPlayer, self).__init__(game, color, book)
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.verbose = verbose
+        self.stop_event = stop_event
+        self.report = report
+        self.pool = pool
+        if check_evaluation is None:
+            check_evaluation = bool(os.environ.get(CHECK_EVALUATION_ENV_VAR))
+        self.check_evaluation = check_evaluation
+        
+        # Whether the search can stop early yet, and the best root score
+        # found by other processes (a multiprocessing.Value), if it's
+        # searching for a SearchPool
+        self.can_stop = False
+        self.root_bound = None
+        
+        # Statistics for the last search
+        self.nodes = 0
+        self.depth_reached = 0
+        self.search_time = 0.0
+        self.score = 0
+    
+    def get_move(self):
+        if not self.game.color_to_move == self.color:
+            raise RuntimeError("Not my turn!")
+        
+        start_time = time.time()
+        self._deadline = None
+        if self.time_limit is not None:
+            self._deadline = start_time + self.time_limit
+        self.nodes = 0
+        self.depth_reached = 0
+        self.search_time = 0.0
+        self.can_stop = False
+        
+        book_move = self.get_book_move()
+        if book_move:
+            if self.verbose:
+                print "Book move"
+            return book_move
+        tablebase_move = self.get_tablebase_move()
+        if tablebase_move:
+            if self.verbose:
+                print "Tablebase move"
+            return tablebase_move
+        
+        # Deepen one ply at a time, searching the best move so far first
+        best_move = None
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, move = self._search_root(depth, best_move)
+            except SearchTimeout:
+                break
+            best_move = move
+            self.score = score
+            self.depth_reached = depth
+            # There's a move to fall back on now
+            self.can_stop = True
+            if self.report:
+                self.report(depth, score, move)
+            if abs(score) >= MATE_SCORE - self.max_depth:
+                # Found a forced mate; searching deeper won't help
+                break
+        
+        self.search_time = time.time() - start_time
+        if self.verbose:
+            print ("Searched %i nodes to depth %i in %.2fs (%i nodes/s), "
+                   "score %i" % (self.nodes, self.depth_reached,
+                                 self.search_time, self.get_nodes_per_second(),
+                                 self.score))
+        return best_move
+    
+    def get_nodes_per_second(self):
+        """Search speed for the last move.
+        
+        """
+        if not self.search_time:
+            return 0
+        return int(self.nodes / self.search_time)
+    
+    def evaluate(self):
+        """Score the position for the player to move, in hundredths of a
+        pawn, from the game's running scores.
+        
+        """
+        game = self.game
+        color = game.color_to_move
+        scores = game.scores
+        if self.check_evaluation:
+            expected = game.compute_scores()
+            assert scores == expected, (
+                "Running scores %r don't match %r after %s" %
+                (scores, expected, get_fen(game)))
+        return scores[color] - scores[not color]
+    
+    def _order_moves(self, moves, first_move=None):
+        """Sort moves so the ones most likely to be good come first: the
+        given move, then captures of valuable pieces by cheap ones.
+        
+        """
+        def move_priority(move):
+            if (first_move and move[0].pos == first_move[0].pos and
+                move[1:] == first_move[1:]):
+                return 100000
+            taken_piece = self.game.get_piece_at(move[1])
+            if not taken_piece:
+                return 0
+            return (PIECE_VALUES[taken_piece.__class__] * 10 -
+                    PIECE_VALUES[move[0].__class__])
+        return sorted(moves, key=move_priority, reverse=True)
+    
+    def _search_root(self, depth, first_move):
+        """Search every move to the given depth. Returns the best score and
+        move.
+        
+        """
+        game = self.game
+        moves = self._order_moves(game.get_valid_moves(self.color),
+                                  first_move)
+        alpha, beta = -MATE_SCORE - 1, MATE_SCORE + 1
+        best_move = moves[0]
+        
+        # Depth one is over too quickly to be worth sharing out
+        split = len(moves)
+        if self.pool and depth > 1:
+            split = 1
+        for move in moves[:split]:
+            undo = game.make_move(move)
+            try:
+                score = -self._negamax(depth - 1, -beta, -alpha, 1)
+            finally:
+                game.unmake_move(undo)
+            if score > alpha:
+                alpha = score
+                best_move = move
+        
+        if moves[split:]:
+            # Results come back in move order, so ties go the same way
+            results = self.pool.search(
+                game, moves[split:], depth - 1, -beta, -alpha,
+                self._deadline, self.can_stop, self.stop_event)
+            for move, (score, nodes) in zip(moves[split:], results):
+                self.nodes += nodes
+                if -score > alpha:
+                    alpha = -score
+                    best_move = move
+        return alpha, best_move
+    
+    def _negamax(self, depth, alpha, beta, ply):
+        """Score of the position for the player to move, searched depth plies
+        ahead. Scores outside alpha-beta are only bounds.
+        
+        """
+        self.nodes += 1
+        if self.can_stop and not self.nodes & SEARCH_CHECK_INTERVAL:
+            if self._deadline and time.time() > self._deadline:
+                raise SearchTimeout()
+            if self.stop_event and self.stop_event.is_set():
+                raise SearchTimeout()
+        
+        game = self.game
+        if (game.tablebase and
+            game.get_piece_count() <= TABLEBASE_MAX_PIECES):
+            result = game.tablebase.probe(game)
+            if result:
+                outcome, plies = result
+                if outcome == TABLEBASE_WIN:
+                    return MATE_SCORE - ply - plies
+                if outcome == TABLEBASE_LOSS:
+                    return -MATE_SCORE + ply + plies
+                return 0
+        
+        color = game.color_to_move
+        
+        # A leaf only needs to know there's a move, not what they all are
+        if depth == 0:
+            has_move = game.has_legal_move(color)
+        else:
+            moves = game.get_valid_moves(color)
+            has_move = bool(moves)
+        if not has_move:
+            # Checkmate (sooner is worse) or stalemate
+            if game.in_check(color):
+                return -MATE_SCORE + ply
+            return 0
+        if game.idle_move_count >= 50:
+            return 0
+        if depth == 0:
+            return self.evaluate()
+        
+        for move in self._order_moves(moves):
+            if ply == 1 and self.root_bound is not None:
+                # Only scores that would beat (or, for an earlier root move,
+                # tie) the best root move so far matter
+                beta = min(beta, 1 - self.root_bound.value)
+                if alpha >= beta:
+                    return alpha
+            undo = game.make_move(move)
+            try:
+                score = -self._negamax(depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                game.unmake_move(undo)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+
+# The position a search worker process is looking at, so its move cache
+# carries over between root moves and depths, its tablebases, and what it
+# shares with the SearchPool that started it.
+_search_worker = {"fen": None, "game": None, "tablebase": None,
+                  "cancel": None, "bound": None}
+
+def init_search_worker(tablebase_dir, cancel, bound):
+    if tablebase_dir:
+        _search_worker["tablebase"] = Tablebase(tablebase_dir)
+    _search_worker["cancel"] = cancel
+    _search_worker["bound"] = bound
+
+def search_root_move(task):
+    """Search one root move in a SearchPool process.
+    
+    Task is (game class, FEN, move cache size, move in UCI notation, depth,
+    alpha, beta, deadline, whether it can stop early). Returns the score
+    for the player to move after the move (or None if the search was
+    cancelled first) and the number of nodes searched.
+    
+    """
+    (game_class, fen, move_cache, move_string, depth, alpha, beta, deadline,
+     can_stop) = task
+    cancel = _search_worker["cancel"]
+    bound = _search_worker["bound"]
+    if can_stop and cancel.is_set():
+        return None, 0
+    game = _search_worker["game"]
+    if (_search_worker["fen"] != fen or
+        game.__class__ != game_class):
+        game = game_class.from_fen(fen)
+        game.move_cache.max_size = move_cache
+        game.tablebase = _search_worker["tablebase"]
+        _search_worker["fen"] = fen
+        _search_worker["game"] = game
+    
+    undo = game.make_move(get_move_for_uci(game, move_string))
+    player = SearchPlayer(game, game.color_to_move, verbose=False,
+                          stop_event=cancel)
+    player._deadline = deadline
+    player.can_stop = can_stop
+    player.root_bound = bound
+    try:
+        score = player._negamax(depth, alpha, beta, 1)
+    except SearchTimeout:
+        score = None
+    finally:
+        game.unmake_move(undo)
+    if score is not None:
+        # Anything better than the best root score so far is exact; let the
+        # other processes cut off at it
+        with bound.get_lock():
+            if -score > bound.value:
+                bound.value = -score
+    return score, player.nodes
+
+
+class SearchPool(object):
+    """Worker processes for SearchPlayer to search root moves in, side by
+    side. The processes start when they're first needed and stay up until
+    the pool is closed.
+    
+    The processes share the best root score found so far, and cut their
+    searches off at it. A search stopped part way cancels the moves still
+    being searched, and waits for them to give up.
+    
+    """
+    def __init__(self, workers, tablebase_dir=None):
+        self.workers = workers
+        self.tablebase_dir = tablebase_dir
+        self._pool = None
+        self._cancel = multiprocessing.Event()
+        self._bound = multiprocessing.Value("i", 0)
+    
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+    
+    def search(self, game, moves, depth, alpha, beta, deadline=None,
+               can_stop=True, stop_event=None):
+        """Search each move to the given depth, bounded by alpha and beta,
+        for the player to move after it. Returns a (score, nodes) pair for
+        each move, in order. Raises SearchTimeout if the deadline passes or
+        stop_event is set before they're all done, as long as can_stop is
+        set.
+        
+        """
+        if not self._pool:
+            self._pool = multiprocessing.Pool(
+                self.workers, init_search_worker,
+                (self.tablebase_dir, self._cancel, self._bound))
+        # The best score so far for the player at the root
+        self._bound.value = -beta
+        fen = game.to_fen()
+        results = [self._pool.apply_async(search_root_move, [(
+                       game.__class__, fen, game.move_cache.max_size,
+                       get_uci_move(move), depth, alpha, beta,
+                       deadline if can_stop else None, can_stop)])
+                   for move in moves]
+        scores = []
+        try:
+            for result in results:
+                while not result.ready():
+                    result.wait(SEARCH_POLL_INTERVAL)
+                    if can_stop and ((deadline and time.time() > deadline) or
+                                     (stop_event and stop_event.is_set())):
+                        raise SearchTimeout()
+                score, nodes = result.get()
+                if score is None:
+                    raise SearchTimeout()
+                scores.append((score, nodes))
+        except SearchTimeout:
+            # Don't leave the other processes searching, but keep them
+            self._cancel.set()
+            for result in results:
+                result.wait()
+            self._cancel.clear()
+            raise
+        return scores
+
+
 class HumanPlayer(AbstractPlayer):
     """Represents a human player.
     
@@ -864,12 +6319,14 @@ class HumanPlayer(AbstractPlayer):
             # Get user input
             move_string = raw_input("Your move: ").strip().upper()
             
-            # Is it an explicit move (from -> to)?
-            explicit_match = re.match(r"([A-H][1-8]).*([A-H][1-8])",
+            # Is it an explicit move (from -> to, then what to promote to
+            # if it's not a Queen)?
+            explicit_match = re.match(r"([A-H][1-8]).*([A-H][1-8])([NBR]?)$",
                                       move_string)
             if explicit_match:
                 from_ref = explicit_match.group(1)
                 to_ref = explicit_match.group(2)
+                promotion_letter = explicit_match.group(3)
                 from_pos = get_coords_for_grid_ref(from_ref)
                 to_pos = get_coords_for_grid_ref(to_ref)
                 piece = self.game.get_piece_at(from_pos)
@@ -886,11 +6343,19 @@ class HumanPlayer(AbstractPlayer):
                 if not to_pos in valid_squares:
                     print "That %s can't move to %s!" % (piece.name, to_ref)
                     continue
+                if promotion_letter:
+                    promotion = PIECE_CLASSES_FOR_LETTERS[
+                        promotion_letter.lower()]
+                    if not (piece, to_pos, promotion) in valid_moves:
+                        print "That %s can't promote!" % piece.name
+                        continue
+                    return (piece, to_pos, promotion)
                 return (piece, to_pos)
             
             # Specified a single square
             if not re.match(r"[A-H][1-8]", move_string):
-                print "That's not a valid move. Examples: 'A8', 'D2D4', etc."
+                print ("That's not a valid move. Examples: 'A8', 'D2D4', "
+                       "'A7A8N', etc.")
                 continue
             pos = get_coords_for_grid_ref(move_string)
             piece_on_target = self.game.get_piece_at(pos)
@@ -899,7 +6364,7 @@ class HumanPlayer(AbstractPlayer):
             if not piece_on_target or not piece_on_target.color == self.color:
                 valid_moves = self.game.get_valid_moves(self.color)
                 moves_to_target = [move for move in valid_moves if
-                                   move[1] == pos]
+                                   move[1] == pos and len(move) == 2]
                 if not moves_to_target:
                     action_string = "move there"
                     if piece_on_target:
@@ -950,6 +6415,213 @@ class HumanPlayer(AbstractPlayer):
                 continue
             return (piece, coords)
 
+
+class UCIEngine(object):
+    """Speaks the Universal Chess Interface on standard input and output, so
+    the search engine can be used from chess GUIs and match runners.
+    
+    Searches run on a worker thread, so "stop" and "isready" are answered
+    while the engine is thinking. Only one search runs at a time; any command
+    that changes the position stops the current one first.
+    
+    """
+    def __init__(self, backend="object", depth=3, move_cache=MOVE_CACHE_SIZE,
+                 book=None, tablebase=None, pool=None, input_file=None,
+                 output_file=None):
+        self.game_class = GAME_BACKENDS[backend]
+        self.depth = depth
+        self.move_cache = move_cache
+        self.book = book
+        self.tablebase = tablebase
+        self.pool = pool
+        self.input_file = input_file or sys.stdin
+        self.output_file = output_file or sys.stdout
+        self.game = self._new_game()
+        
+        self._output_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._search_thread = None
+        self._player = None
+        self._search_start = 0.0
+        self._infinite = False
+    
+    def run(self):
+        """Answer commands until "quit" or the end of input.
+        
+        """
+        # Not "for line in input_file", which reads ahead and would wait for
+        # more input before handling a command
+        for line in iter(self.input_file.readline, ""):
+            if not self.handle_command(line):
+                break
+        self.stop()
+    
+    def send(self, line):
+        """Write a line of output. Both threads write, so one line at a time.
+        
+        """
+        with self._output_lock:
+            self.output_file.write(line + "\n")
+            self.output_file.flush()
+    
+    def handle_command(self, line):
+        """Act on a line of input. Returns False once told to quit.
+        
+        """
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, arguments = tokens[0], tokens[1:]
+        if command == "uci":
+            self.send("id name %s" % UCI_ENGINE_NAME)
+            self.send("id author %s" % UCI_AUTHOR)
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self.stop()
+            self.game = self._new_game()
+        elif command == "position":
+            self.stop()
+            self.set_position(arguments)
+        elif command == "go":
+            self.stop()
+            self.go(arguments)
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            return False
+        elif command not in ("debug", "setoption", "register", "ponderhit"):
+            self.send("info string Unknown command: %s" % command)
+        return True
+    
+    def set_position(self, arguments):
+        """Handle "position startpos|fen FEN [moves MOVE...]". If a move
+        is illegal the position stops at the move before.
+        
+        """
+        if "moves" in arguments:
+            moves = arguments[arguments.index("moves") + 1:]
+            arguments = arguments[:arguments.index("moves")]
+        else:
+            moves = []
+        try:
+            if arguments[:1] == ["startpos"]:
+                game = self._new_game()
+            elif arguments[:1] == ["fen"]:
+                game = self.game_class.from_fen(" ".join(arguments[1:]))
+                game.move_cache.max_size = self.move_cache
+                game.tablebase = self.tablebase
+            else:
+                raise ValueError("Expected startpos or fen")
+        except ValueError as e:
+            self.send("info string Bad position: %s" % e)
+            return
+        self.game = game
+        for move_string in moves:
+            try:
+                move = get_move_for_uci(game, move_string)
+            except ValueError as e:
+                self.send("info string %s" % e)
+                return
+            game.make_move(move)
+    
+    def go(self, arguments):
+        """Handle "go", starting a search on the worker thread. Understands
+        depth, movetime, wtime, btime, winc, binc, movestogo and infinite.
+        
+        """
+        options = {}
+        for name, value in zip(arguments, arguments[1:]):
+            if name in ("depth", "movetime", "wtime", "btime", "winc", "binc",
+                        "movestogo"):
+                try:
+                    options[name] = int(value)
+                except ValueError:
+                    self.send("info string Bad %s: %s" % (name, value))
+        
+        # Spend a fixed time, or a share of what's left on the clock
+        color = self.game.color_to_move
+        clock, increment = (("wtime", "winc") if color == WHITE
+                            else ("btime", "binc"))
+        time_limit = None
+        if "movetime" in options:
+            time_limit = options["movetime"] / 1000.0
+        elif clock in options:
+            remaining = options[clock] / 1000.0
+            time_limit = min(remaining / options.get("movestogo",
+                                                     UCI_MOVES_TO_GO) +
+                             options.get(increment, 0) / 1000.0,
+                             remaining / 2)
+        if time_limit is not None:
+            time_limit = max(time_limit - UCI_MOVE_OVERHEAD, 0.0)
+        
+        if "depth" in options:
+            max_depth = max(options["depth"], 1)
+        elif time_limit is not None or "infinite" in arguments:
+            max_depth = UCI_MAX_DEPTH
+        else:
+            max_depth = self.depth
+        
+        self._stop_event.clear()
+        self._infinite = "infinite" in arguments
+        self._player = SearchPlayer(self.game, color, max_depth=max_depth,
+                                    time_limit=time_limit, verbose=False,
+                                    stop_event=self._stop_event,
+                                    report=self._report, book=self.book,
+                                    pool=self.pool)
+        self._search_start = time.time()
+        self._search_thread = threading.Thread(target=self._search)
+        self._search_thread.daemon = True
+        self._search_thread.start()
+    
+    def stop(self):
+        """Stop the search if there is one, waiting for its best move to be
+        sent.
+        
+        """
+        if self._search_thread:
+            self._stop_event.set()
+            self._search_thread.join()
+            self._search_thread = None
+    
+    def _new_game(self):
+        game = self.game_class()
+        game.move_cache.max_size = self.move_cache
+        game.tablebase = self.tablebase
+        return game
+    
+    def _search(self):
+        """Worker thread: search and send the best move. An infinite search
+        can finish early (on a mate, at UCI_MAX_DEPTH, or with a book or
+        tablebase move), but bestmove mustn't be sent until "stop".
+        
+        """
+        if not self.game.has_legal_move(self._player.color):
+            move_string = "0000"
+        else:
+            move_string = get_uci_move(self._player.get_move())
+        if self._infinite:
+            self._stop_event.wait()
+        self.send("bestmove %s" % move_string)
+    
+    def _report(self, depth, score, move):
+        """Send the search's progress after each depth.
+        
+        """
+        elapsed = time.time() - self._search_start
+        if abs(score) > MATE_SCORE - UCI_MAX_DEPTH - TABLEBASE_MAX_PLIES:
+            plies = MATE_SCORE - abs(score)
+            score_string = "mate %i" % ((plies + 1) // 2 if score > 0
+                                        else -((plies + 1) // 2))
+        else:
+            score_string = "cp %i" % score
+        nodes = self._player.nodes
+        self.send("info depth %i score %s nodes %i nps %i time %i pv %s" %
+                  (depth, score_string, nodes,
+                   nodes / elapsed if elapsed else 0, elapsed * 1000,
+                   get_uci_move(move)))
+
 if __name__ == "__main__":
     try:
         main()